@@ -0,0 +1,134 @@
+"""
+Round trip latency and throughput of commands through
+Host.send -> sera watch -> Host.receive on the in-memory provider, with the
+share of time spent in json, NaCl key setup, encryption and dispatch.
+
+    python -m benchmarks.roundtrip --count 1000 --workers 4  # from the repo root
+"""
+from collections import defaultdict
+import json
+import os
+import statistics
+import threading
+import time
+
+import click
+from nacl import public
+
+os.environ['SERA_CLIENT'] = 'sera.providers.memory.MemoryProvider'
+
+from sera.commands.main import main  # noqa: E402
+from sera.sera import Host, RemoteCommand  # noqa: E402
+from sera.utils import keygen  # noqa: E402
+
+WATCHER = 'benchmark'
+
+
+@main.command()
+@click.pass_context
+@click.argument('args', nargs=-1)
+def noop(ctx, args):
+    """Return the arguments without running a process"""
+    return RemoteCommand(returncode=0, stdout=' '.join(args))
+
+
+class Timings(object):
+    """Accumulate the time spent in wrapped functions across threads"""
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def wrap(self, owner, attr, label):
+        original = getattr(owner, attr)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.totals[label] += time.perf_counter() - start
+        setattr(owner, attr, timed)
+
+    def reset(self):
+        with self.lock:
+            self.totals.clear()
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+@click.command()
+@click.option('--count', '-n', default=500, help="Commands per run")
+@click.option('--workers', '-w', default=1, help="Watcher worker pool size")
+@click.option('--command', '-c', default='noop', help="Command to send, e.g. echo")
+@click.option('--duplicates', default=0.0, help="Chance of duplicate delivery")
+def benchmark(count, workers, command, duplicates):
+    public_key, private_key = keygen(None, write=False)
+    os.environ['SERA_CLIENT_PUBLIC_KEY'] = public_key
+    os.environ['SERA_CLIENT_PRIVATE_KEY'] = private_key
+    os.environ['SERA_MEMORY_DUPLICATES'] = str(duplicates)
+
+    timings = Timings()
+    timings.wrap(json, 'dumps', 'json')
+    timings.wrap(json, 'loads', 'json')
+    for owner in [public.PrivateKey, public.PublicKey, public.Box]:
+        timings.wrap(owner, '__init__', 'key setup')
+    timings.wrap(public.Box, 'encrypt', 'encryption')
+    timings.wrap(public.Box, 'decrypt', 'encryption')
+
+    master = Host.get(public_key.replace('=', ''), create=True)
+    Host.get(WATCHER, create=True)
+    watcher = threading.Thread(target=main.main, kwargs={
+        'args': [
+            '-w', WATCHER, '-t', '-1', '-v', '0',
+            'watch', '-c', public_key, '-n', str(workers)],
+        'standalone_mode': False})
+    watcher.start()
+    params = {'args': ['hello']}
+    master.send(WATCHER, command, params, public_key, timeout=5)  # warm up
+
+    timings.reset()
+    latencies = []
+    start = time.perf_counter()
+    for i in range(count):
+        sent = time.perf_counter()
+        resp = master.send(WATCHER, command, params, public_key, timeout=5)
+        if not resp:
+            raise click.ClickException('No response from the watcher')
+        latencies.append(time.perf_counter() - sent)
+    elapsed = time.perf_counter() - start
+    shares = dict(timings.totals)
+
+    start = time.perf_counter()
+    master.send_batch([(WATCHER, command, params, public_key)] * count)
+    received = 0
+    while received < count and master.receive(timeout=5):
+        received += 1
+    pipelined = time.perf_counter() - start
+
+    master.send(WATCHER, 'end', {}, public_key, await_response=False)
+    watcher.join()
+
+    click.echo('%i x %s, %i worker(s)' % (count, command, workers))
+    click.echo('round trip latency ms: mean %.3f p50 %.3f p95 %.3f p99 %.3f max %.3f' % (
+        statistics.mean(latencies) * 1000,
+        percentile(latencies, 50) * 1000,
+        percentile(latencies, 95) * 1000,
+        percentile(latencies, 99) * 1000,
+        max(latencies) * 1000))
+    click.echo('sequential: %.1f commands/s' % (count / elapsed))
+    click.echo('pipelined: %.1f commands/s (%i of %i received)' % (
+        received / pipelined, received, count))
+    click.echo('time per round trip:')
+    shares['dispatch'] = elapsed - sum(shares.values())
+    for label in ['json', 'key setup', 'encryption', 'dispatch']:
+        click.echo('  %-10s %8.3f ms %5.1f%%' % (
+            label, shares.get(label, 0) / count * 1000, shares.get(label, 0) / elapsed * 100))
+
+
+if __name__ == '__main__':
+    benchmark()
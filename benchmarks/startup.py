@@ -0,0 +1,74 @@
+"""
+Cold start cost of the sera console script: the import time of sera.cli, the
+heaviest modules it pulls in, and the wall time of a few local invocations
+each in a fresh interpreter.
+
+    python -m benchmarks.startup --repeat 10  # from the repo root
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+INVOCATIONS = [
+    ['--help'],
+    ['create', '--help'],
+    ['-w', 'host', 'echo', '--help'],
+]
+WATCHED_MODULES = ['boto3', 'botocore', 'nacl', 'requests', 'pkg_resources']
+# run the sera of this checkout, whether or not a sera is installed
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENV = dict(os.environ, PYTHONPATH=os.pathsep.join(
+    path for path in [ROOT, os.getenv('PYTHONPATH')] if path))
+
+
+def import_times():
+    """Return {module: cumulative microseconds} from -X importtime for sera.cli"""
+    out = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import sera.cli'],
+        stderr=subprocess.PIPE, universal_newlines=True, check=True, env=ENV).stderr
+    times = {}
+    for line in out.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line.split('|')
+        times[module.strip()] = int(cumulative)
+    return times
+
+
+def wall_time(args, repeat, code='from sera.cli import cli; cli()'):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, '-c', code] + args,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=ENV)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+@click.command()
+@click.option('--repeat', '-n', default=5, help="Runs per invocation")
+@click.option('--top', default=10, help="Slowest imports to list")
+def benchmark(repeat, top):
+    times = import_times()
+    click.echo('import sera.cli: %.1f ms' % (times.get('sera.cli', 0) / 1000))
+    click.echo('slowest imports (cumulative):')
+    for module, usec in sorted(times.items(), key=lambda item: -item[1])[:top]:
+        click.echo('  %-40s %8.1f ms' % (module, usec / 1000))
+    loaded = [module for module in WATCHED_MODULES if module in times]
+    click.echo('heavy modules loaded at startup: %s' % (', '.join(loaded) or 'none'))
+
+    baseline = statistics.median(wall_time([], repeat, code='pass'))
+    click.echo('python startup: %.1f ms' % (baseline * 1000))
+    for args in INVOCATIONS:
+        durations = wall_time(args, repeat)
+        click.echo('sera %-25s median %.1f ms min %.1f ms' % (
+            ' '.join(args), statistics.median(durations) * 1000, min(durations) * 1000))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,259 @@
+"""
+Asyncio client for issuing commands to many watchers from one event loop.
+
+Replies from every watcher arrive on the one master queue, so a single poller
+per Host receives them and hands each to the coroutine awaiting its
+correlation id, or awaiting any reply from that watcher::
+
+    master = await Host.get(public_key_name, create=True)
+    responses = await asyncio.gather(*[
+        master.send(name, 'echo', {'args': ['hello']}, key, timeout=20)
+        for name, key in watchers])
+
+Providers may implement the provider methods as coroutines; blocking
+providers are run on a thread pool.
+"""
+import asyncio
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import logging
+from os import getenv
+from uuid import uuid4
+
+from .sera import (
+    get_client, backoff, is_transient, url_pattern, DEFAULT_TIMEOUT, Host as _Host)
+
+logger = logging.getLogger(__name__)
+
+EXECUTOR = None
+UNCLAIMED_MAX = 1000  # replies kept for a later receive when nobody awaits them
+LEGACY = 'legacy'  # waiter key prefix for replies that have no correlation id
+
+
+def get_executor():
+    global EXECUTOR
+    if not EXECUTOR:
+        EXECUTOR = ThreadPoolExecutor(max_workers=int(getenv('SERA_AIO_THREADS', '32')))
+    return EXECUTOR
+
+
+class AsyncProvider(object):
+    """Coroutine interface over a blocking provider"""
+
+    def __init__(self, provider, executor=None):
+        self.provider = provider
+        self.executor = executor or get_executor()
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.provider)
+
+    @property
+    def name(self):
+        return self.provider.name
+
+    @property
+    def endpoint(self):
+        return self.provider.endpoint
+
+    @endpoint.setter
+    def endpoint(self, endpoint):
+        self.provider.endpoint = endpoint
+
+    def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(
+            self.executor, partial(getattr(self.provider, method), *args, **kwargs))
+
+    async def get_endpoint(self, name):
+        return await self._run('get_endpoint', name)
+
+    async def create_endpoint(self, name):
+        return await self._run('create_endpoint', name)
+
+    async def delete_endpoint(self, url):
+        return await self._run('delete_endpoint', url)
+
+    async def send_message(self, name, msg, attributes={}):
+        return await self._run('send_message', name, msg, attributes)
+
+    async def send_message_batch(self, messages):
+        return await self._run('send_message_batch', list(messages))
+
+    async def receive_message(self, timeout=0):
+        return await self._run('receive_message', timeout)
+
+    def is_transient(self, err):
+        return is_transient(self.provider, err)
+
+
+async def get_async_client(**kwargs):
+    """Return the SERA_CLIENT provider with a coroutine interface"""
+    provider_class = get_client()
+    if asyncio.iscoroutinefunction(getattr(provider_class, 'receive_message', None)):
+        return provider_class(**kwargs)
+    loop = asyncio.get_event_loop()
+    # provider construction may block on credentials and connection setup
+    provider = await loop.run_in_executor(get_executor(), partial(provider_class, **kwargs))
+    return AsyncProvider(provider)
+
+
+class Host(_Host):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # futures awaiting a reply by correlation id, sender name or None for any
+        self.waiters = defaultdict(deque)
+        self.unclaimed = deque(maxlen=UNCLAIMED_MAX)
+        self.poller = None
+
+    @classmethod
+    async def get(cls, name, create=False, namespace=None, **kwargs):
+        client = await get_async_client(namespace=namespace, **kwargs)
+        url = await client.get_endpoint(name)
+        if not url and create:
+            url = await client.create_endpoint(name)
+        if url:
+            return cls(name, url, client, creator=create)
+        return
+
+    async def exchange_keys(self, name, timeout=DEFAULT_TIMEOUT):
+        cmd = 'public_key %s' % getenv('SERA_CLIENT_PUBLIC_KEY', '')
+        remote = await self.send(name, cmd, timeout=timeout)
+        watcher_key = None
+        if remote and remote.name.startswith('public_key'):
+            watcher_key = remote.public_key
+        return watcher_key
+
+    async def send(
+            self,
+            name,
+            cmd='',
+            params='',
+            recipient_key=None,
+            timeout=-1,
+            await_response=True,
+            stdout='',
+            stderr='',
+            returncode=None,
+            correlation_id=None):
+        logger.debug('Host.client.send_message(%s, %s, ...)' % (name, str(cmd)))
+        if await_response:
+            correlation_id = uuid4().hex
+        messages = self._pack(
+            cmd, params, recipient_key, stdout, stderr, returncode,
+            correlation_id=correlation_id)
+        # await the reply before sending so it can't be missed
+        reply = self._expect(name, correlation_id) if await_response else None
+        try:
+            for body, payload in messages:
+                await self.client.send_message(name, body, payload)
+        except Exception:
+            if reply:
+                reply.cancel()
+            raise
+        if reply:
+            return await self._wait(reply, timeout)
+        return
+
+    async def send_batch(self, commands):
+        messages = []
+        for name, cmd, params, recipient_key in commands:
+            logger.debug('Host.client.send_message_batch(%s, %s, ...)' % (name, str(cmd)))
+            messages.extend(
+                (name,) + message for message in self._pack(cmd, params, recipient_key))
+        return await self.client.send_message_batch(messages)
+
+    async def receive(self, timeout=-1, sender=None):
+        """Return the next reply, or the next reply from sender"""
+        return await self._wait(self._expect(sender), timeout)
+
+    def _expect(self, sender=None, correlation_id=None):
+        """
+        Return a future for the next reply to correlation_id, or for the next
+        message from sender (or anyone). A reply without a correlation id, from
+        a watcher that doesn't echo them, completes a future awaiting a
+        correlation id from that sender.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        sender = url_pattern.sub('-', sender) if sender else None
+        if correlation_id:
+            keys = [correlation_id, (LEGACY, sender)]
+        else:
+            keys = [sender]
+        for cmd in self.unclaimed:
+            if any(key in keys for key in self._keys(cmd)):
+                self.unclaimed.remove(cmd)
+                future.set_result(cmd)
+                return future
+        for key in keys:
+            self.waiters[key].append(future)
+        if not self.poller or self.poller.done():
+            self.poller = asyncio.ensure_future(self._poll())
+        return future
+
+    def _keys(self, cmd):
+        """Return the waiter keys a reply may complete, in order"""
+        sender = url_pattern.sub('-', cmd.host)
+        if cmd.correlation_id:
+            return [cmd.correlation_id, sender, None]
+        return [(LEGACY, sender), sender, None]
+
+    async def _wait(self, future, timeout=-1):
+        try:
+            if timeout > -1:
+                return await asyncio.wait_for(future, timeout)
+            return await future
+        except asyncio.TimeoutError:
+            return
+
+    def _awaited(self):
+        for key, waiters in list(self.waiters.items()):
+            while waiters and waiters[0].done():  # timed out or cancelled
+                waiters.popleft()
+            if not waiters:
+                del self.waiters[key]
+        return bool(self.waiters)
+
+    async def _poll(self):
+        """
+        Receive replies for as long as any are awaited, retrying transient
+        errors and failing every awaiting future with any other error
+        """
+        errors = 0
+        while self._awaited():
+            try:
+                msg = await self.client.receive_message(DEFAULT_TIMEOUT)
+                errors = 0
+            except Exception as err:
+                if not is_transient(self.client, err):
+                    for waiters in self.waiters.values():
+                        while waiters:
+                            future = waiters.popleft()
+                            if not future.done():
+                                future.set_exception(err)
+                    return
+                errors += 1
+                delay = backoff(errors)
+                logger.warning('%s receiving on %s, retrying in %.1fs' % (
+                    err.__class__.__name__, self.uid, delay))
+                await asyncio.sleep(delay)
+                continue
+            if msg:
+                msg = self._reassemble(msg)
+            if msg:
+                cmd = self._unpack(msg)
+                if cmd:
+                    self._dispatch(cmd)
+
+    def _dispatch(self, cmd):
+        for key in self._keys(cmd):
+            waiters = self.waiters.get(key)
+            while waiters:
+                future = waiters.popleft()
+                if not future.done():
+                    future.set_result(cmd)
+                    return
+        logger.debug('Unclaimed reply from %s' % cmd.host)
+        self.unclaimed.append(cmd)
@@ -2,7 +2,7 @@ import click
 
 from .main import main
 from ..sera import remote
-from ..utils import get_allowed_clients
+from ..utils import read_allowed_clients, write_allowed_clients
 
 
 @main.command()
@@ -11,23 +11,22 @@ from ..utils import get_allowed_clients
 def add(ctx, client_key):
     """add client public key to known clients"""
     if ctx.obj['local']:
-        clients = get_allowed_clients(ctx.obj['known_clients'])
+        clients = read_allowed_clients(ctx.obj['known_clients'])
         if client_key not in clients:
-            with ctx.obj['known_clients'].open(mode='w+') as file:
-                file.writelines([client_key])
+            write_allowed_clients(ctx.obj['known_clients'], clients + [client_key])
     else:
-        remote('client', ctx)
+        remote('add', ctx)
 
 
 @main.command()
 @click.pass_context
+@click.argument('client_key')
 def revoke(ctx, client_key):
     """remove client public key from known clients"""
     if ctx.obj['local']:
-        clients = get_allowed_clients(ctx.obj['known_clients'])
-        with ctx.obj['known_clients'].open(mode='w') as file:
-            for existing_client_key in clients:
-                if client_key != existing_client_key:
-                    file.writelines([client_key])
+        clients = read_allowed_clients(ctx.obj['known_clients'])
+        if client_key in clients:
+            write_allowed_clients(
+                ctx.obj['known_clients'], [client for client in clients if client != client_key])
     else:
-        remote('revoke', ctx)
\ No newline at end of file
+        remote('revoke', ctx)
@@ -0,0 +1,235 @@
+"""
+A long running agent that keeps the master's provider client, endpoints,
+shared keys and reply polling warm between invocations of sera.
+
+The agent listens on a unix socket (SERA_AGENT_SOCKET or agent.sock in the
+sera configuration directory) for json lines naming a Host method and its
+arguments, and answers with a json line holding the result, preceded by a
+line per output chunk when streaming. Each invocation that finds an agent
+sends its commands through it instead of setting up a master of its own.
+"""
+from collections import OrderedDict
+import json
+import logging
+import os
+from os import getenv
+from pathlib import Path
+import socket
+import threading
+
+import click
+
+from .main import main
+from ..sera import DEFAULT_CLIENT, DEFAULT_TIMEOUT, Host, RemoteCommand
+
+logger = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = 1  # seconds to wait for a running agent to accept
+
+
+def get_socket_path(sera_path):
+    return Path(getenv('SERA_AGENT_SOCKET') or str(sera_path / 'agent.sock'))
+
+
+def get_identity():
+    """Return what an agent and a client must agree on to share a master"""
+    return {
+        'public_key': getenv('SERA_CLIENT_PUBLIC_KEY', ''),
+        'client': getenv('SERA_CLIENT', DEFAULT_CLIENT),
+        'namespace': getenv('SERA_NAMESPACE', 'sera'),
+    }
+
+
+def reply_to_dict(reply):
+    if reply is None:
+        return
+    return dict((key, value) for key, value in vars(reply).items() if key != 'args')
+
+
+def reply_from_dict(data):
+    if data is None:
+        return
+    return RemoteCommand(**data)
+
+
+class AgentError(click.ClickException):
+    pass
+
+
+class AgentMaster(object):
+    """
+    Stands in for the master Host of an invocation, forwarding each call to
+    the agent over one connection.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile('rwb')
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def _call(self, op, *args, callback=None):
+        self.file.write(json.dumps({'op': op, 'args': args}).encode('utf-8') + b'\n')
+        self.file.flush()
+        for line in self.file:
+            response = json.loads(line.decode('utf-8'), object_pairs_hook=OrderedDict)
+            if 'chunk' in response:
+                callback(*response['chunk'])
+            elif 'error' in response:
+                raise AgentError(response['error'])
+            else:
+                return response.get('result')
+        raise AgentError('The sera agent closed the connection')
+
+    def hello(self):
+        return self._call('hello')
+
+    def stop(self):
+        return self._call('stop')
+
+    def list_endpoints(self):
+        return self._call('list_endpoints')
+
+    # timeouts default to those of Host, so a call never waits forever by omission
+    def exchange_keys(self, name, timeout=DEFAULT_TIMEOUT):
+        return self._call('exchange_keys', name, timeout)
+
+    def exchange_keys_all(self, names, timeout=DEFAULT_TIMEOUT):
+        return self._call('exchange_keys_all', list(names), timeout)
+
+    def send(self, name, cmd='', params='', recipient_key=None, timeout=-1):
+        return reply_from_dict(self._call('send', name, cmd, params, recipient_key, timeout))
+
+    def send_stream(self, name, cmd, params, recipient_key, callback, timeout=DEFAULT_TIMEOUT):
+        return reply_from_dict(self._call(
+            'send_stream', name, cmd, params, recipient_key, timeout, callback=callback))
+
+    def send_all(self, targets, cmd, params='', timeout=DEFAULT_TIMEOUT):
+        replies = self._call('send_all', targets, cmd, params, timeout)
+        return OrderedDict((name, reply_from_dict(reply)) for name, reply in replies.items())
+
+
+def connect(sera_path):
+    """Return an AgentMaster if an agent for this master is listening, else None"""
+    path = get_socket_path(sera_path)
+    if not path.exists():
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(CONNECT_TIMEOUT)
+        sock.connect(str(path))
+        sock.settimeout(None)  # replies take as long as the command timeout
+    except OSError as err:
+        logger.debug('No sera agent at %s: %s' % (path, str(err)))
+        sock.close()
+        return
+    agent = AgentMaster(sock)
+    try:
+        identity = agent.hello()
+    except (OSError, ValueError, AgentError) as err:
+        logger.debug('Sera agent at %s did not answer: %s' % (path, str(err)))
+        agent.close()
+        return
+    if identity != get_identity():
+        logger.debug('Sera agent at %s serves a different master' % path)
+        agent.close()
+        return
+    return agent
+
+
+def handle(server, master, request, write):
+    """Call the Host method a request names and return a json friendly result"""
+    op, args = request.get('op'), request.get('args', [])
+    if op == 'hello':
+        return server.identity
+    elif op == 'stop':
+        # shutdown waits for serve_forever, which waits for this handler
+        threading.Thread(target=server.shutdown, daemon=True).start()
+        return
+    elif op == 'list_endpoints':
+        return master.list_endpoints()
+    elif op == 'exchange_keys':
+        return master.exchange_keys(*args)
+    elif op == 'exchange_keys_all':
+        return master.exchange_keys_all(*args)
+    elif op == 'send':
+        return reply_to_dict(master.send(*args))
+    elif op == 'send_stream':
+        name, cmd, params, recipient_key, timeout = args
+
+        def callback(stdout, stderr):
+            write({'chunk': [stdout, stderr]})
+        return reply_to_dict(master.send_stream(
+            name, cmd, params, recipient_key, callback, timeout))
+    elif op == 'send_all':
+        targets, cmd, params, timeout = args
+        replies = master.send_all(OrderedDict(targets), cmd, params, timeout)
+        return OrderedDict((name, reply_to_dict(reply)) for name, reply in replies.items())
+    raise ValueError('Unknown agent operation %s' % op)
+
+
+def serve(path, master):
+    """Return a unix socket server answering requests with the master Host"""
+    import socketserver
+
+    class AgentHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            def write(response):
+                self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+                self.wfile.flush()
+
+            for line in self.rfile:
+                try:
+                    request = json.loads(line.decode('utf-8'), object_pairs_hook=OrderedDict)
+                    write({'result': handle(self.server, master, request, write)})
+                except Exception as err:
+                    logger.exception('Sera agent request failed')
+                    write({'error': str(err)})
+
+    class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    umask = os.umask(0o177)  # only the owner may connect
+    try:
+        server = AgentServer(str(path), AgentHandler)
+    finally:
+        os.umask(umask)
+    server.identity = get_identity()
+    return server
+
+
+@main.command()
+@click.pass_context
+@click.option('--stop', is_flag=True, help="Stop the running agent")
+def agent(ctx, stop):
+    """Keep the master connection warm for other invocations"""
+    verbosity = ctx.obj['verbosity']
+    path = get_socket_path(ctx.obj['sera_path'])
+    running = connect(ctx.obj['sera_path'])
+    if stop:
+        if not running:
+            raise click.ClickException('No sera agent is running at %s' % path)
+        running.stop()
+        running.close()
+        if verbosity:
+            click.echo('Stopped the agent at %s' % path)
+        return
+    if running:
+        running.close()
+        raise click.ClickException('A sera agent is already running at %s' % path)
+    if path.exists():  # left behind by an agent that didn't exit cleanly
+        path.unlink()
+    # use the masters public key as its name
+    master = Host.get(getenv('SERA_CLIENT_PUBLIC_KEY').replace('=', ''), create=True)
+    server = serve(path, master)
+    click.echo('Agent listening on %s' % path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if path.exists():
+            path.unlink()
@@ -1,5 +1,4 @@
 import click
-import requests
 
 from .main import main, lprint
 
@@ -16,12 +15,13 @@ def disallow(ctx, delay, from_ip):
     """Delete allowed connection from ip address"""
 
     if not from_ip:
+        import requests
         ctx.params['from_ip'] = from_ip = requests.get(
             'http://ipinfo.io').json().get('ip')
     if ctx.obj['local']:
         ufw_rule = '"delete allow from %s"' % from_ip
         args = ['printf', ufw_rule, '|', 'at', 'now', '+', str(delay), 'minutes']
-        out = run('ufw', args)
+        out = run('ufw', args, stream=ctx.obj.get('stream'))
     else:
         out = remote('disallow', ctx)
     return lprint(ctx, out)
@@ -35,11 +35,12 @@ def allow(ctx, delay, from_ip):
     """Open firewall connection from ip address"""
 
     if not from_ip:
+        import requests
         ctx.params['from_ip'] = from_ip = requests.get(
             'http://ipinfo.io').json().get('ip')
     args = ['allow', 'from', from_ip]
     if ctx.obj['local']:
-        out = run('ufw', args)
+        out = run('ufw', args, stream=ctx.obj.get('stream'))
         if not out.returncode:
             ip_addr = get_ip_address(from_ip)
             out.subcommand = disallow
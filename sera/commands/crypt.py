@@ -1,5 +1,16 @@
+"""
+Files are encrypted to a streaming .nacl format: a header of MAGIC, a version
+byte, the chunk size and a random nonce prefix, followed by the file in fixed
+size chunks each sealed with SecretBox. A chunk's nonce is the prefix and its
+counter, with the high bit set on the final chunk so truncation is detected.
+Older .nacl files holding a single base64 encoded SecretBox still decrypt.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from hashlib import sha256
+import os
 from pathlib import Path
+import struct
 
 import click
 from nacl.exceptions import CryptoError
@@ -10,37 +21,133 @@ from nacl.encoding import Base64Encoder
 from .main import main, lprint
 from ..sera import remote
 
+MAGIC = b'SERA'
+VERSION = 1
+CHUNK_SIZE = 64 * 1024
+COUNTER = struct.Struct('>Q')
+PREFIX_SIZE = SecretBox.NONCE_SIZE - COUNTER.size
+HEADER = struct.Struct('>4sBI%is' % PREFIX_SIZE)  # magic, version, chunk size, nonce prefix
+FINAL = 1 << 63
+TMP_SUFFIX = '.sera-tmp'
 
-def apply_crypto(password, recursive, root, pattern, command='encrypt'):
-    box = SecretBox(sha256(password).digest())
+
+def chunk_nonce(prefix, counter, final=False):
+    return prefix + COUNTER.pack(counter | FINAL if final else counter)
+
+
+def encrypt_stream(box, infile, outfile, chunk_size=None):
+    chunk_size = chunk_size or CHUNK_SIZE
+    prefix = random(PREFIX_SIZE)
+    outfile.write(HEADER.pack(MAGIC, VERSION, chunk_size, prefix))
+    counter = 0
+    chunk = infile.read(chunk_size)
+    while True:
+        next_chunk = infile.read(chunk_size)  # read ahead to find the final chunk
+        nonce = chunk_nonce(prefix, counter, final=not next_chunk)
+        outfile.write(box.encrypt(chunk, nonce).ciphertext)
+        if not next_chunk:
+            break
+        chunk = next_chunk
+        counter += 1
+
+
+def decrypt_stream(box, infile, outfile):
+    header = infile.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise CryptoError('Truncated .nacl header')
+    magic, version, chunk_size, prefix = HEADER.unpack(header)
+    if version != VERSION:
+        raise CryptoError('Unsupported .nacl version %i' % version)
+    sealed_size = chunk_size + SecretBox.MACBYTES
+    counter = 0
+    chunk = infile.read(sealed_size)
+    while True:
+        if len(chunk) < SecretBox.MACBYTES:
+            raise CryptoError('Truncated .nacl chunk')
+        next_chunk = infile.read(sealed_size)
+        outfile.write(box.decrypt(chunk, chunk_nonce(prefix, counter, final=not next_chunk)))
+        if not next_chunk:
+            break
+        chunk = next_chunk
+        counter += 1
+
+
+def is_stream(file):
+    with file.open('rb') as infile:
+        return infile.read(len(MAGIC) + 1) == MAGIC + bytes([VERSION])
+
+
+def crypt_file(key, file, command='encrypt'):
+    """Encrypt or decrypt a file with a SecretBox key, returning any error"""
+    box = SecretBox(key)
+    if command == 'encrypt':
+        outfile = file.name + '.nacl'
+    else:
+        outfile = file.name[:-5]
+    parent = file.parent
+    outfile_path = parent / outfile
+    # write alongside and rename so a failure never leaves a partial file
+    tmp_path = parent / ('.%s%s' % (outfile, TMP_SUFFIX))
+    try:
+        if command == 'encrypt':
+            with file.open('rb') as infile, tmp_path.open('wb') as out:
+                encrypt_stream(box, infile, out)
+        elif is_stream(file):
+            with file.open('rb') as infile, tmp_path.open('wb') as out:
+                decrypt_stream(box, infile, out)
+        else:  # base64 encoded single SecretBox
+            tmp_path.write_bytes(box.decrypt(file.read_bytes(), encoder=Base64Encoder))
+        os.replace(str(tmp_path), str(outfile_path))
+    except (CryptoError, OSError) as err:  # e.g. unreadable files or a full disk
+        return str(err)
+    finally:
+        try:
+            tmp_path.unlink()
+        except FileNotFoundError:  # renamed into place, or never created
+            pass
+
+
+def crypt_files(key, files, command='encrypt', jobs=1):
+    """Yield (file, error) as files are processed, with jobs processes in parallel"""
+    if jobs < 2:
+        for file in files:
+            yield file, crypt_file(key, file, command)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = deque()
+        for file in files:
+            pending.append((file, pool.submit(crypt_file, key, file, command)))
+            if len(pending) >= jobs * 2:  # keep the walk just ahead of the workers
+                file, future = pending.popleft()
+                yield file, future.result()
+        while pending:
+            file, future = pending.popleft()
+            yield file, future.result()
+
+
+def apply_crypto(password, recursive, root, pattern, command='encrypt', jobs=1):
+    key = sha256(password).digest()
 
     if recursive:
         files = Path(root).rglob(pattern)
     else:
         files = Path(root).glob(pattern)
-    files = [file for file in files if file.is_file()]
+    # the walk is lazy so skip any files written along the way
+    files = (
+        file for file in files
+        if file.is_file() and file.suffix != TMP_SUFFIX and not (
+            command == 'encrypt' and file.suffix == '.nacl'))
     error = None
     err_count = 0
-    total_count = len(files)
-    for file in files:
-        content = file.read_bytes()
-        try:
-            if command == 'encrypt':
-                nonce = random(SecretBox.NONCE_SIZE)
-                output = box.encrypt(content, nonce, Base64Encoder)
-                outfile = file.name + '.nacl'
-            else:
-                outfile = file.name[:-5]
-                output = box.decrypt(content, encoder=Base64Encoder)
-            click.echo(str(file))
-        except CryptoError as err:
-            error = str(err)
+    total_count = 0
+    for file, file_error in crypt_files(key, files, command, jobs):
+        total_count += 1
+        if file_error:
+            error = file_error
             err_count += 1
             click.echo('Failed to %s %s' % (command, str(file)))
-            continue
-        parent = file.parent
-        outfile_path = parent / outfile
-        outfile_path.write_bytes(output)
+        else:
+            click.echo(str(file))
     if error:
         if err_count == total_count:
             msg = 'Error'
@@ -55,13 +162,15 @@ def apply_crypto(password, recursive, root, pattern, command='encrypt'):
 @click.pass_context
 @click.option('--recursive', '-R', is_flag=True)
 @click.option('--password', '-p')
+@click.option(
+    '--jobs', '-j', type=click.IntRange(1), default=1, help="Files to encrypt in parallel")
 @click.argument("root")
 @click.argument("pattern")
-def encrypt(ctx, recursive, password, root, pattern):
+def encrypt(ctx, recursive, password, jobs, root, pattern):
     """Encrypt files on path matching glob pattern"""
     password = password or click.prompt("Enter password", hide_input=True).strip().encode()
     if ctx.obj['local']:
-        apply_crypto(password, recursive, root, pattern)
+        apply_crypto(password, recursive, root, pattern, jobs=jobs)
     else:
         out = remote('encrypt', ctx)
         return lprint(ctx, out)
@@ -71,12 +180,14 @@ def encrypt(ctx, recursive, password, root, pattern):
 @click.pass_context
 @click.option('--recursive', '-R', is_flag=True)
 @click.option('--password', '-p')
+@click.option(
+    '--jobs', '-j', type=click.IntRange(1), default=1, help="Files to decrypt in parallel")
 @click.argument("root")
-def decrypt(ctx, recursive, password, root):
+def decrypt(ctx, recursive, password, jobs, root):
     """Decrypt .nacl files on a path and overwrite existing"""
     password = password or click.prompt("Enter password", hide_input=True).strip().encode()
     if ctx.obj['local']:
-        apply_crypto(password, recursive, root, pattern='*.nacl', command='decrypt')
+        apply_crypto(password, recursive, root, pattern='*.nacl', command='decrypt', jobs=jobs)
     else:
         out = remote('decrypt', ctx)
         return lprint(ctx, out)
@@ -12,7 +12,7 @@ from ..sera import run, remote
 def echo(ctx, args):
     """Test connection with watcher"""
     if ctx.obj['local']:
-        out = run('echo', args)
+        out = run('echo', args, stream=ctx.obj.get('stream'))
     else:
         out = remote('echo', ctx)
 
@@ -1,16 +1,115 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
+import importlib
 from os import getenv
 from sys import argv
 
 import click
+from click.utils import make_default_short_help
 
-from ..sera import Host
+from ..sera import BaseEndpoint, Host
 from ..settings import DEFAULT_TIMEOUT
 from ..utils import (
-    get_default_watcher,
-    get_watcher_key, set_env_key,
+    get_default_watcher, get_entry_points,
+    is_target_pattern, resolve_targets, set_owner,
     configure_path, loadenv, configure_logging)
 
+# modules that register each subcommand on main when imported
+SUBCOMMAND_MODULES = {
+    'add': 'sera.commands.addrevoke',
+    'agent': 'sera.commands.agent',
+    'allow': 'sera.commands.allow',
+    'create': 'sera.commands.create',
+    'decrypt': 'sera.commands.crypt',
+    'disallow': 'sera.commands.allow',
+    'echo': 'sera.commands.echo',
+    'encrypt': 'sera.commands.crypt',
+    'end': 'sera.commands.end',
+    'export': 'sera.commands.export',
+    'install': 'sera.commands.install',
+    'revoke': 'sera.commands.addrevoke',
+    'symlink': 'sera.commands.symlink',
+    'watch': 'sera.commands.watch',
+    'watchers': 'sera.commands.watchers',
+}
+
+# short help for `sera --help`, so listing commands doesn't import their modules
+SUBCOMMAND_HELP = {
+    'add': 'add client public key to known clients',
+    'agent': 'Keep the master connection warm for other invocations',
+    'allow': 'Open firewall connection from ip address',
+    'create': 'Create and update access, keypair, signature',
+    'decrypt': 'Decrypt .nacl files on a path and overwrite existing',
+    'disallow': 'Delete allowed connection from ip address',
+    'echo': 'Test connection with watcher',
+    'encrypt': 'Encrypt files on path matching glob pattern',
+    'end': 'Exits the program.',
+    'export': 'export VARIABLE=VALUE to env',
+    'install': 'Install a configuration or service',
+    'revoke': 'remove client public key from known clients',
+    'symlink': 'Locally install a symlink to sera',
+    'watch': 'Receive remote commands',
+    'watchers': 'List, import or export known watcher public keys',
+}
+
+
+class LazyGroup(click.Group):
+    """
+    A group that imports a subcommand's module only when the subcommand is
+    used. Plugin commands from 'sera.subcommand' entry points and plugin
+    groups from 'sera.collection' entry points are looked up last.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.subcommand_modules = kwargs.pop('subcommand_modules', {})
+        self.subcommand_help = kwargs.pop('subcommand_help', {})
+        super().__init__(*args, **kwargs)
+        self.plugins = None
+        self.sources = []
+
+    def get_plugins(self):
+        if self.plugins is None:
+            self.plugins = {}
+            for ep in get_entry_points('sera.subcommand'):
+                self.plugins[ep.name] = ep
+            self.sources = [ep.load() for ep in get_entry_points('sera.collection')]
+        return self.plugins
+
+    def list_commands(self, ctx):
+        names = set(super().list_commands(ctx)) | set(self.subcommand_modules)
+        names |= set(self.get_plugins())
+        for source in self.sources:
+            names |= set(source.list_commands(ctx))
+        return sorted(names)
+
+    def get_command(self, ctx, name):
+        if name not in self.commands and name in self.subcommand_modules:
+            importlib.import_module(self.subcommand_modules[name])
+        command = super().get_command(ctx, name)
+        if command is None and name in self.get_plugins():
+            command = self.plugins[name].load()
+        for source in [] if command else self.sources:
+            command = source.get_command(ctx, name)
+            if command:
+                break
+        return command
+
+    def format_commands(self, ctx, formatter):
+        """Like click's, but takes the help of unloaded subcommands from subcommand_help"""
+        names = self.list_commands(ctx)
+        limit = formatter.width - 6 - max([len(name) for name in names] or [0])
+        rows = []
+        for name in names:
+            if name in self.subcommand_help and name not in self.commands:
+                rows.append((name, make_default_short_help(self.subcommand_help[name], limit)))
+                continue
+            command = self.get_command(ctx, name)
+            if command is not None and not command.hidden:
+                rows.append((name, command.get_short_help_str(limit)))
+        if rows:
+            with formatter.section('Commands'):
+                formatter.write_dl(rows)
+
 
 def get_default_timeout():
     if len(argv) > 1 and 'watch' in argv[1:]:
@@ -19,6 +118,14 @@ def get_default_timeout():
         return int(getenv('SERA_TIMEOUT', DEFAULT_TIMEOUT))
 
 
+def echo_chunk(stdout, stderr):
+    """ echo streamed output as it arrives """
+    if stdout:
+        click.echo(stdout, nl=False)
+    if stderr:
+        click.echo(stderr, nl=False, err=True)
+
+
 def lprint(ctx, out):
     """ echo output of stdout and stderr if it's not a watch invoked command """
     if out.stdout:
@@ -28,13 +135,15 @@ def lprint(ctx, out):
     return out
 
 
-@click.group()
+@click.group(cls=LazyGroup, subcommand_modules=SUBCOMMAND_MODULES,
+             subcommand_help=SUBCOMMAND_HELP)
 @click.option('--timeout', '-t', type=int, default=get_default_timeout)
 @click.option('--debug', '-d', is_flag=True)
 @click.option('--verbosity', '-v', type=int, default=1)
 @click.option('--watcher', '-w', default=get_default_watcher)
+@click.option('--stream', '-s', is_flag=True, help="Print output while the command runs")
 @click.pass_context
-def main(ctx, timeout, debug, verbosity, watcher):
+def main(ctx, timeout, debug, verbosity, watcher, stream):
     """
     With OPTIONS send COMMAND with ARGS to target WATCHER
 
@@ -55,9 +164,11 @@ def main(ctx, timeout, debug, verbosity, watcher):
         'local': local,
         'timeout': timeout,
         'verbosity': verbosity,
+        'sera_path': sera_path,
         'known_clients': sera_path / 'known_clients',
         'known_watchers': sera_path / 'known_watchers',
-        'env_path': env_path}
+        'env_path': env_path,
+        'stream': echo_chunk if stream and not local else None}
     if not env_path_exists and ctx.invoked_subcommand != 'keygen':
         if verbosity:
             click.echo('No env file. Using provider credentials (if defined)')
@@ -72,27 +183,83 @@ def main(ctx, timeout, debug, verbosity, watcher):
     namespace = getenv('SERA_NAMESPACE', 'sera')
     if verbosity > 1 and namespace != 'sera':
         click.echo('Using namespace "%s"' % namespace)
-    if ctx.invoked_subcommand in ['create', 'install', 'watch'] or local:
+    if ctx.invoked_subcommand in ['agent', 'create', 'install', 'watch', 'watchers'] or local:
         return
 
+    ctx.obj['watcher_keys'] = get_watcher_keys(sera_path)
+
     # master related logic
     if not watcher:
         watcher = getenv('SERA_DEFAULT_WATCHER', '')
-    watcher = Host.get(watcher, create=True)
-
-    # use the masters public key as its name
-    master = Host.get(getenv('SERA_CLIENT_PUBLIC_KEY').replace('=', ''), create=True)
+    # a running `sera agent` keeps the master host warm between invocations
+    agent = None
+    if getenv('SERA_AGENT', '1') != '0':
+        from .agent import connect
+        agent = connect(sera_path)
+    if agent:
+        master = agent
+    else:
+        # use the masters public key as its name
+        master = Host.get(getenv('SERA_CLIENT_PUBLIC_KEY').replace('=', ''), create=True)
     ctx.obj['master'] = master
+    if is_target_pattern(watcher):
+        return target_watchers(ctx, watcher)
+    if agent:  # the agent creates the watcher queue when it first sends to it
+        watcher = BaseEndpoint(watcher)
+    else:
+        watcher = Host.get(watcher, create=True)
     ctx.obj['watcher'] = watcher
-    watcher_key = get_watcher_key(ctx.obj['known_watchers'], watcher.name)
+    watcher_key = ctx.obj['watcher_keys'].get(watcher.name)
     if not watcher_key:
         if verbosity:
             click.echo('Exchanging public keys with %s' % watcher.uid)
-        watcher_key = master.exchange_keys(watcher.name)
+        watcher_key = master.exchange_keys(watcher.name, ctx.obj['timeout'])
         if watcher_key:
-            set_env_key(ctx.obj['known_watchers'], watcher.name, watcher_key)
+            ctx.obj['watcher_keys'][watcher.name] = watcher_key
         else:
             raise click.ClickException(
                 'No public key received from %s' % watcher.uid)
     ctx.obj['watcher_key'] = watcher_key
 
+
+def get_watcher_keys(sera_path):
+    """Return the KeyStore of known watcher keys, imported from known_watchers when new"""
+    from ..keystore import KeyStore
+
+    path = sera_path / 'known_watchers.db'
+    new = not path.exists()
+    store = KeyStore.open(path, sera_path / 'known_watchers')
+    if new:
+        set_owner(path)
+    return store
+
+
+def target_watchers(ctx, target):
+    """
+    Resolve a glob or @group target against the known watchers, the groups
+    file and the existing endpoints, and exchange keys with new watchers in
+    one round trip, so remote commands fan out to every matched watcher.
+    """
+    verbosity = ctx.obj['verbosity']
+    master = ctx.obj['master']
+    known = OrderedDict(ctx.obj['watcher_keys'].items())
+    names = resolve_targets(
+        target, known, master.list_endpoints(), ctx.obj['sera_path'] / 'groups')
+    if not names:
+        raise click.ClickException('No watchers match %s' % target)
+    unknown = [name for name in names if not known.get(name)]
+    if unknown:
+        if verbosity:
+            click.echo('Exchanging public keys with %i watcher(s)' % len(unknown))
+        received = master.exchange_keys_all(unknown, ctx.obj['timeout'])
+        ctx.obj['watcher_keys'].update(received)
+        known.update(received)
+    missing = [name for name in names if not known.get(name)]
+    if len(missing) == len(names):
+        raise click.ClickException('No public key received from %s' % ', '.join(missing))
+    if missing and verbosity:
+        click.echo('No public key received from %s' % ', '.join(missing))
+    ctx.obj['watchers'] = OrderedDict(
+        (name, known[name]) for name in names if known.get(name))
+    if verbosity > 1:
+        click.echo('Targeting %s' % ', '.join(ctx.obj['watchers']))
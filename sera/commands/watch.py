@@ -1,3 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+import logging
+import sys
+import threading
 import time
 from os import getenv
 from socket import gethostname
@@ -5,36 +10,124 @@ from socket import gethostname
 import click
 
 from .main import main
-from ..sera import Host
-from ..utils import get_allowed_clients
+from .. import metrics
+from ..sera import Host, DEFAULT_TIMEOUT
+from ..utils import AllowedClients
+
+logger = logging.getLogger(__name__)
+
+
+def execute(ctx, host, cmd):
+    """
+    Invoke a command and any chained subcommands, sending each result to the
+    client with the command's correlation id. If the client asked to stream,
+    output of the first command is sent in numbered chunks while it runs,
+    followed by its result.
+    """
+    subcommand = main.get_command(ctx, cmd.name)
+    params = cmd.params
+    obj = dict(ctx.obj, stream=None)
+    sequence = count()
+    if cmd.stream:
+        def stream(stdout, stderr):
+            host.send(
+                cmd.host,
+                cmd.name,
+                params=cmd.params,
+                stdout=stdout,
+                stderr=stderr,
+                recipient_key=cmd.public_key,
+                seq=next(sequence),
+                correlation_id=cmd.correlation_id,
+                await_response=False)
+        obj['stream'] = stream
+    # each command gets its own obj so concurrent workers don't share a stream
+    cmd_ctx = click.Context(ctx.command, parent=ctx, info_name=ctx.info_name, obj=obj)
+    while subcommand:  # can chain commands
+        start = time.perf_counter()
+        try:
+            out = cmd_ctx.invoke(subcommand, **params)
+        except Exception:
+            metrics.inc('sera_errors_total', stage='command')
+            raise
+        metrics.observe(
+            'sera_command_seconds', time.perf_counter() - start, command=subcommand.name)
+        host.send(
+            cmd.host,
+            cmd.name,
+            params=cmd.params,
+            stdout=out.stdout,
+            stderr=out.stderr,
+            returncode=out.returncode,
+            recipient_key=cmd.public_key,
+            seq=next(sequence) if obj['stream'] else None,
+            correlation_id=cmd.correlation_id,
+            await_response=False)
+        obj['stream'] = None
+        subcommand = getattr(out, 'subcommand', None)
+        params = getattr(out, 'params', None)
 
 
 @main.command()
 @click.pass_context
 @click.option('--client', '-c', help="Allowed client public key")
-def watch(ctx, client):
+@click.option(
+    '--batch', '-b', type=click.IntRange(1, 10),
+    help="Receive up to BATCH commands per request and buffer the extras")
+@click.option(
+    '--workers', '-n', type=click.IntRange(1), default=1,
+    help="Execute up to WORKERS commands concurrently while polling")
+@click.option(
+    '--metrics', 'metrics_address',
+    help="Export metrics at a local PORT, unix:PATH or file:PATH")
+def watch(ctx, client, batch, workers, metrics_address):
     """Receive remote commands"""
     verbosity = ctx.obj.get('verbosity')
     ctx.obj['host'] = name = ctx.parent.params['watcher'] or gethostname()
-    allowed_clients = get_allowed_clients(ctx.obj['known_clients'], client)
+    # added and revoked keys are picked up while watching
+    allowed_clients = AllowedClients(ctx.obj['known_clients'], client)
     timeout = ctx.obj['timeout']
     ctx.obj['local'] = True
     click.echo('Watching %s' % name)
+    if metrics_address:
+        click.echo('Exporting metrics at %s' % metrics.export(metrics_address))
 
     # wait for the host queue to be created by the client
     host = None
+    # remember received message ids across restarts to not repeat redelivered commands
+    options = {'dedup_path': ctx.obj['sera_path'] / 'received.db'}
+    if batch:
+        options['MaxNumberOfMessages'] = batch
     delay = 0
     max_delay = int(getenv('SERA_MAX_DELAY', '20'))
     while not host:
-        host = Host.get(name)
+        host = Host.get(name, **options)
         time.sleep(delay)
         if delay < max_delay:
             delay += 1
 
+    # drop commands from clients that aren't allowed before decrypting them
+    host.allowed_clients = allowed_clients
+
+    # with workers, commands run on a pool while the queue keeps being polled
+    pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    slots = threading.BoundedSemaphore(workers)
+    stopped = threading.Event()
+    # return from receive periodically to notice an end command run by a worker
+    poll_timeout = DEFAULT_TIMEOUT if pool and timeout < 0 else timeout
+
+    def done(future):
+        slots.release()
+        err = future.exception()
+        if isinstance(err, SystemExit):  # the end command
+            stopped.set()
+        elif err:
+            logger.error('Command failed: %s' % str(err))
+
     # host queue created - await a command
     start = time.time()
-    while True:
-        cmd = host.receive(timeout=timeout)
+    while not stopped.is_set():
+        cmd = host.receive(timeout=poll_timeout)
         if cmd and cmd.public_key not in allowed_clients:
             if verbosity:
                 click.echo("Client public key '%s' not allowed" %
@@ -44,26 +137,21 @@ def watch(ctx, client):
             if verbosity:
                 click.echo('Sending public key to %s' % cmd.host)
             host.send(cmd.host, 'public_key %s' % getenv(
-                'SERA_CLIENT_PUBLIC_KEY'), await_response=False)
+                'SERA_CLIENT_PUBLIC_KEY'), correlation_id=cmd.correlation_id,
+                await_response=False)
         elif cmd and cmd.public_key in allowed_clients and cmd.name:
             if verbosity:
                 click.echo('Received cmd %s' % str(cmd.name))
-            subcommand = main.get_command(ctx, cmd.name)
-            params = cmd.params
-            while subcommand:  # can chain commands
-                out = ctx.invoke(subcommand, **params)
-                host.send(
-                    cmd.host,
-                    cmd.name,
-                    params=cmd.params,
-                    stdout=out.stdout,
-                    stderr=out.stderr,
-                    returncode=out.returncode,
-                    recipient_key=cmd.public_key,
-                    await_response=False)
-                subcommand = getattr(out, 'subcommand', None)
-                params = getattr(out, 'params', None)
+            if pool:
+                slots.acquire()  # bound the commands in flight
+                pool.submit(execute, ctx, host, cmd).add_done_callback(done)
+            else:
+                execute(ctx, host, cmd)
 
         duration = time.time() - start
         if timeout > -1 and duration > timeout:
-            return
+            break
+    if pool:
+        pool.shutdown()
+    if stopped.is_set():
+        sys.exit()
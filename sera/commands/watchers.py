@@ -0,0 +1,27 @@
+import click
+
+from .main import main, get_watcher_keys
+
+
+@main.command()
+@click.pass_context
+@click.option(
+    '--import', 'import_path', type=click.Path(exists=True, dir_okay=False),
+    help="Add the keys of a name=key dotenv file")
+@click.option(
+    '--export', 'export_path', type=click.Path(dir_okay=False),
+    help="Write every key to a name=key dotenv file")
+def watchers(ctx, import_path, export_path):
+    """List, import or export known watcher public keys"""
+    keys = get_watcher_keys(ctx.obj['sera_path'])
+    if import_path:
+        count = keys.import_dotenv(import_path)
+        if ctx.obj['verbosity']:
+            click.echo('Imported %i watcher key(s) from %s' % (count, import_path))
+    if export_path:
+        count = keys.export_dotenv(export_path)
+        if ctx.obj['verbosity']:
+            click.echo('Exported %i watcher key(s) to %s' % (count, export_path))
+    if not import_path and not export_path:
+        for name, key in keys.items():
+            click.echo('%s %s' % (name, key))
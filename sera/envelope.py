@@ -0,0 +1,83 @@
+"""
+Versioned binary message envelope, sent in the Envelope message attribute.
+
+    magic b'SE' | version | flags | codec | sender public key (32 bytes) |
+    correlation id (16 bytes, zeros for none) |
+    [fragment id (16 bytes) | fragment index | fragment count] |
+    payload
+
+The fragment fields are only present with the FRAGMENT flag. The payload is
+a NaCl box of the JSON command with the ENCRYPTED flag, otherwise the plain
+command text. Header fields are read in place from the received bytes and the
+payload is returned as a memoryview of them.
+"""
+from collections import namedtuple
+import struct
+
+MAGIC = b'SE'
+VERSION = 1
+HEADER = struct.Struct('>2sBBB32s16s')
+FRAGMENT = struct.Struct('>16sHH')
+
+ENCRYPTED = 1
+FRAGMENTED = 2
+
+CODEC_NAMES = ['', 'zlib']  # by codec id
+NO_ID = bytes(16)
+
+Envelope = namedtuple('Envelope', [
+    'version', 'flags', 'codec', 'sender_key', 'correlation_id',
+    'fragment_id', 'fragment_index', 'fragment_count', 'payload'])
+
+
+def pack(
+        payload, sender_key, codec='', correlation_id=None, encrypted=True,
+        fragment=None):
+    """
+    Return envelope bytes for a payload from a raw 32 byte sender key, with an
+    optional 16 byte correlation id and (fragment id, index, count)
+    """
+    flags = ENCRYPTED if encrypted else 0
+    if fragment:
+        flags |= FRAGMENTED
+    header = HEADER.pack(
+        MAGIC, VERSION, flags, CODEC_NAMES.index(codec), sender_key, correlation_id or NO_ID)
+    if fragment:
+        header += FRAGMENT.pack(*fragment)
+    return header + payload
+
+
+def is_envelope(data):
+    return len(data) >= HEADER.size and data[:2] == MAGIC
+
+
+def is_fragment(data):
+    return is_envelope(data) and bool(data[3] & FRAGMENTED)
+
+
+def sender_key(data):
+    """Return the raw sender key of envelope bytes without reading the payload"""
+    if not is_envelope(data):
+        raise ValueError('Not a sera envelope')
+    return HEADER.unpack_from(data)[4]
+
+
+def unpack(data):
+    """Return an Envelope from envelope bytes, raising ValueError if malformed"""
+    if not is_envelope(data):
+        raise ValueError('Not a sera envelope')
+    magic, version, flags, codec, sender_key, correlation_id = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError('Unsupported envelope version %i' % version)
+    if codec >= len(CODEC_NAMES):
+        raise ValueError('Unknown codec %i' % codec)
+    offset = HEADER.size
+    fragment_id, fragment_index, fragment_count = None, 0, 1
+    if flags & FRAGMENTED:
+        fragment_id, fragment_index, fragment_count = FRAGMENT.unpack_from(data, offset)
+        offset += FRAGMENT.size
+    return Envelope(
+        version, flags, CODEC_NAMES[codec], sender_key,
+        None if correlation_id == NO_ID else correlation_id,
+        fragment_id, fragment_index, fragment_count,
+        memoryview(data)[offset:])
@@ -1,87 +1,160 @@
 """
-Modified version of https://github.com/mailgun/expiringdict with max_len removed
-which works around http://bugs.python.org/issue27275.
+Dictionary with auto-expiring values for caching purposes, originally based on
+https://github.com/mailgun/expiringdict
 
-Included primarily pypi version of expiringdict is not python3 compatible
-
-Dictionary with auto-expiring values for caching purposes.
-Expiration happens on any access, object is locked during cleanup from expired
-values.
->>> ExpiringDict(max_age_seconds=10)
+Entries are kept in expiry order so expired entries are evicted from the front
+in O(1) amortized time whenever the dict is written or sized, and optionally
+by a background sweep. With max_len the least recently used entry is evicted
+to make room.
+>>> cache = ExpiringDict(max_age_seconds=10, max_len=1000, sweep_interval=60)
 The values stored in the following way:
 {
     key1: (value1, created_time1),
     key2: (value2, created_time2)
 }
-NOTE: iteration over dict and also keys() do not remove expired values!
+hits, misses and evictions count lookups and evicted entries, and like the
+entries are only changed with the lock held.
 
 """
 
 import time
+import weakref
 from collections import OrderedDict
-from threading import RLock
+from collections.abc import MutableMapping
+from threading import Lock, Thread
+
+
+def sweep(ref, interval):
+    """Periodically expire entries until the dict is garbage collected"""
+    while True:
+        time.sleep(interval)
+        expiring_dict = ref()
+        if expiring_dict is None:
+            return
+        expiring_dict.expire()
+        del expiring_dict
 
 
-class ExpiringDict(OrderedDict):
-    def __init__(self, max_age_seconds):
+class ExpiringDict(MutableMapping):
+    def __init__(self, max_age_seconds, max_len=None, sweep_interval=None):
         assert max_age_seconds >= 0
+        assert max_len is None or max_len >= 1
 
-        OrderedDict.__init__(self)
         self.max_age = max_age_seconds
-        self.lock = RLock()
+        self.max_len = max_len
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()  # least recently used first
+        self._created = OrderedDict()  # oldest first
+        if sweep_interval:
+            Thread(target=sweep, args=(weakref.ref(self), sweep_interval), daemon=True).start()
+
+    def _expire(self, now):
+        """ Evict expired entries from the front. Call with the lock held. """
+        created = self._created
+        while created:
+            key, created_time = next(iter(created.items()))
+            if now - created_time < self.max_age:
+                break
+            del created[key]
+            del self._items[key]
+            self.evictions += 1
+
+    def _evict(self, key):
+        """ Evict an entry if it's still there. Call with the lock held. """
+        if self._items.pop(key, None):
+            del self._created[key]
+            self.evictions += 1
+
+    def expire(self):
+        """ Evict all expired entries. """
+        with self.lock:
+            self._expire(time.monotonic())
 
     def __contains__(self, key):
         """ Return True if the dict has a key, else return False. """
         try:
-            with self.lock:
-                item = OrderedDict.__getitem__(self, key)
-                if time.time() - item[1] < self.max_age:
-                    return True
-                else:
-                    del self[key]
+            self[key]
         except KeyError:
-            pass
-        return False
+            return False
+        return True
 
     def __getitem__(self, key, with_age=False):
         """ Return the item of the dict.
         Raises a KeyError if key is not in the map.
         """
         with self.lock:
-            item = OrderedDict.__getitem__(self, key)
-            item_age = time.time() - item[1]
-            if item_age < self.max_age:
-                if with_age:
-                    return item[0], item_age
-                else:
-                    return item[0]
-            else:
-                del self[key]
-                raise KeyError(key)
+            item = self._items.get(key)
+            if item is not None:
+                item_age = time.monotonic() - item[1]
+                if item_age < self.max_age:
+                    self.hits += 1
+                    if self.max_len:
+                        self._items.move_to_end(key)
+                    if with_age:
+                        return item[0], item_age
+                    else:
+                        return item[0]
+                self._evict(key)
+            self.misses += 1
+        raise KeyError(key)
 
     def __setitem__(self, key, value):
         """ Set d[key] to value. """
+        now = time.monotonic()
+        with self.lock:
+            self._created.pop(key, None)
+            self._created[key] = now
+            self._items[key] = (value, now)
+            self._items.move_to_end(key)
+            self._expire(now)
+            if self.max_len:
+                while len(self._items) > self.max_len:
+                    self._evict(next(iter(self._items)))
+
+    def __delitem__(self, key):
         with self.lock:
-            OrderedDict.__setitem__(self, key, (value, time.time()))
+            del self._items[key]
+            del self._created[key]
+
+    def __iter__(self):
+        """ Iterate over a snapshot of the keys that haven't expired. """
+        with self.lock:
+            self._expire(time.monotonic())
+            keys = list(self._items)
+        return iter(keys)
+
+    def __len__(self):
+        with self.lock:
+            self._expire(time.monotonic())
+            return len(self._items)
+
+    def clear(self):
+        with self.lock:
+            self._items.clear()
+            self._created.clear()
 
     def pop(self, key, default=None):
         """ Get item from the dict and remove it.
         Return default if expired or does not exist. Never raise KeyError.
         """
         with self.lock:
-            try:
-                item = OrderedDict.__getitem__(self, key)
-                del self[key]
-                return item[0]
-            except KeyError:
+            item = self._items.pop(key, None)
+            if item is None:
                 return default
+            del self._created[key]
+        if time.monotonic() - item[1] < self.max_age:
+            return item[0]
+        return default
 
     def ttl(self, key):
         """ Return TTL of the `key` (in seconds).
         Returns None for non-existent or expired keys.
         """
         key_value, key_age = self.get(key, with_age=True)
-        if key_age:
+        if key_age is not None:
             key_ttl = self.max_age - key_age
             if key_ttl > 0:
                 return key_ttl
@@ -116,4 +189,4 @@ class ExpiringDict(OrderedDict):
                 r.append(self[key])
             except KeyError:
                 pass
-        return r
\ No newline at end of file
+        return r
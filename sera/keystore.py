@@ -0,0 +1,108 @@
+"""
+Watcher public keys by name in an indexed SQLite table, so looking up one
+watcher doesn't read the keys of the whole fleet.
+
+>>> keys = KeyStore('/etc/sera/known_watchers.db')
+>>> keys['web-1'] = 'b1ZfANMSxRJwqtkJK4DwLoL7wCl8-Rjl8aPEc-co4TU='
+>>> keys.update({'web-2': '...', 'web-3': '...'})  # in one transaction
+
+Keys can be imported from and exported to the dotenv format of the
+known_watchers file used by earlier versions.
+"""
+from collections import OrderedDict
+import os
+from pathlib import Path
+import sqlite3
+from threading import Lock
+
+from dotenv.main import parse_dotenv
+
+
+class KeyStore(object):
+    def __init__(self, path, table='watchers'):
+        self.path = str(path)
+        self.table = table
+        self.lock = Lock()
+        self.db = sqlite3.connect(
+            self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        with self.lock:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS %s (name TEXT PRIMARY KEY, key TEXT)' % table)
+
+    @classmethod
+    def open(cls, path, dotenv_path=None):
+        """Return the KeyStore at path, first importing a dotenv file if it is new"""
+        path = Path(str(path))
+        new = not path.exists()
+        store = cls(path)
+        if new and dotenv_path and Path(str(dotenv_path)).exists():
+            store.import_dotenv(dotenv_path)
+        return store
+
+    def get(self, name, default=None):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT key FROM %s WHERE name = ?' % self.table, (name,)).fetchone()
+        return row[0] if row else default
+
+    def __getitem__(self, name):
+        key = self.get(name)
+        if key is None:
+            raise KeyError(name)
+        return key
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __setitem__(self, name, key):
+        self.update({name: key})
+
+    def __delitem__(self, name):
+        with self.lock:
+            deleted = self.db.execute(
+                'DELETE FROM %s WHERE name = ?' % self.table, (name,)).rowcount
+        if not deleted:
+            raise KeyError(name)
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM %s' % self.table).fetchone()[0]
+
+    def __iter__(self):
+        return iter([name for name, key in self.items()])
+
+    def items(self):
+        """Return (name, key) of every watcher, ordered by name"""
+        with self.lock:
+            return self.db.execute(
+                'SELECT name, key FROM %s ORDER BY name' % self.table).fetchall()
+
+    def update(self, keys):
+        """Set many {name: key} in one transaction, so all or none are stored"""
+        items = keys.items() if hasattr(keys, 'items') else keys
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO %s (name, key) VALUES (?, ?)' % self.table,
+                    [(name, key) for name, key in items if key])
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def import_dotenv(self, path):
+        """Add the keys of a name=key dotenv file and return how many there were"""
+        keys = OrderedDict(parse_dotenv(str(path)))
+        self.update(keys)
+        return len(keys)
+
+    def export_dotenv(self, path):
+        """Write every key to a name=key dotenv file, replacing it atomically"""
+        path = str(path)
+        tmp_path = '%s.tmp' % path
+        keys = self.items()
+        with open(tmp_path, 'w') as file:
+            file.writelines('%s=%s\n' % (name, key) for name, key in keys)
+        os.replace(tmp_path, path)
+        return len(keys)
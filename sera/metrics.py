@@ -0,0 +1,174 @@
+"""
+Counters and latency histograms of a watcher in the Prometheus text format.
+
+Nothing is recorded until enable() is called, so instrumented code only pays
+for a flag check when metrics are off. `sera watch --metrics ADDRESS` enables
+them and exports them at ADDRESS, one of:
+
+    9100 or 127.0.0.1:9100     http on a local port
+    unix:/run/sera/metrics     http on a unix socket
+    file:/var/lib/sera.prom    a file rewritten every SERA_METRICS_INTERVAL seconds
+
+>>> metrics.inc('sera_receives_total', result='empty')
+>>> metrics.observe('sera_command_seconds', 0.2, command='echo')
+"""
+from bisect import bisect_left
+import logging
+import os
+from threading import Lock, Thread
+import time
+
+logger = logging.getLogger(__name__)
+
+ENABLED = False
+BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+METRICS = {  # name: (type, help)
+    'sera_receives_total': (
+        'counter', 'Receive polls that returned a message or were empty'),
+    'sera_queue_wait_seconds': (
+        'histogram', 'Time from a message being sent to being received'),
+    'sera_decrypt_seconds': ('histogram', 'Time to decrypt a received message'),
+    'sera_command_seconds': ('histogram', 'Time to execute a command by name'),
+    'sera_send_seconds': ('histogram', 'Time to send a message'),
+    'sera_dedup_hits_total': ('counter', 'Redelivered messages dropped as duplicates'),
+    'sera_rejected_total': ('counter', 'Messages dropped from clients that are not allowed'),
+    'sera_errors_total': ('counter', 'Errors by stage'),
+}
+
+LOCK = Lock()
+COUNTERS = {}  # (name, labels): value
+HISTOGRAMS = {}  # (name, labels): [bucket counts..., sum, count]
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def reset():
+    with LOCK:
+        COUNTERS.clear()
+        HISTOGRAMS.clear()
+
+
+def inc(name, value=1, **labels):
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with LOCK:
+        COUNTERS[key] = COUNTERS.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with LOCK:
+        histogram = HISTOGRAMS.get(key)
+        if histogram is None:
+            histogram = HISTOGRAMS[key] = [0] * (len(BUCKETS) + 3)
+        histogram[bisect_left(BUCKETS, seconds)] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+
+def _labels(labels, **extra):
+    labels = list(labels) + sorted(extra.items())
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n'))
+        for label, value in labels)
+
+
+def render():
+    """Return every recorded metric in the Prometheus text exposition format"""
+    with LOCK:
+        counters = sorted(COUNTERS.items())
+        histograms = sorted((key, list(value)) for key, value in HISTOGRAMS.items())
+    lines = []
+    for name, (kind, description) in sorted(METRICS.items()):
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for (metric, labels), value in counters:
+            if metric == name:
+                lines.append('%s%s %s' % (name, _labels(labels), value))
+        for (metric, labels), histogram in histograms:
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram):
+                cumulative += count
+                lines.append('%s_bucket%s %i' % (name, _labels(labels, le=bound), cumulative))
+            lines.append('%s_sum%s %r' % (name, _labels(labels), histogram[-2]))
+            lines.append('%s_count%s %i' % (name, _labels(labels), histogram[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+def write(path):
+    """Replace a file with the current metrics, for a textfile collector"""
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as file:
+        file.write(render())
+    os.replace(tmp_path, path)
+
+
+def export(address):
+    """
+    Enable metrics and export them at an address in a daemon thread,
+    returning a description of where they are served
+    """
+    enable()
+    if address.startswith('file:'):
+        path = address[len('file:'):]
+        interval = float(os.getenv('SERA_METRICS_INTERVAL', '15'))
+
+        def write_forever():
+            while True:
+                try:
+                    write(path)
+                except OSError as err:
+                    logger.warning('Failed to write metrics to %s: %s' % (path, str(err)))
+                time.sleep(interval)
+        Thread(target=write_forever, daemon=True).start()
+        return path
+    from http.server import BaseHTTPRequestHandler
+    import socketserver
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    if address.startswith('unix:'):
+        path = address[len('unix:'):]
+        if os.path.exists(path):
+            os.unlink(path)
+
+        class MetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+            def get_request(self):  # http.server expects a (host, port) client address
+                request, _ = super().get_request()
+                return request, ('unix', 0)
+        server = MetricsServer(path, MetricsHandler)
+        where = path
+    else:
+        host, _, port = address.rpartition(':')
+
+        class MetricsServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+        server = MetricsServer((host or '127.0.0.1', int(port)), MetricsHandler)
+        where = 'http://%s:%s/metrics' % server.server_address[:2]
+    Thread(target=server.serve_forever, daemon=True).start()
+    return where
@@ -0,0 +1,83 @@
+"""
+ExpiringDict written through to a SQLite table so entries survive restarts.
+
+Unexpired rows are loaded into memory when the dict is created, so lookups
+stay in memory and only writes touch the database. Expired rows are deleted
+on load and then at most once every max age.
+>>> received = PersistentExpiringDict(180, '/etc/sera/received.db', table='messages')
+Values must be serializable as json.
+
+"""
+import json
+import sqlite3
+import time
+from threading import Lock
+
+from .expiringdict import ExpiringDict
+
+
+class PersistentExpiringDict(ExpiringDict):
+    def __init__(self, max_age_seconds, path, table='cache', **kwargs):
+        super().__init__(max_age_seconds, **kwargs)
+        self.path = str(path)
+        self.table = table
+        self.db_lock = Lock()
+        self.db = sqlite3.connect(
+            self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        with self.db_lock:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS %s '
+                '(key TEXT PRIMARY KEY, value TEXT, created REAL)' % table)
+        self.compacted = 0
+        self._load()
+
+    def _load(self):
+        self.compact()
+        now = time.time()
+        monotonic_now = time.monotonic()
+        with self.db_lock:
+            rows = self.db.execute(
+                'SELECT key, value, created FROM %s ORDER BY created' % self.table).fetchall()
+        with self.lock:
+            for key, value, created in rows:
+                created = monotonic_now - (now - created)
+                self._created[key] = created
+                self._items[key] = (json.loads(value), created)
+            if self.max_len:
+                while len(self._items) > self.max_len:
+                    self._evict(next(iter(self._items)))
+
+    def compact(self):
+        """ Delete expired rows. """
+        now = time.time()
+        self.compacted = now
+        with self.db_lock:
+            self.db.execute(
+                'DELETE FROM %s WHERE created <= ?' % self.table, (now - self.max_age,))
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        with self.db_lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO %s (key, value, created) VALUES (?, ?, ?)' % self.table,
+                (key, json.dumps(value), time.time()))
+        if time.time() - self.compacted > self.max_age:
+            self.compact()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._delete(key)
+
+    def _delete(self, key):
+        with self.db_lock:
+            self.db.execute('DELETE FROM %s WHERE key = ?' % self.table, (key,))
+
+    def pop(self, key, default=None):
+        value = super().pop(key, default)
+        self._delete(key)
+        return value
+
+    def clear(self):
+        super().clear()
+        with self.db_lock:
+            self.db.execute('DELETE FROM %s' % self.table)
@@ -0,0 +1,24 @@
+from datetime import datetime
+
+from dateutil.tz import tzlocal
+
+
+class Message(object):
+    def __init__(self, uid, timestamp=0, body='', sender='', **kwargs):
+        self.__dict__.update(kwargs)
+        self.uid = str(uid)
+        self.timestamp = int(timestamp)
+        self.body = body
+        self.sender = sender
+
+    def __repr__(self):
+        return '<%s %s %s>' % (self.__class__.__name__, self.datetimestamp, self.body)
+
+    def __str__(self):
+        return self.body
+
+    @property
+    def datetimestamp(self):
+        if self.timestamp:
+            return datetime.fromtimestamp(
+                int(str(self.timestamp)[:10]), tz=tzlocal()).strftime('%d/%b/%Y:%H:%M:%S %z')
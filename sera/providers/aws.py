@@ -1,30 +1,56 @@
 
+from collections import deque, OrderedDict
 import logging
 import re
 import os
-from datetime import datetime
+import sqlite3
+import threading
 import time
 
-from dateutil.tz import tzlocal
 import boto3
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from botocore.exceptions import (
+    ClientError, ConnectionError as BotoConnectionError, HTTPClientError)
 
+from . import Message
+from .. import metrics
 from ..expiringdict import ExpiringDict
-from ..sera import Host
+from ..persistentdict import PersistentExpiringDict
+from ..utils import configure_path
 
 logger = logging.getLogger(__name__)
 
 ReceiveMessageWaitTimeSeconds = 0  # let the clients set wait time instead of the queue
 MessageRetentionPeriod = 60  # shortest period possible on aws
 VisibilityTimeout = MessageRetentionPeriod+60  # ensure the message is only seen once
+MaxNumberOfMessages = 1  # up to 10 per receive, extras are buffered on the provider
+MaxBatchEntries = 10  # aws limits on send_message_batch
+MaxBatchBytes = 256*1024
+MaxPoolConnections = 10  # http connections kept per client, at least the watcher workers
 
 url_pattern = re.compile('[^a-zA-Z0-9_-]+')
 ENDPOINT_CACHE = None
+# boto3 clients are thread safe and slow to create, so every provider in the
+# process shares one per service, region and credentials
+CLIENTS = {}  # (service, region, access key, secret key): client
+# the access key id each client signs with, which ties cached urls to an account
+ACCESS_KEY_IDS = {}  # (service, region, access key, secret key): access key id
+CLIENTS_LOCK = threading.Lock()
+NON_EXISTENT_QUEUE = ['AWS.SimpleQueueService.NonExistentQueue', 'QueueDoesNotExist']
+# error codes worth retrying, besides any 5xx response
+TRANSIENT_ERRORS = [
+    'Throttling', 'ThrottlingException', 'RequestThrottled', 'RequestThrottledException',
+    'TooManyRequestsException', 'RequestLimitExceeded', 'SlowDown', 'RequestTimeout',
+    'ServiceUnavailable', 'InternalError', 'InternalFailure',
+    'AWS.SimpleQueueService.RequestThrottled']
 
 # AWS SQS guarantees at least once but in practice may deliver twice
 # regardless of retention period and visibility timeout so we want to cache received
-# messageids to ensure we don't duplicate commands.
-MSG_CACHE = ExpiringDict(VisibilityTimeout+60)
+# messageids to ensure we don't duplicate commands. With a dedup_path the
+# messageids are also stored on disk so a restarted watcher still knows them.
+MSG_CACHE_TTL = VisibilityTimeout+60
+MSG_CACHE_SIZE = int(os.getenv('SERA_MSG_CACHE_SIZE', 10000))
+MSG_CACHE = ExpiringDict(MSG_CACHE_TTL, max_len=MSG_CACHE_SIZE, sweep_interval=60)
 
 Q_NAMESPACE = 'Sera'
 USERNAME = 'SeraWatcher'
@@ -48,28 +74,78 @@ WATCHER_POLICY = """{
     ]
 }"""
 
-logger = logging.getLogger(__name__)
 
+def get_endpoint_cache():
+    """
+    Return a cache of queue urls shared by every sera invocation, stored at
+    SERA_ENDPOINT_CACHE (default endpoints.db in the sera config path), or
+    in memory if it can't be opened.
+    """
+    ttl = int(os.getenv('SERA_ENDPOINT_TTL', 60*60))
+    max_len = int(os.getenv('SERA_ENDPOINT_CACHE_SIZE', 1000))
+    path = os.getenv('SERA_ENDPOINT_CACHE')
+    if path is None:
+        try:
+            path = str(configure_path() / 'endpoints.db')
+        except OSError:
+            path = ''
+    if path:
+        try:
+            return PersistentExpiringDict(ttl, path, table='endpoints', max_len=max_len)
+        except sqlite3.Error as err:
+            logger.debug('Endpoint cache %s unavailable: %s' % (path, str(err)))
+    return ExpiringDict(ttl, max_len=max_len)
 
-class Message(object):
-    def __init__(self, uid, timestamp=0, body='', sender='', **kwargs):
-        self.__dict__.update(kwargs)
-        self.uid = str(uid)
-        self.timestamp = int(timestamp)
-        self.body = body
-        self.sender = sender
 
-    def __repr__(self):
-        return '<%s %s %s>' % (self.__class__.__name__, self.datetimestamp, self.body)
+def get_client_key(service, region='', access_key='', secret_access_key=''):
+    """Return the key of the shared client for a service, region and credentials"""
+    return (
+        service,
+        region or os.getenv('SERA_REGION'),
+        access_key or os.getenv('SERA_ACCESS_KEY'),
+        secret_access_key or os.getenv('SERA_SECRET_KEY'))
+
 
-    def __str__(self):
-        return self.body
+def get_boto_client(service, region='', access_key='', secret_access_key=''):
+    """
+    Return the process wide boto3 client for a service, region and credentials,
+    with a connection pool of SERA_MAX_POOL_CONNECTIONS kept alive between
+    requests.
+    """
+    key = get_client_key(service, region, access_key, secret_access_key)
+    service, region, access_key, secret_access_key = key
+    client = CLIENTS.get(key)
+    if client:
+        return client
+    with CLIENTS_LOCK:
+        if key not in CLIENTS:
+            config = Config(
+                max_pool_connections=int(
+                    os.getenv('SERA_MAX_POOL_CONNECTIONS', MaxPoolConnections)),
+                tcp_keepalive=os.getenv('SERA_TCP_KEEPALIVE', '1') != '0')
+            # sessions aren't thread safe so each client gets its own
+            session = boto3.session.Session(
+                region_name=region,
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_access_key)
+            credentials = session.get_credentials()
+            ACCESS_KEY_IDS[key] = credentials.access_key if credentials else ''
+            CLIENTS[key] = session.client(service, config=config)
+        return CLIENTS[key]
 
-    @property
-    def datetimestamp(self):
-        if self.timestamp:
-            return datetime.fromtimestamp(
-                int(str(self.timestamp)[:10]), tz=tzlocal()).strftime('%d/%b/%Y:%H:%M:%S %z')
+
+def is_stale(err):
+    """Return True if a ClientError is for a queue that no longer exists"""
+    return err.response.get('Error', {}).get('Code', '') in NON_EXISTENT_QUEUE
+
+
+def is_transient(err):
+    """Return True if an error is throttling, a server error or a connection error"""
+    if isinstance(err, ClientError):
+        status = err.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        code = err.response.get('Error', {}).get('Code', '')
+        return code in TRANSIENT_ERRORS or status >= 500
+    return isinstance(err, (BotoConnectionError, HTTPClientError, ConnectionError, TimeoutError))
 
 
 class AWSProvider(object):
@@ -80,24 +156,41 @@ class AWSProvider(object):
             secret_access_key='',
             namespace=None,
             **kwargs):
-        global ENDPOINT_CACHE
+        global ENDPOINT_CACHE, MSG_CACHE
         if not ENDPOINT_CACHE:
-            ENDPOINT_CACHE = ExpiringDict(int(os.getenv('SERA_ENDPOINT_TTL', 60*60)))
+            ENDPOINT_CACHE = get_endpoint_cache()
         self.cache = ENDPOINT_CACHE
+        dedup_path = kwargs.pop('dedup_path', None) or os.getenv('SERA_DEDUP_PATH')
+        if dedup_path and getattr(MSG_CACHE, 'path', None) != str(dedup_path):
+            MSG_CACHE = PersistentExpiringDict(
+                MSG_CACHE_TTL, dedup_path, table='messages',
+                max_len=MSG_CACHE_SIZE, sweep_interval=60)
         self.name = 'AWS'
         self.endpoint = kwargs.get('endpoint')  # sera.Host
-        self.sqs = boto3.client(
-            'sqs',
-            region_name=region or os.getenv('SERA_REGION'),
-            aws_access_key_id=access_key or os.getenv('SERA_ACCESS_KEY'),
-            aws_secret_access_key=secret_access_key or os.getenv('SERA_SECRET_KEY'))
+        client_key = get_client_key('sqs', region, access_key, secret_access_key)
+        self.sqs = get_boto_client(*client_key)
+        self.access_key_id = ACCESS_KEY_IDS.get(client_key, '')
         if namespace is None:  # allow '' to be set as a valid namespace
             namespace = os.getenv('SERA_NAMESPACE', 'sera')
         kwargs.setdefault('namespace', namespace)
         kwargs.setdefault('ReceiveMessageWaitTimeSeconds', ReceiveMessageWaitTimeSeconds)
         kwargs.setdefault('MessageRetentionPeriod', MessageRetentionPeriod)
         kwargs.setdefault('VisibilityTimeout', VisibilityTimeout)
+        kwargs.setdefault(
+            'MaxNumberOfMessages',
+            int(os.getenv('SERA_MAX_MESSAGES', MaxNumberOfMessages)))
         self.__dict__.update(kwargs)
+        # messages received in a batch but not yet handed out, with their
+        # visibility deadline
+        self.prefetched = deque()
+
+    def _cache_key(self, name):
+        """
+        Return an endpoint cache key unique to the credentials, region and
+        queue name, so accounts sharing the cache don't get each other's urls
+        """
+        return '%s:%s:%s' % (
+            self.access_key_id, self.sqs.meta.region_name, self._sanitize(name))
 
     def _sanitize(self, name):
         """Return a name with a namespace and limited to sqs max queue name length"""
@@ -106,6 +199,8 @@ class AWSProvider(object):
             return '-'.join([self.namespace, name])[:80]
         return name[:80]
 
+    is_transient = staticmethod(is_transient)
+
     @classmethod
     def create_provider_keys(
             cls,
@@ -115,11 +210,7 @@ class AWSProvider(object):
             policy=WATCHER_POLICY):
         """Create a provider user with permissions for the watcher to connect"""
 
-        iam = boto3.client(
-            'iam',
-            region_name=os.getenv('SERA_REGION'),
-            aws_access_key_id=os.getenv('SERA_ACCESS_KEY'),
-            aws_secret_access_key=os.getenv('SERA_SECRET_KEY'))
+        iam = get_boto_client('iam')
         try:
             iam.create_user(UserName=username)
             keys = iam.create_access_key(UserName=username)
@@ -164,22 +255,24 @@ class AWSProvider(object):
             code = e.response.get('Error', {}).get('Code', '')
             logger.error('%s on create_queue %s' % (code, name))
             raise
-        self.cache[name] = url
+        self.cache[self._cache_key(name)] = url
         return url
 
     def delete_endpoint(self, url):
         self.sqs.delete_queue(QueueUrl=url)
+        for key, cached_url in self.cache.items():
+            if cached_url == url:
+                self.cache.pop(key)
 
     def get_endpoint(self, name):
         queue_name = self._sanitize(name)
-        url = self.cache.get(name)
+        url = self.cache.get(self._cache_key(name))
         if not url:
             try:
                 url = self.sqs.get_queue_url(QueueName=queue_name)['QueueUrl']
-                self.cache[name] = url
+                self.cache[self._cache_key(name)] = url
             except ClientError as e:
-                code = e.response.get('Error', {}).get('Code', '')
-                if code == 'AWS.SimpleQueueService.NonExistentQueue':
+                if is_stale(e):
                     logger.debug("%s queue doesn't exist" % queue_name)
                     return
                 else:
@@ -187,40 +280,119 @@ class AWSProvider(object):
         logger.debug('get_endpoint %s' % str(url))
         return url
 
+    def list_endpoints(self):
+        """Return the names of the queues in this namespace"""
+        prefix = '%s-' % self.namespace if self.namespace else ''
+        names = []
+        paginator = self.sqs.get_paginator('list_queues')
+        for page in paginator.paginate(QueueNamePrefix=prefix):
+            for url in page.get('QueueUrls', []):
+                names.append(url.rsplit('/', 1)[-1][len(prefix):])
+        return names
+
     def delete_message(self, uid):
         return self.sqs.delete_message(
             QueueUrl=self.endpoint.url,
             ReceiptHandle=uid)
 
+    def _pop_prefetched(self):
+        """Return the next buffered message that is still invisible to other receivers"""
+        while self.prefetched:
+            message, deadline = self.prefetched.popleft()
+            if time.time() < deadline:
+                MSG_CACHE[message.message_id] = None
+                return message
+            # the message is visible on the queue again and will be redelivered
+            logger.debug('Dropping prefetched message %s past its visibility' % message.uid)
+        return
+
     def receive_message(self, timeout=0):
-        global MSG_CACHE
+        message = self._pop_prefetched()
+        if message:
+            return message
         if timeout > 20 or timeout < 0:  # aws max long poll
             timeout = 20
-        msg = None
+        msgs = []
         start = time.time()
-        while not msg or msg.get('MessageId') in MSG_CACHE:
-            msg = self.sqs.receive_message(
-                QueueUrl=self.endpoint.url,
-                AttributeNames=['SentTimestamp'],
-                MessageAttributeNames=['Sender', 'Encrypted'],
-                WaitTimeSeconds=timeout,
-                MaxNumberOfMessages=1).get('Messages', [None])[0]
+        while not msgs:
+            received = self._receive_own(timeout)
+            msgs = [msg for msg in received if msg['MessageId'] not in MSG_CACHE]
+            if len(msgs) < len(received):
+                metrics.inc('sera_dedup_hits_total', len(received) - len(msgs))
             duration = time.time() - start
             if duration > timeout:
                 break
-        if msg and msg['MessageId'] not in MSG_CACHE:
+        # received messages stay hidden from other receivers until the deadline
+        deadline = start + self.VisibilityTimeout
+        for msg in msgs:
             message = Message(
                 uid=msg['ReceiptHandle'],
                 timestamp=msg['Attributes']['SentTimestamp'],
                 body=msg['Body'],
                 sender=msg['MessageAttributes'].get('Sender', {}).get('StringValue', ''),
-                encrypted=msg['MessageAttributes'].get('Encrypted', {}).get('BinaryValue', ''))
-            MSG_CACHE['MessageId'] = None
-            return message
-        return
+                encrypted=msg['MessageAttributes'].get('Encrypted', {}).get('BinaryValue', ''),
+                envelope=msg['MessageAttributes'].get('Envelope', {}).get('BinaryValue', b''),
+                message_id=msg['MessageId'])
+            self.prefetched.append((message, deadline))
+        return self._pop_prefetched()
 
-    def send_message(self, name, msg, attributes={}):
-        to = Host.get(name, create=self.endpoint.creator)
+    def _receive_own(self, timeout):
+        """
+        Receive from this endpoint's queue, looking its url up again once if
+        stale. A queue that was deleted and isn't ours to create has no
+        messages, so wait out the timeout and return none.
+        """
+        try:
+            return self._receive(self.endpoint.url, timeout)
+        except ClientError as e:
+            if not is_stale(e):
+                raise
+            logger.debug('Stale endpoint %s for %s' % (self.endpoint.url, self.endpoint.uid))
+            self.cache.pop(self._cache_key(self.endpoint.uid), None)
+            url = self._resolve(self.endpoint.uid)
+            if not url:
+                logger.warning("%s queue doesn't exist" % self._sanitize(self.endpoint.uid))
+                time.sleep(timeout)
+                return []
+            self.endpoint.url = url
+            return self._receive(url, timeout)
+
+    def _receive(self, url, timeout):
+        return self.sqs.receive_message(
+            QueueUrl=url,
+            AttributeNames=['SentTimestamp'],
+            MessageAttributeNames=['Sender', 'Encrypted', 'Envelope'],
+            WaitTimeSeconds=timeout,
+            MaxNumberOfMessages=self.MaxNumberOfMessages).get('Messages', [])
+
+    def _with_endpoint(self, name, call):
+        """
+        Return call(url) for the endpoint of a name, looking the url up again
+        once if it was stale, or None if the endpoint doesn't exist
+        """
+        url = self._resolve(name)
+        if url:
+            try:
+                return call(url)
+            except ClientError as e:
+                if not is_stale(e):
+                    raise
+                logger.debug('Stale endpoint %s for %s' % (url, name))
+                self.cache.pop(self._cache_key(name), None)
+                url = self._resolve(name)
+        if not url:
+            logger.warning("%s queue doesn't exist" % self._sanitize(name))
+            return
+        return call(url)
+
+    def _resolve(self, name):
+        """Return the url of a recipient queue, creating it if this endpoint is a creator"""
+        url = self.get_endpoint(name)
+        if not url and self.endpoint.creator:
+            url = self.create_endpoint(name)
+        return url
+
+    def _message_attributes(self, attributes):
         msg_attrs = {}
         msg_attrs['Sender'] = self.endpoint.uid
         msg_attrs.update(attributes)
@@ -229,10 +401,61 @@ class AWSProvider(object):
                 msg_attrs[attr] = {'BinaryValue': value, 'DataType': 'Binary'}
             else:
                 msg_attrs[attr] = {'StringValue': value, 'DataType': 'String'}
-        logger.info('sqs.send_message(%s, ...)' % to.url)
+        return msg_attrs
+
+    def send_message(self, name, msg, attributes={}):
+        msg_attrs = self._message_attributes(attributes)
+        return self._with_endpoint(name, lambda url: self._send(url, msg, msg_attrs))
+
+    def _send(self, url, msg, msg_attrs):
+        logger.info('sqs.send_message(%s, ...)' % url)
         response = self.sqs.send_message(
-            QueueUrl=to.url,
+            QueueUrl=url,
             MessageBody=msg,
             MessageAttributes=msg_attrs)
 
         return response
+
+    def send_message_batch(self, messages):
+        """
+        Send an iterable of (name, msg, attributes) tuples.
+
+        Recipient urls are resolved up front and messages are grouped per queue
+        into send_message_batch calls within the aws entry and size limits.
+        """
+        queues = OrderedDict()
+        for name, msg, attributes in messages:
+            queues.setdefault(name, []).append(
+                {'MessageBody': msg, 'MessageAttributes': self._message_attributes(attributes)})
+        for name in queues:
+            self._resolve(name)
+
+        responses = []
+        for name, entries in queues.items():
+            batch = []
+            batch_bytes = 0
+            for entry in entries:
+                size = len(entry['MessageBody']) + sum(
+                    len(attr) + len(value.get('StringValue', value.get('BinaryValue', '')))
+                    for attr, value in entry['MessageAttributes'].items())
+                if batch and (
+                        len(batch) == MaxBatchEntries or batch_bytes + size > MaxBatchBytes):
+                    responses.append(self._with_endpoint(
+                        name, lambda url: self._send_batch(url, batch)))
+                    batch = []
+                    batch_bytes = 0
+                entry['Id'] = str(len(batch))
+                batch.append(entry)
+                batch_bytes += size
+            if batch:
+                responses.append(self._with_endpoint(
+                    name, lambda url: self._send_batch(url, batch)))
+        return responses
+
+    def _send_batch(self, url, entries):
+        logger.info('sqs.send_message_batch(%s, %i entries)' % (url, len(entries)))
+        response = self.sqs.send_message_batch(QueueUrl=url, Entries=entries)
+        for failed in response.get('Failed', []):
+            logger.error('%s sending batch entry %s to %s' % (
+                failed.get('Code', ''), failed.get('Id'), url))
+        return response
@@ -0,0 +1,295 @@
+"""
+Filesystem spool provider for clients and watchers on the same machine or on
+shared storage, e.g. SERA_CLIENT=sera.providers.local.LocalProvider
+
+Each endpoint is a directory under SERA_SPOOL_PATH with maildir style
+subdirectories. Messages are written to tmp/ and renamed into new/, and a
+receiver claims a message by renaming it into cur/, so delivery is atomic and a
+message is only handed to one receiver. Claimed messages that are not deleted
+reappear after the visibility timeout, and unclaimed messages expire after the
+retention period like the AWS provider.
+
+A long polling receiver waits on a fifo of its own in wake/, which senders on
+the same machine write to after each delivery, so a message is noticed as soon
+as it arrives. Receivers also rescan the spool at intervals growing up to
+PollInterval, for senders on other machines sharing the storage.
+"""
+from base64 import b64decode, b64encode
+import errno
+import json
+import logging
+import os
+from pathlib import Path
+import re
+import select
+import shutil
+import socket
+import tempfile
+import time
+from uuid import uuid4
+import weakref
+
+from . import Message
+
+logger = logging.getLogger(__name__)
+
+MessageRetentionPeriod = 60
+VisibilityTimeout = MessageRetentionPeriod+60
+MinPollInterval = 0.001  # seconds between the first spool scans while long polling
+PollInterval = 0.25  # most seconds between scans, when no sender on this machine wakes us
+SweepInterval = 1  # seconds between expiring old and invisible messages
+SpoolMode = 0o2770  # group writable, setgid so everything in the spool keeps its group
+MessageMode = 0o660
+
+url_pattern = re.compile('[^a-zA-Z0-9_-]+')
+# fifos are named pid-id@hostname, as only senders on the same machine can open them
+HOSTNAME = url_pattern.sub('-', socket.gethostname())
+
+
+def get_spool_path():
+    return Path(os.getenv('SERA_SPOOL_PATH') or Path(tempfile.gettempdir()) / 'sera')
+
+
+def make_shared_dir(path, group=None):
+    """
+    Create a directory that the client and watcher users of its group can both
+    write, leaving one that already exists as it is
+    """
+    try:
+        path.mkdir()
+    except FileExistsError:
+        return
+    os.chmod(str(path), SpoolMode)  # mkdir modes are masked by the umask
+    if group:
+        shutil.chown(str(path), group=group)
+
+
+def close_fifo(path, fd=None):
+    if fd is not None:
+        os.close(fd)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:  # the endpoint was deleted
+        pass
+
+
+def notify(url):
+    """Wake the receivers on this machine that wait for messages on a spool"""
+    wake = os.path.join(url, 'wake')
+    try:
+        names = os.listdir(wake)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if not name.endswith('@' + HOSTNAME):
+            continue
+        path = os.path.join(wake, name)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except FileNotFoundError:  # its receiver exited
+            continue
+        except OSError as err:
+            if err.errno == errno.ENXIO:  # left behind by a receiver that didn't exit cleanly
+                close_fifo(path)
+            else:  # the receiver rescans the spool anyway
+                logger.debug('Failed to wake a receiver on %s: %s' % (url, str(err)))
+            continue
+        try:
+            os.write(fd, b'\0')
+        except BlockingIOError:  # woken already
+            pass
+        finally:
+            os.close(fd)
+
+
+class LocalProvider(object):
+    def __init__(
+            self,
+            spool_path='',
+            namespace=None,
+            **kwargs):
+        self.name = 'Local'
+        self.endpoint = kwargs.get('endpoint')  # sera.Host
+        self.spool_path = Path(spool_path) if spool_path else get_spool_path()
+        if namespace is None:  # allow '' to be set as a valid namespace
+            namespace = os.getenv('SERA_NAMESPACE', 'sera')
+        kwargs.setdefault('namespace', namespace)
+        kwargs.setdefault('MessageRetentionPeriod', MessageRetentionPeriod)
+        kwargs.setdefault('VisibilityTimeout', VisibilityTimeout)
+        kwargs.setdefault(
+            'PollInterval', float(os.getenv('SERA_SPOOL_INTERVAL', PollInterval)))
+        self.__dict__.update(kwargs)
+        self.swept = 0
+        self.fifos = {}  # url: fd
+
+    def _sanitize(self, name):
+        """Return a name with a namespace, limited to the same length as aws queues"""
+        name = url_pattern.sub('-', name)
+        if self.namespace:
+            return '-'.join([self.namespace, name])[:80]
+        return name[:80]
+
+    @classmethod
+    def create_provider_keys(cls, *args, **kwargs):
+        """A local spool has no provider credentials"""
+        return None, None
+
+    def create_endpoint(self, name):
+        path = self.spool_path / self._sanitize(name)
+        if not self.spool_path.exists():
+            self.spool_path.parent.mkdir(parents=True, exist_ok=True)
+            make_shared_dir(self.spool_path, os.getenv('SERA_SPOOL_GROUP'))
+        make_shared_dir(path)
+        for subdir in ['tmp', 'new', 'cur', 'wake']:
+            make_shared_dir(path / subdir)
+        return str(path)
+
+    def delete_endpoint(self, url):
+        shutil.rmtree(url, ignore_errors=True)
+
+    def get_endpoint(self, name):
+        path = self.spool_path / self._sanitize(name)
+        if not (path / 'new').exists():
+            logger.debug("%s spool doesn't exist" % str(path))
+            return
+        logger.debug('get_endpoint %s' % str(path))
+        return str(path)
+
+    def list_endpoints(self):
+        prefix = self._sanitize('')
+        if not self.spool_path.exists():
+            return []
+        return [
+            path.name[len(prefix):] for path in self.spool_path.iterdir()
+            if path.name.startswith(prefix) and (path / 'new').exists()]
+
+    def delete_message(self, uid):
+        try:
+            os.unlink(os.path.join(self.endpoint.url, 'cur', uid))
+        except FileNotFoundError:
+            pass
+
+    def _sweep(self, url):
+        """Expire unclaimed messages and make invisible claimed messages visible again"""
+        now = time.time()
+        if now - self.swept < SweepInterval:
+            return
+        self.swept = now
+        for subdir in ['new', 'cur']:
+            for uid in os.listdir(os.path.join(url, subdir)):
+                path = os.path.join(url, subdir, uid)
+                try:
+                    if now - int(uid.split('-')[0]) / 1e6 > self.MessageRetentionPeriod:
+                        os.unlink(path)
+                    elif subdir == 'cur' and (
+                            now - os.stat(path).st_mtime > self.VisibilityTimeout):
+                        os.rename(path, os.path.join(url, 'new', uid))
+                except FileNotFoundError:  # claimed or swept by another receiver
+                    pass
+
+    def _claim(self, url):
+        """Return the oldest message on the spool that this receiver claimed"""
+        for uid in sorted(os.listdir(os.path.join(url, 'new'))):
+            path = os.path.join(url, 'cur', uid)
+            try:
+                os.rename(os.path.join(url, 'new', uid), path)
+            except FileNotFoundError:  # claimed by another receiver
+                continue
+            os.utime(path)  # start of the visibility timeout
+            with open(path) as file:
+                record = json.load(file)
+            attributes = record.pop('attributes')
+            for attr, value in attributes.items():
+                if isinstance(value, dict):  # binary
+                    attributes[attr] = b64decode(value['binary'])
+            return Message(
+                uid=uid,
+                timestamp=record['timestamp'],
+                body=record['body'],
+                sender=attributes.get('Sender', ''),
+                encrypted=attributes.get('Encrypted', ''),
+                envelope=attributes.get('Envelope', b''))
+
+    def _fifo(self, url):
+        """Return the fd of the fifo this receiver waits on for messages on a spool"""
+        fd = self.fifos.get(url)
+        if fd is None:
+            make_shared_dir(Path(url) / 'wake')  # missing from spools of earlier versions
+            path = os.path.join(
+                url, 'wake', '%i-%s@%s' % (os.getpid(), uuid4().hex[:8], HOSTNAME))
+            os.mkfifo(path)
+            os.chmod(path, MessageMode)
+            # opened for writing too, so it never reads as closed between senders
+            fd = self.fifos[url] = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+            weakref.finalize(self, close_fifo, path, fd)
+        return fd
+
+    def _wait(self, url, timeout):
+        """Wait until a sender on this machine wakes us, and return True if one did"""
+        try:
+            fd = self._fifo(url)
+        except FileNotFoundError:  # no spool to wait on
+            time.sleep(timeout)
+            return False
+        if not select.select([fd], [], [], timeout)[0]:
+            return False
+        try:
+            os.read(fd, 4096)
+        except BlockingIOError:
+            pass
+        return True
+
+    def receive_message(self, timeout=0):
+        """
+        Return the next message, or None after timeout seconds without one,
+        also while the endpoint doesn't exist
+        """
+        if timeout > 20 or timeout < 0:  # same max long poll as aws
+            timeout = 20
+        url = self.endpoint.url
+        deadline = time.time() + timeout
+        interval = MinPollInterval
+        while True:
+            try:
+                self._sweep(url)
+                message = self._claim(url)
+            except FileNotFoundError:
+                logger.debug("%s spool doesn't exist" % url)
+                message = None
+            remaining = deadline - time.time()
+            if message or remaining <= 0:
+                return message
+            if self._wait(url, min(interval, remaining)):
+                interval = MinPollInterval
+            else:
+                interval = min(interval * 2, self.PollInterval)
+
+    def send_message(self, name, msg, attributes={}):
+        url = self.get_endpoint(name)
+        if not url and self.endpoint.creator:
+            url = self.create_endpoint(name)
+        if not url:
+            logger.warning("%s spool doesn't exist" % self._sanitize(name))
+            return
+        msg_attrs = {}
+        msg_attrs['Sender'] = self.endpoint.uid
+        msg_attrs.update(attributes)
+        for attr, value in msg_attrs.items():
+            if not isinstance(value, str):
+                msg_attrs[attr] = {'binary': b64encode(value).decode('ascii')}
+        now = time.time()
+        uid = '%016d-%s' % (int(now * 1e6), uuid4().hex)
+        logger.info('spool.send_message(%s, ...)' % url)
+        tmp_path = os.path.join(url, 'tmp', uid)
+        with open(tmp_path, 'w') as file:
+            os.fchmod(file.fileno(), MessageMode)  # readable by a receiver of the group
+            json.dump({
+                'body': msg,
+                'timestamp': int(now * 1000),
+                'attributes': msg_attrs}, file)
+        os.rename(tmp_path, os.path.join(url, 'new', uid))
+        notify(url)
+        return {'MessageId': uid}
+
+    def send_message_batch(self, messages):
+        return [self.send_message(name, msg, attributes) for name, msg, attributes in messages]
@@ -0,0 +1,181 @@
+"""
+In-memory provider that mimics AWS SQS semantics within one process, for tests
+and benchmarks, e.g. SERA_CLIENT=sera.providers.memory.MemoryProvider
+
+Received messages are hidden for the visibility timeout, unreceived messages
+expire after the retention period, and SERA_MEMORY_DUPLICATES sets the chance
+(0 to 1) that a received message is delivered again, as SQS may do.
+"""
+from collections import deque
+from heapq import heappop, heappush
+import logging
+import os
+import random
+import re
+import threading
+import time
+from uuid import uuid4
+
+from . import Message
+from .. import metrics
+from ..expiringdict import ExpiringDict
+
+logger = logging.getLogger(__name__)
+
+MessageRetentionPeriod = 60
+VisibilityTimeout = MessageRetentionPeriod+60
+
+url_pattern = re.compile('[^a-zA-Z0-9_-]+')
+
+QUEUES = {}  # url: Queue
+QUEUES_CHANGED = threading.Condition()
+
+# duplicate deliveries are dropped like the AWS provider does
+MSG_CACHE = ExpiringDict(
+    VisibilityTimeout+60,
+    max_len=int(os.getenv('SERA_MSG_CACHE_SIZE', 10000)),
+    sweep_interval=60)
+
+
+class Queue(object):
+    def __init__(self):
+        self.messages = {}  # uid: message record
+        self.visible = deque()  # uids in delivery order
+        self.invisible = []  # heap of (visible again time, uid)
+
+    def put(self, record):
+        self.messages[record['uid']] = record
+        self.visible.append(record['uid'])
+
+    def hide(self, uid, until):
+        heappush(self.invisible, (until, uid))
+
+    def get(self, now, retention, visibility, duplicate_rate=0):
+        """Return the next visible message record and hide it, or deliver it again"""
+        while self.invisible and self.invisible[0][0] <= now:
+            self.visible.append(heappop(self.invisible)[1])
+        while self.visible:
+            uid = self.visible.popleft()
+            record = self.messages.get(uid)
+            if not record:  # deleted
+                continue
+            if now - record['sent'] > retention:
+                del self.messages[uid]
+                continue
+            if random.random() < duplicate_rate:
+                self.visible.append(uid)
+            else:
+                self.hide(uid, now + visibility)
+            return record
+
+    def delete(self, uid):
+        self.messages.pop(uid, None)
+
+
+class MemoryProvider(object):
+    def __init__(
+            self,
+            namespace=None,
+            **kwargs):
+        self.name = 'Memory'
+        self.endpoint = kwargs.get('endpoint')  # sera.Host
+        if namespace is None:  # allow '' to be set as a valid namespace
+            namespace = os.getenv('SERA_NAMESPACE', 'sera')
+        kwargs.setdefault('namespace', namespace)
+        kwargs.setdefault('MessageRetentionPeriod', MessageRetentionPeriod)
+        kwargs.setdefault('VisibilityTimeout', VisibilityTimeout)
+        kwargs.setdefault(
+            'DuplicateRate', float(os.getenv('SERA_MEMORY_DUPLICATES', '0')))
+        self.__dict__.update(kwargs)
+
+    def _sanitize(self, name):
+        """Return a name with a namespace, limited to the same length as aws queues"""
+        name = url_pattern.sub('-', name)
+        if self.namespace:
+            return '-'.join([self.namespace, name])[:80]
+        return name[:80]
+
+    @classmethod
+    def create_provider_keys(cls, *args, **kwargs):
+        """An in-memory queue has no provider credentials"""
+        return None, None
+
+    def create_endpoint(self, name):
+        url = 'memory://%s' % self._sanitize(name)
+        with QUEUES_CHANGED:
+            QUEUES.setdefault(url, Queue())
+            QUEUES_CHANGED.notify_all()
+        return url
+
+    def delete_endpoint(self, url):
+        with QUEUES_CHANGED:
+            QUEUES.pop(url, None)
+
+    def get_endpoint(self, name):
+        url = 'memory://%s' % self._sanitize(name)
+        if url not in QUEUES:
+            logger.debug("%s queue doesn't exist" % url)
+            return
+        return url
+
+    def list_endpoints(self):
+        prefix = 'memory://%s' % self._sanitize('')
+        return [url[len(prefix):] for url in list(QUEUES) if url.startswith(prefix)]
+
+    def delete_message(self, uid):
+        with QUEUES_CHANGED:
+            queue = QUEUES.get(self.endpoint.url)
+            if queue:
+                queue.delete(uid)
+
+    def receive_message(self, timeout=0):
+        """
+        Return the next message, or None after timeout seconds without one,
+        also while the endpoint doesn't exist
+        """
+        if timeout > 20 or timeout < 0:  # same max long poll as aws
+            timeout = 20
+        deadline = time.time() + timeout
+        with QUEUES_CHANGED:
+            while True:
+                now = time.time()
+                queue = QUEUES.get(self.endpoint.url)
+                record = queue and queue.get(
+                    now, self.MessageRetentionPeriod, self.VisibilityTimeout, self.DuplicateRate)
+                if record and record['uid'] in MSG_CACHE:
+                    logger.debug('Dropping duplicate delivery of %s' % record['uid'])
+                    metrics.inc('sera_dedup_hits_total')
+                    continue
+                if record:
+                    break
+                if now >= deadline:
+                    return
+                QUEUES_CHANGED.wait(deadline - now)
+        MSG_CACHE[record['uid']] = None
+        return Message(
+            uid=record['uid'],
+            timestamp=int(record['sent'] * 1000),
+            body=record['body'],
+            sender=record['attributes'].get('Sender', ''),
+            encrypted=record['attributes'].get('Encrypted', ''),
+            envelope=record['attributes'].get('Envelope', b''))
+
+    def send_message(self, name, msg, attributes={}):
+        url = self.get_endpoint(name)
+        if not url and self.endpoint.creator:
+            url = self.create_endpoint(name)
+        if not url:
+            logger.warning("%s queue doesn't exist" % self._sanitize(name))
+            return
+        msg_attrs = {}
+        msg_attrs['Sender'] = self.endpoint.uid
+        msg_attrs.update(attributes)
+        uid = uuid4().hex
+        with QUEUES_CHANGED:
+            QUEUES[url].put({
+                'uid': uid, 'body': msg, 'attributes': msg_attrs, 'sent': time.time()})
+            QUEUES_CHANGED.notify_all()
+        return {'MessageId': uid}
+
+    def send_message_batch(self, messages):
+        return [self.send_message(name, msg, attributes) for name, msg, attributes in messages]
@@ -1,14 +1,22 @@
+from collections import deque, OrderedDict
 import logging
 import re
 from os import getenv
-from subprocess import run as _run, PIPE, CompletedProcess
+from queue import Queue, Empty
+from subprocess import run as _run, Popen, PIPE, CompletedProcess, TimeoutExpired
 import json
 import importlib
+import math
+import random
+import struct
+from threading import Condition, Lock, Thread
 import time
+from uuid import uuid4
+import zlib
 
-from nacl.exceptions import CryptoError
-
-from .utils import encrypt, decrypt
+from . import envelope, metrics
+from .expiringdict import ExpiringDict
+from .utils import encrypt, decrypt, key_from_bytes, key_to_bytes
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +24,28 @@ START_TIME = 0
 DEFAULT_CLIENT = 'sera.providers.aws.AWSProvider'
 DEFAULT_TIMEOUT = 20
 Q_NAMESPACE = 'Sera'
+RUN_TIMEOUT = 60*12
+STREAM_INTERVAL = float(getenv('SERA_STREAM_INTERVAL', '0.5'))  # seconds between chunks
+STREAM_CHUNK_SIZE = 64*1024  # characters of output per chunk
+
+ENVELOPE_BODY = 'envelope'  # the body of messages with an Envelope attribute
+
+# encrypted payloads are compressed with SERA_CODEC ('none' to disable) when
+# they are at least COMPRESS_MIN_BYTES and it makes them smaller
+CODECS = {
+    'zlib': (zlib.compress, zlib.decompress),
+}
+COMPRESS_MIN_BYTES = 512
+# payloads larger than a message allows are sent as ordered fragments
+FRAGMENT_BYTES = int(getenv('SERA_FRAGMENT_BYTES', 192*1024))
+FRAGMENT_TTL = 60*5
+# fragment id: (fragment count, {index: bytes}), changed by receiving threads under the lock
+FRAGMENTS = ExpiringDict(FRAGMENT_TTL, max_len=1000)
+FRAGMENTS_LOCK = Lock()
+# rejections are counted for the most recently rejected sender keys, which any
+# sender can make up, within the last REJECTED_TTL seconds
+REJECTED_TTL = 60*60
+REJECTED_MAX_KEYS = 1000
 
 url_pattern = re.compile('[^a-zA-Z0-9_-]+')
 
@@ -27,6 +57,10 @@ class RemoteCommand(CompletedProcess):
         self.__dict__['name'] = kwargs.pop('name', None)
         self.__dict__['params'] = kwargs.pop('params', None)
         self.__dict__['subcommand'] = kwargs.pop('subcommand', None)
+        # streamed output chunks are numbered in order from 0
+        self.__dict__['seq'] = kwargs.pop('seq', None)
+        self.__dict__['stream'] = kwargs.pop('stream', False)
+        self.__dict__['correlation_id'] = kwargs.pop('correlation_id', None)
         kwargs.setdefault('returncode', None)
         kwargs.setdefault('args', ())
         super().__init__(**kwargs)
@@ -43,6 +77,18 @@ class RemoteCommand(CompletedProcess):
     def subcommand(self):
         return self.__dict__.get('subcommand', None)
 
+    @property
+    def seq(self):
+        return self.__dict__.get('seq', None)
+
+    @property
+    def stream(self):
+        return self.__dict__.get('stream', False)
+
+    @property
+    def correlation_id(self):
+        return self.__dict__.get('correlation_id', None)
+
     @property
     def host(self):
         return self.__dict__.get('host', '')
@@ -65,28 +111,133 @@ def get_client():
     return getattr(module, class_name)
 
 
-def run(cmd, args=None):
+def run(cmd, args=None, stream=None):
     """
     Run command as sudo user (to log command)
+
+    With a stream callback, output is passed to stream(stdout, stderr) in
+    chunks while the command runs instead of being returned.
     """
     cmd = ['sudo', '-n', cmd]  # avoid prompting for sudo password
     if args:
         cmd += list(args)
+    if stream:
+        return run_stream(cmd, stream)
     return _run(
             cmd,
             stdout=PIPE,
             stderr=PIPE,
             universal_newlines=True,
-            timeout=60*12)
+            timeout=RUN_TIMEOUT)
+
+
+def _read_lines(pipe, name, lines):
+    for line in pipe:
+        lines.put((name, line))
+    pipe.close()
+    lines.put((name, None))
+
+
+def run_stream(cmd, stream, interval=None, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Run cmd and call stream(stdout, stderr) with the output at most every
+    interval seconds, or sooner once chunk_size characters are buffered.
+    Return a CompletedProcess without output.
+    """
+    if interval is None:
+        interval = STREAM_INTERVAL
+    process = Popen(cmd, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    lines = Queue()
+    for name in ['stdout', 'stderr']:
+        Thread(target=_read_lines, args=(getattr(process, name), name, lines), daemon=True).start()
+    buffered = {'stdout': [], 'stderr': []}
+    size = 0
+    open_pipes = 2
+    deadline = time.time() + RUN_TIMEOUT
+    flushed = time.time()
+    while open_pipes:
+        if time.time() > deadline:
+            process.kill()
+            process.wait()
+            raise TimeoutExpired(cmd, RUN_TIMEOUT)
+        try:
+            name, line = lines.get(timeout=max(0.001, flushed + interval - time.time()))
+            if line is None:
+                open_pipes -= 1
+            else:
+                buffered[name].append(line)
+                size += len(line)
+        except Empty:
+            pass
+        if size >= chunk_size or (time.time() - flushed >= interval) or not open_pipes:
+            if size:
+                stream(''.join(buffered['stdout']), ''.join(buffered['stderr']))
+                buffered = {'stdout': [], 'stderr': []}
+                size = 0
+            flushed = time.time()
+    return CompletedProcess(cmd, process.wait(), '', '')
+
+
+def is_transient(client, err):
+    """
+    Return True if a provider error may succeed when retried. Providers can
+    tell with an is_transient(err) method, otherwise only connection errors
+    and timeouts are.
+    """
+    check = getattr(client, 'is_transient', None)
+    if check:
+        return check(err)
+    return isinstance(err, (ConnectionError, TimeoutError))
+
+
+def backoff(attempt, max_delay=None):
+    """Return a jittered exponential delay before retrying after attempt errors"""
+    if max_delay is None:
+        max_delay = float(getenv('SERA_MAX_DELAY', '20'))
+    return random.uniform(0, min(max_delay, 0.5 * 2 ** attempt))
 
 
 def remote(cmd, ctx):
-    watcher = ctx.obj['watcher']
     master = ctx.obj['master']
+    if ctx.obj.get('watchers') is not None:  # glob or group target
+        return aggregate(master.send_all(
+            ctx.obj['watchers'], cmd, ctx.params, ctx.obj['timeout']))
+    watcher = ctx.obj['watcher']
+    if ctx.obj.get('stream'):
+        return master.send_stream(
+            watcher.name, cmd, ctx.params, ctx.obj['watcher_key'], ctx.obj['stream'],
+            ctx.obj['timeout'])
     return master.send(
         watcher.name, cmd, ctx.params, ctx.obj['watcher_key'], ctx.obj['timeout'])
 
 
+def aggregate(replies):
+    """
+    Return a RemoteCommand reporting {name: RemoteCommand or None} replies with
+    watchers that gave identical output grouped together. The returncode is
+    the first non zero returncode, or 1 if a watcher didn't reply.
+    """
+    groups = OrderedDict()
+    for name, reply in replies.items():
+        if reply is None:
+            key = None
+        else:
+            key = (reply.returncode, reply.stdout or '', reply.stderr or '')
+        groups.setdefault(key, []).append(name)
+    lines = []
+    returncode = 0
+    for key, names in sorted(groups.items(), key=lambda group: -len(group[1])):
+        if key is None:
+            lines.append('%s (%i): no response' % (', '.join(names), len(names)))
+            returncode = returncode or 1
+            continue
+        code, stdout, stderr = key
+        lines.append('%s (%i): returncode %s' % (', '.join(names), len(names), code))
+        lines.extend('    ' + line for line in (stdout + stderr).splitlines())
+        returncode = returncode or code or 0
+    return RemoteCommand(returncode=returncode, stdout='\n'.join(lines), stderr='')
+
+
 class BaseEndpoint(object):
 
     def __init__(self, uid, url='', client=None, creator=False):
@@ -112,9 +263,22 @@ class BaseEndpoint(object):
 
 class Host(BaseEndpoint):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # replies awaited by correlation id, routed by whichever sending thread
+        # is polling the queue
+        self.replies = OrderedDict()  # correlation id: deque of RemoteCommands
+        self.replies_changed = Condition()
+        self.polling = False
+        # with a container of allowed public keys, messages from other senders
+        # are deleted unread and counted by sender key
+        self.allowed_clients = None
+        self.rejected = ExpiringDict(REJECTED_TTL, max_len=REJECTED_MAX_KEYS)
+        self.rejected_total = 0
+
     @classmethod
-    def get(cls, name, create=False, namespace=None):
-        client = get_client()(namespace=namespace)
+    def get(cls, name, create=False, namespace=None, **kwargs):
+        client = get_client()(namespace=namespace, **kwargs)
         url = client.get_endpoint(name)
         if not url and create:
             url = client.create_endpoint(name)
@@ -122,14 +286,64 @@ class Host(BaseEndpoint):
             return cls(name, url, client, creator=create)
         return
 
+    def list_endpoints(self):
+        """Return the names of the endpoints on the provider"""
+        return self.client.list_endpoints()
+
     def exchange_keys(self, name, timeout=DEFAULT_TIMEOUT):
         cmd = 'public_key %s' % getenv('SERA_CLIENT_PUBLIC_KEY', '')
-        remote = self.send(name, cmd)
+        remote = self.send(name, cmd, timeout=timeout)
         watcher_key = None
         if remote and remote.name.startswith('public_key'):
             watcher_key = remote.public_key
         return watcher_key
 
+    def exchange_keys_all(self, names, timeout=DEFAULT_TIMEOUT):
+        """Exchange keys with many watchers at once and return {name: public key}"""
+        cmd = 'public_key %s' % getenv('SERA_CLIENT_PUBLIC_KEY', '')
+        replies = self.send_all(OrderedDict((name, None) for name in names), cmd, timeout=timeout)
+        return OrderedDict(
+            (name, reply.public_key) for name, reply in replies.items() if reply)
+
+    def _pack(
+            self, cmd, params='', recipient_key=None, stdout='', stderr='', returncode=None,
+            seq=None, stream=False, correlation_id=None):
+        """Return a list of message bodies and attributes for a command"""
+        codec = ''
+        if recipient_key:  # encrypt
+            kwargs = {
+                'params': params, 'name': cmd,
+                'stdout': stdout, 'stderr': stderr, 'returncode': returncode}
+            if seq is not None:
+                kwargs['seq'] = seq
+            if stream:
+                kwargs['stream'] = True
+            data = json.dumps(kwargs).encode('utf-8')
+            compression = getenv('SERA_CODEC', 'zlib')
+            if compression in CODECS and len(data) >= COMPRESS_MIN_BYTES:
+                compressed = CODECS[compression][0](data)
+                if len(compressed) < len(data):
+                    data = compressed
+                    codec = compression
+            data = encrypt(data, recipient_key, getenv('SERA_CLIENT_PRIVATE_KEY'))
+        else:
+            data = cmd.encode('utf-8')
+        sender_key = key_to_bytes(getenv('SERA_CLIENT_PUBLIC_KEY', ''))
+        correlation_id = bytes.fromhex(correlation_id) if correlation_id else None
+        if len(data) <= FRAGMENT_BYTES:
+            return [(ENVELOPE_BODY, {'Envelope': envelope.pack(
+                data, sender_key, codec, correlation_id, bool(recipient_key))})]
+        # payloads larger than a message allows are sent as numbered fragments
+        fragment_id = uuid4().bytes
+        count = int(math.ceil(len(data) / FRAGMENT_BYTES))
+        logger.debug('Sending payload in %i fragments' % count)
+        return [
+            (ENVELOPE_BODY, {'Envelope': envelope.pack(
+                data[index*FRAGMENT_BYTES:(index+1)*FRAGMENT_BYTES],
+                sender_key, codec, correlation_id, bool(recipient_key),
+                fragment=(fragment_id, index, count))})
+            for index in range(count)]
+
     def send(
             self,
             name,
@@ -140,49 +354,356 @@ class Host(BaseEndpoint):
             await_response=True,
             stdout='',
             stderr='',
-            returncode=None):
-        payload = {}
-        if recipient_key:  # encrypt
-            kwargs = {
-                'params': params, 'name': cmd,
-                'stdout': stdout, 'stderr': stderr, 'returncode': returncode}
-            encrypted = encrypt(json.dumps(kwargs), recipient_key, getenv('SERA_CLIENT_PRIVATE_KEY'))
-            payload = {'Encrypted': encrypted}
-            cmd = 'decrypt %s' % getenv('SERA_CLIENT_PUBLIC_KEY')
+            returncode=None,
+            seq=None,
+            stream=False,
+            correlation_id=None):
+        """
+        Send a command and return the reply to it, or send a reply with the
+        correlation_id of the command it answers and return None.
+        """
         logger.debug('Host.client.send_message(%s, %s, ...)' % (name, str(cmd)))
-        self.client.send_message(name, json.dumps(cmd), payload)
         if await_response:
-            return self.receive(timeout)
+            correlation_id = self._expect()
+        try:
+            start = time.perf_counter()
+            try:
+                for body, payload in self._pack(
+                        cmd, params, recipient_key, stdout, stderr, returncode, seq, stream,
+                        correlation_id):
+                    self.client.send_message(name, body, payload)
+            except Exception:
+                metrics.inc('sera_errors_total', stage='send')
+                raise
+            metrics.observe('sera_send_seconds', time.perf_counter() - start)
+            if await_response:
+                return self._next_reply(correlation_id, timeout)
+        finally:
+            if await_response:
+                self._forget(correlation_id)
         return
 
+    def send_stream(self, name, cmd, params, recipient_key, callback, timeout=DEFAULT_TIMEOUT):
+        """
+        Send a command whose output the watcher streams back, calling
+        callback(stdout, stderr) with each chunk in order as it arrives, and
+        return the final RemoteCommand with the returncode. Chunks may arrive
+        out of order and are reassembled by sequence number. Timeout is the
+        longest wait for the next message; None is returned if it passes.
+        """
+        correlation_id = self._expect()
+        try:
+            return self._receive_stream(
+                name, cmd, params, recipient_key, callback, timeout, correlation_id)
+        finally:
+            self._forget(correlation_id)
+
+    def _receive_stream(self, name, cmd, params, recipient_key, callback, timeout, correlation_id):
+        self.send(
+            name, cmd, params, recipient_key, await_response=False, stream=True,
+            correlation_id=correlation_id)
+        chunks = {}
+        next_seq = 0
+        final = None
+        while not final or next_seq < final.seq:
+            reply = self._next_reply(correlation_id, timeout)
+            if not reply:
+                return
+            if reply.seq is None:
+                logger.debug('Ignoring unnumbered %s reply from %s' % (reply.name, reply.host))
+                continue
+            if reply.returncode is not None:
+                final = reply
+            elif reply.seq >= next_seq:
+                chunks[reply.seq] = reply
+            while next_seq in chunks:
+                chunk = chunks.pop(next_seq)
+                callback(chunk.stdout, chunk.stderr)
+                next_seq += 1
+        return final
+
+    def send_batch(self, commands, correlation_id=None):
+        """
+        Send (name, cmd, params, recipient_key) tuples without awaiting responses.
+
+        Commands are batched per recipient by the provider.
+        """
+        messages = []
+        for name, cmd, params, recipient_key in commands:
+            logger.debug('Host.client.send_message_batch(%s, %s, ...)' % (name, str(cmd)))
+            messages.extend(
+                (name,) + message for message in self._pack(
+                    cmd, params, recipient_key, correlation_id=correlation_id))
+        return self.client.send_message_batch(messages)
+
+    def send_all(self, targets, cmd, params='', timeout=DEFAULT_TIMEOUT):
+        """
+        Send a command to an ordered {name: recipient_key} of watchers in one
+        batch and return {name: RemoteCommand or None} with the first reply
+        from each watcher within timeout seconds of sending.
+        """
+        if timeout < 0:
+            timeout = DEFAULT_TIMEOUT
+        correlation_id = self._expect()
+        replies = OrderedDict((name, None) for name in targets)
+        pending = set(targets)
+        start = time.time()
+        try:
+            self.send_batch(
+                [(name, cmd, params, key) for name, key in targets.items()], correlation_id)
+            while pending:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    break
+                reply = self._next_reply(correlation_id, remaining)
+                if not reply:
+                    continue
+                sender = url_pattern.sub('-', reply.host or '')
+                if sender in pending:
+                    replies[sender] = reply
+                    pending.discard(sender)
+                else:
+                    logger.debug('Ignoring %s reply from %s' % (reply.name, reply.host))
+        finally:
+            self._forget(correlation_id)
+        return replies
+
+    def _expect(self):
+        """Return a new correlation id whose replies will be kept for _next_reply"""
+        correlation_id = uuid4().hex
+        with self.replies_changed:
+            self.replies[correlation_id] = deque()
+        return correlation_id
+
+    def _forget(self, correlation_id):
+        """Stop keeping replies to a correlation id; later ones are dropped as stale"""
+        with self.replies_changed:
+            self.replies.pop(correlation_id, None)
+
+    def _route(self, reply):
+        """
+        Keep a reply for the caller awaiting its correlation id. Replies without
+        one, from watchers that don't echo it, go to the longest waiting caller.
+        Call with replies_changed held.
+        """
+        correlation_id = reply.correlation_id
+        if correlation_id is None and self.replies:
+            correlation_id = next(iter(self.replies))
+        if correlation_id in self.replies:
+            self.replies[correlation_id].append(reply)
+            self.replies_changed.notify_all()
+        else:
+            logger.debug('Dropping stale %s reply from %s' % (reply.name, reply.host))
+
+    def _next_reply(self, correlation_id, timeout=-1):
+        """
+        Return the next reply to a correlation id, or None after timeout
+        seconds. Of the threads awaiting replies on this host one polls the
+        queue at a time and routes every reply to its caller.
+        """
+        start = time.time()
+        polled = False  # poll at least once, even with no timeout
+        while True:
+            with self.replies_changed:
+                while True:
+                    replies = self.replies.get(correlation_id)
+                    if replies:
+                        return replies.popleft()
+                    remaining = None
+                    if timeout > -1:
+                        remaining = max(0, timeout - (time.time() - start))
+                        if not remaining and polled:
+                            return
+                    if not self.polling:
+                        self.polling = True
+                        break
+                    if remaining == 0:
+                        return
+                    self.replies_changed.wait(remaining)
+            polled = True
+            reply = None
+            try:
+                reply = self.receive(-1 if remaining is None else remaining)
+            finally:
+                with self.replies_changed:
+                    self.polling = False
+                    if reply:
+                        self._route(reply)
+                    self.replies_changed.notify_all()
+
     def receive(self, timeout=-1):
-        delay = 0
-        max_delay = int(getenv('SERA_MAX_DELAY', '20'))
+        """
+        Long poll back to back until a message arrives or timeout seconds pass.
+
+        After SERA_IDLE_AFTER seconds without a message the host is idle and
+        sleeps SERA_IDLE_DELAY seconds between polls, trading latency for fewer
+        requests (no idle sleep by default). Only transient receive errors
+        back off and are retried; other errors are raised.
+        """
+        idle_after = float(getenv('SERA_IDLE_AFTER', '0'))
+        idle_delay = float(getenv('SERA_IDLE_DELAY', '0'))
+        errors = 0
         start = time.time()
         while True:
-            msg = self.client.receive_message(timeout)
+            wait = DEFAULT_TIMEOUT
+            if timeout > -1:
+                wait = int(math.ceil(max(0, min(wait, timeout - (time.time() - start)))))
+            try:
+                msg = self.client.receive_message(wait)
+                errors = 0
+            except Exception as err:
+                metrics.inc('sera_errors_total', stage='receive')
+                if not is_transient(self.client, err):
+                    raise
+                errors += 1
+                delay = backoff(errors)
+                logger.warning('%s receiving on %s, retrying in %.1fs' % (
+                    err.__class__.__name__, self.uid, delay))
+                logger.debug(str(err))
+                time.sleep(delay)
+                msg = None
+            else:
+                metrics.inc('sera_receives_total', result='message' if msg else 'empty')
+                if msg and msg.timestamp:
+                    metrics.observe('sera_queue_wait_seconds', time.time() - msg.timestamp / 1000)
+            if msg and not self._preauthorize(msg):
+                if timeout > -1 and time.time() - start >= timeout:
+                    return
+                continue
             if msg:
+                msg = self._reassemble(msg)
+                if not msg:  # pick up the remaining fragments before timing out
+                    continue
                 break
             duration = time.time() - start
-            if timeout > -1 and duration > timeout:
+            if timeout > -1 and duration >= timeout:
                 return
+            if idle_delay and duration > idle_after:
+                time.sleep(idle_delay)
+
+        return self._unpack(msg)
+
+    def _sender_key(self, msg):
+        """Return the sender public key of a message from its envelope header or body"""
+        data = getattr(msg, 'envelope', None)
+        try:
+            if data:
+                return key_from_bytes(envelope.sender_key(data))
+            if ' ' in msg.body:
+                return json.loads(msg.body).split(' ')[1]
+        except (ValueError, AttributeError, IndexError, struct.error):
+            pass
+        return
 
-            # limit the polling on queues to an acceptable threshold
-            time.sleep(delay)
-            if delay < max_delay:
-                delay += 1
+    def _preauthorize(self, msg):
+        """
+        Return True if a message is from an allowed client, or if any client is
+        allowed. Other messages are counted by sender and dropped before any
+        decryption, so a flood of them costs no more than receiving it. They
+        aren't deleted, which a watcher may not be allowed to do, and stay
+        invisible until they expire like every received message.
+        """
+        if self.allowed_clients is None:
+            return True
+        senders_key = self._sender_key(msg)
+        if senders_key in self.allowed_clients:
+            return True
+        count = self.rejected[senders_key] = self.rejected.get(senders_key, 0) + 1
+        self.rejected_total += 1
+        metrics.inc('sera_rejected_total')
+        if not count & (count - 1):  # log the 1st, 2nd, 4th, 8th... rejection
+            logger.warning('Rejected %i message(s) from client public key %s' % (
+                count, senders_key))
+        return False
+
+    def _reassemble(self, msg):
+        """
+        Keep a received fragment and return the message with the whole payload
+        once every fragment has arrived, otherwise None. Fragments out of range
+        of their count, or repeated, are dropped. Other messages are returned as
+        they are.
+        """
+        data = getattr(msg, 'envelope', None)
+        if not data or not envelope.is_fragment(data):
+            return msg
+        try:
+            env = envelope.unpack(data)
+        except (ValueError, struct.error):
+            return msg  # logged by _unpack
+        fragment_id = env.fragment_id.hex()
+        index, count = env.fragment_index, env.fragment_count
+        with FRAGMENTS_LOCK:
+            expected, fragments = FRAGMENTS.get(fragment_id) or (count, {})
+            if count != expected or not 0 <= index < count:
+                logger.warning('Dropping fragment %i of %i of %s from %s' % (
+                    index, count, fragment_id, msg.sender))
+                return
+            if index in fragments:
+                logger.debug('Dropping repeated fragment %i of %s' % (index, fragment_id))
+                return
+            fragments[index] = bytes(env.payload)
+            if len(fragments) < count:
+                FRAGMENTS[fragment_id] = (count, fragments)
+                return
+            FRAGMENTS.pop(fragment_id)
+        msg.envelope = envelope.pack(
+            b''.join(fragments[index] for index in range(count)),
+            env.sender_key, env.codec, env.correlation_id, env.flags & envelope.ENCRYPTED)
+        return msg
+
+    def _unpack(self, msg):
+        """Return a RemoteCommand from a received message"""
+        data = getattr(msg, 'envelope', None)
+        if not data:
+            return self._unpack_legacy(msg)
+        from nacl.exceptions import CryptoError
+        try:
+            env = envelope.unpack(data)
+            senders_key = key_from_bytes(env.sender_key)
+            correlation_id = env.correlation_id.hex() if env.correlation_id else None
+            if not env.flags & envelope.ENCRYPTED:
+                name = bytes(env.payload).decode('utf-8').split(' ')[0]
+                logger.debug(
+                    'RemoteCommand(host=%s, public_key=%s, name=%s, ...)' %
+                    (msg.sender, str(senders_key), name))
+                return RemoteCommand(
+                    host=msg.sender, name=name, public_key=senders_key,
+                    correlation_id=correlation_id)
+            start = time.perf_counter()
+            data = decrypt(
+                bytes(env.payload), senders_key, getenv('SERA_CLIENT_PRIVATE_KEY'),
+                encoding=None)
+            metrics.observe('sera_decrypt_seconds', time.perf_counter() - start)
+            if env.codec:
+                data = CODECS[env.codec][1](data)
+            kwargs = json.loads(data.decode('utf-8'))
+        except (ValueError, struct.error, KeyError, CryptoError, zlib.error) as err:
+            metrics.inc('sera_errors_total', stage='unpack')
+            logger.warning('Failed to unpack msg')
+            logger.warning(msg)
+            logger.warning(str(err))
+            return
+        logger.debug(
+            'RemoteCommand(host=%s, public_key=%s, name=%s' %
+            (msg.sender, str(senders_key), kwargs.get('name')))
+        return RemoteCommand(
+            host=msg.sender, public_key=senders_key, correlation_id=correlation_id, **kwargs)
 
+    def _unpack_legacy(self, msg):
+        """Return a RemoteCommand from a message in the json body format"""
         if ' ' in msg.body:
             body, senders_key = json.loads(msg.body).split(' ')
         else:
             body = msg.body
             senders_key = None
         if body == 'decrypt':
+            from nacl.exceptions import CryptoError
             try:
                 kwargs = json.loads(
                     decrypt(msg.encrypted, senders_key, getenv('SERA_CLIENT_PRIVATE_KEY')))
             # if the message is unencrypted it will raise a ValueError trying to extract a NONCE
             except (ValueError, CryptoError) as err:
+                metrics.inc('sera_errors_total', stage='unpack')
                 logger.warning('Failed to decrypt msg')
                 logger.warning(msg)
                 logger.warning(str(err))
@@ -1,22 +1,26 @@
-from base64 import urlsafe_b64encode
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from collections import OrderedDict
+from fnmatch import fnmatchcase
+from functools import lru_cache
 from os import getenv, getuid
 import logging
 from pwd import getpwuid
 from pathlib import Path
+import re
 from shutil import chown
 import socket
 import sys
+import time
 
 
 from dotenv.main import set_key, parse_dotenv
 from dotenv import load_dotenv
 
-from nacl.public import PrivateKey, PublicKey, Box
-from nacl.encoding import URLSafeBase64Encoder
-from nacl.utils import random
-
-ALLOWED_CLIENTS = []
+# masters use their url safe public key as their queue name
+CLIENT_NAME = re.compile('^[a-zA-Z0-9_-]{43}$')
+# watcher names are url safe, so globs are made url safe apart from their wildcards
+target_pattern = re.compile('[^a-zA-Z0-9_*?!\\[\\]-]+')
+BOX_CACHE_SIZE = int(getenv('SERA_BOX_CACHE_SIZE', '128'))
 
 
 def get_default_watcher():
@@ -26,6 +30,19 @@ def get_default_watcher():
     return ''
 
 
+def get_entry_points(group):
+    """Return the installed entry points for a group without importing them"""
+    try:
+        from importlib import metadata
+    except ImportError:  # python < 3.8
+        import pkg_resources
+        return list(pkg_resources.iter_entry_points(group=group))
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        return list(entry_points.select(group=group))
+    return list(entry_points.get(group, []))
+
+
 def get_ip_address(target_ip):
     soc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     soc.connect((target_ip, 22))
@@ -94,32 +111,123 @@ def loadenv(base_path):
     return envpath, False
 
 
+def read_allowed_clients(path):
+    """Return the client public keys in a known_clients file, one per line"""
+    if not path.exists():
+        return []
+    with path.open() as file:
+        return [line.strip() for line in file if line.strip()]
+
+
 def get_allowed_clients(path, client=None):
-    global ALLOWED_CLIENTS
     if client:
         return [client]
-    elif ALLOWED_CLIENTS:
-        return ALLOWED_CLIENTS
-    if path.exists():
-        with path.open() as file:
-            ALLOWED_CLIENTS = [line.rstrip('\n') for line in file.readlines() if line.rstrip('\n')]
-    return ALLOWED_CLIENTS
+    return read_allowed_clients(path)
+
 
+def write_allowed_clients(path, clients):
+    """Replace a known_clients file atomically so a watcher never reads half of it"""
+    tmp_path = path.with_name(path.name + '.tmp')
+    with tmp_path.open(mode='w') as file:
+        file.writelines('%s\n' % client for client in clients)
+    tmp_path.replace(path)
 
-def get_watcher_key(path, name):
+
+class AllowedClients(object):
+    """
+    The set of allowed client public keys in a known_clients file, or just
+    the one client given. The file is reloaded when its modification time or
+    size changes, checked at most every SERA_CLIENTS_CHECK_INTERVAL seconds,
+    so keys added or revoked take effect without restarting a watcher.
+    """
+
+    def __init__(self, path, client=None, check_interval=None):
+        self.path = path
+        self.client = client
+        if check_interval is None:
+            check_interval = float(getenv('SERA_CLIENTS_CHECK_INTERVAL', '1'))
+        self.check_interval = check_interval
+        self.checked = None
+        self.version = None  # (mtime, size, inode) of the file last read
+        self.clients = frozenset([client] if client else [])
+
+    def refresh(self):
+        """Reload the clients if the file changed, returning True if it was read"""
+        if self.client:
+            return False
+        now = time.monotonic()
+        if self.checked is not None and now - self.checked < self.check_interval:
+            return False
+        self.checked = now
+        try:
+            stat = self.path.stat()
+            version = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except FileNotFoundError:
+            version = None
+        if version == self.version and self.version is not None:
+            return False
+        self.version = version
+        self.clients = frozenset(read_allowed_clients(self.path))
+        return True
+
+    def __contains__(self, public_key):
+        self.refresh()
+        return public_key in self.clients
+
+    def __iter__(self):
+        self.refresh()
+        return iter(self.clients)
+
+    def __len__(self):
+        self.refresh()
+        return len(self.clients)
+
+
+def is_target_pattern(watcher):
+    """Return True if a watcher option is a glob or an @group rather than one watcher"""
+    return watcher.startswith('@') or any(char in watcher for char in '*?[')
+
+
+def get_group(path, group):
+    """Return the watcher names or globs of a group in a groups file of name="members" lines"""
     if not path.exists():
-        path.touch(mode=0o644)
-        return
-    dotenv_as_dict = OrderedDict(parse_dotenv(str(path)))
-    return dotenv_as_dict.get(name)
+        return []
+    groups = OrderedDict(parse_dotenv(str(path)))
+    return (groups.get(group) or '').replace(',', ' ').split()
+
+
+def resolve_targets(target, known_watchers=(), endpoints=(), groups_path=None):
+    """
+    Return the sorted watcher names matching a glob or @group target from the
+    known watcher names and the endpoint names that exist on the provider.
+    """
+    if target.startswith('@'):
+        patterns = get_group(groups_path, target[1:]) if groups_path else []
+    else:
+        patterns = [target]
+    names = set(known_watchers) | set(
+        name for name in endpoints if not CLIENT_NAME.match(name))
+    matched = set()
+    for pattern in patterns:
+        pattern = target_pattern.sub('-', pattern)
+        if is_target_pattern(pattern):
+            matched.update(name for name in names if fnmatchcase(name, pattern))
+        else:  # a named member doesn't need to be known yet
+            matched.add(pattern)
+    return sorted(matched)
+
+
+def set_owner(path):
+    """Give a file created with sudo to the default user, except the system env"""
+    default_user = get_default_user()
+    if Path('/etc', 'sera', 'env') != path and getpwuid(getuid()).pw_name != default_user:
+        chown(str(path), user=default_user)
 
 
 def set_env_key(path, key, value):
     if not path.exists():
         path.touch(mode=0o644)
-        default_user = get_default_user()
-        if Path('/etc', 'sera', 'env') != path and getpwuid(getuid()).pw_name != default_user:
-            chown(str(path), user=default_user)
+        set_owner(path)
     return set_key(str(path), key, value, quote_mode="auto")[0]
 
 
@@ -131,6 +239,8 @@ def keygen(path, write=True):
             if Path('/etc', 'sera', 'env') != path and getpwuid(getuid()).pw_name != default_user:
                 chown(str(path), user=default_user)
 
+    from nacl.public import PrivateKey
+
     private_key = PrivateKey.generate()
     public_key = private_key.public_key
     ascii_sk = urlsafe_b64encode(bytes(private_key)).decode('ascii')
@@ -152,24 +262,52 @@ def keygen(path, write=True):
     return ascii_pk, ascii_sk
 
 
+@lru_cache(maxsize=BOX_CACHE_SIZE)
+def key_to_bytes(public_key):
+    """Return the raw 32 bytes of a url safe base64 public key, or zeros for none"""
+    if not public_key:
+        return bytes(32)
+    return urlsafe_b64decode(public_key)
+
+
+@lru_cache(maxsize=BOX_CACHE_SIZE)
+def key_from_bytes(raw_key):
+    """Return the url safe base64 public key of 32 raw bytes, or None for zeros"""
+    if not any(raw_key):
+        return
+    return urlsafe_b64encode(raw_key).decode('ascii')
+
+
+@lru_cache(maxsize=BOX_CACHE_SIZE)
+def get_box(private_key, public_key):
+    """Return a Box for a private key and peer public key with the shared key precomputed"""
+    from nacl.public import PrivateKey, PublicKey, Box
+    from nacl.encoding import URLSafeBase64Encoder
+
+    skey = PrivateKey(private_key, URLSafeBase64Encoder)
+    pkey = PublicKey(public_key, URLSafeBase64Encoder)
+    return Box(skey, pkey)
+
+
 def encrypt(msg, recipient_key, private_key='', encoding='utf-8'):
     """Encrypt a message with the given recipient public key"""
+    from nacl.public import Box
+    from nacl.utils import random
 
     private_key = private_key or getenv('SERA_CLIENT_PRIVATE_KEY')
-    skey = PrivateKey(private_key, URLSafeBase64Encoder)
-    rkey = PublicKey(recipient_key, URLSafeBase64Encoder)
-    msg = bytes(msg, encoding)
-    box = Box(skey, rkey)
+    if isinstance(msg, str):
+        msg = bytes(msg, encoding)
+    box = get_box(private_key, recipient_key)
     nonce = random(Box.NONCE_SIZE)
     return box.encrypt(msg, nonce)
 
 
 def decrypt(msg, sender_key, private_key='', encoding='utf-8'):
-    """Decrypt a message with the given private key or SERA_CLIENT_PRIVATE_KEY"""
+    """
+    Decrypt a message with the given private key or SERA_CLIENT_PRIVATE_KEY,
+    returning bytes if encoding is None
+    """
     private_key = private_key or getenv('SERA_CLIENT_PRIVATE_KEY')
-    skey = PrivateKey(private_key, URLSafeBase64Encoder)
-    pkey = PublicKey(sender_key, URLSafeBase64Encoder)
-    box = Box(skey, pkey)
-    return box.decrypt(msg).decode('utf-8')
-
-
+    box = get_box(private_key, sender_key)
+    plaintext = box.decrypt(msg)
+    return plaintext.decode(encoding) if encoding else plaintext
@@ -25,3 +25,10 @@ class TestAWSProvider(object):
         msg = master.client.receive_message()
         assert type(msg) == Message
         assert msg.body == 'test'
+
+    def test_receive_message_batch(self, master):
+        master.client.MaxNumberOfMessages = 10
+        master.client.send_message(master.name, msg='test2')
+        received = [master.client.receive_message(), master.client.receive_message()]
+        assert sorted(msg.body for msg in received) == ['test', 'test2']
+        assert not master.client.prefetched
@@ -45,3 +45,9 @@ class TestHost(object):
         resp = host.receive(timeout=0)
         assert pkey == resp.public_key
         assert cmd == resp.name
+
+    def test_send_batch(self, host):
+        pkey = getenv('SERA_CLIENT_PUBLIC_KEY')
+        host.send_batch([(host.name, 'echo', {}, pkey)] * 12)
+        names = [host.receive(timeout=0).name for _ in range(12)]
+        assert names == ['echo'] * 12
@@ -1,6 +1,34 @@
 import pytest
 from pathlib import Path, PosixPath
 
+from sera.providers import memory
+
+SECRET_KEY1 = 'mWxBUK-aDh6qZRhdFROhTyiQVdk2pZwqwq-hq4-5elw='
+PUBLIC_KEY1 = 'b1ZfANMSxRJwqtkJK4DwLoL7wCl8-Rjl8aPEc-co4TU='
+
+
+@pytest.fixture
+def keys(monkeypatch):
+    """Use the test key pair as the client keys"""
+    monkeypatch.setenv('SERA_CLIENT_PRIVATE_KEY', SECRET_KEY1)
+    monkeypatch.setenv('SERA_CLIENT_PUBLIC_KEY', PUBLIC_KEY1)
+
+
+@pytest.fixture
+def client(keys, monkeypatch):
+    """Send and receive through the in-memory provider"""
+    monkeypatch.setenv('SERA_CLIENT', 'sera.providers.memory.MemoryProvider')
+    yield
+    memory.QUEUES.clear()
+
+
+@pytest.fixture
+def spool(keys, monkeypatch, tmpdir):
+    """Send and receive through a local spool in a temporary directory"""
+    monkeypatch.setenv('SERA_CLIENT', 'sera.providers.local.LocalProvider')
+    monkeypatch.setenv('SERA_SPOOL_PATH', str(tmpdir))
+    return tmpdir
+
 
 @pytest.fixture
 def dotenv_file(monkeypatch):
@@ -0,0 +1,103 @@
+from collections import OrderedDict
+import threading
+import time
+
+import pytest
+
+from conftest import PUBLIC_KEY1
+from sera.commands.agent import connect, serve
+from sera.sera import DEFAULT_TIMEOUT, Host
+
+
+@pytest.fixture
+def agent(client, monkeypatch, tmp_path):
+    monkeypatch.delenv('SERA_AGENT_SOCKET', raising=False)
+    server = serve(tmp_path / 'agent.sock', Host.get('master', create=True))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield tmp_path
+    server.shutdown()
+    server.server_close()
+
+
+def reply(watcher, chunks=()):
+    cmd = watcher.receive(timeout=5)
+    seq = 0
+    for seq, chunk in enumerate(chunks):
+        watcher.send(
+            cmd.host, cmd.name, stdout=chunk, recipient_key=PUBLIC_KEY1, seq=seq,
+            correlation_id=cmd.correlation_id, await_response=False)
+    watcher.send(
+        cmd.host, cmd.name, stdout=cmd.params['n'], returncode=0,
+        recipient_key=PUBLIC_KEY1, seq=seq + 1 if chunks else None,
+        correlation_id=cmd.correlation_id, await_response=False)
+
+
+def test_no_agent(tmp_path):
+    assert connect(tmp_path) is None
+
+
+def test_agent_identity(agent, monkeypatch):
+    monkeypatch.setenv('SERA_NAMESPACE', 'other')
+    assert connect(agent) is None
+
+
+def test_agent_send(agent):
+    watcher = Host.get('watcher', create=True)
+    thread = threading.Thread(target=reply, args=(watcher,))
+    thread.start()
+    master = connect(agent)
+    response = master.send('watcher', 'echo', {'n': '1'}, PUBLIC_KEY1, 5)
+    thread.join()
+    assert response.stdout == '1'
+    assert response.returncode == 0
+    assert response.host == 'watcher'
+
+
+def test_agent_send_stream(agent):
+    watcher = Host.get('watcher', create=True)
+    thread = threading.Thread(target=reply, args=(watcher, ['a', 'b']))
+    thread.start()
+    chunks = []
+    master = connect(agent)
+    response = master.send_stream(
+        'watcher', 'echo', {'n': '1'}, PUBLIC_KEY1,
+        lambda stdout, stderr: chunks.append(stdout), 5)
+    thread.join()
+    assert chunks == ['a', 'b']
+    assert response.stdout == '1'
+
+
+def test_agent_send_all(agent):
+    watchers = [Host.get(name, create=True) for name in ['web1', 'web2']]
+    threads = [threading.Thread(target=reply, args=(watcher,)) for watcher in watchers]
+    for thread in threads:
+        thread.start()
+    master = connect(agent)
+    replies = master.send_all(
+        OrderedDict([('web1', PUBLIC_KEY1), ('web2', PUBLIC_KEY1)]), 'echo', {'n': '1'}, 5)
+    for thread in threads:
+        thread.join()
+    assert list(replies) == ['web1', 'web2']
+    assert [reply.stdout for reply in replies.values()] == ['1', '1']
+    assert sorted(master.list_endpoints()) == ['master', 'web1', 'web2']
+
+
+def test_agent_default_timeouts(agent, monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        Host, 'exchange_keys', lambda self, name, timeout: calls.append((name, timeout)))
+    monkeypatch.setattr(
+        Host, 'exchange_keys_all',
+        lambda self, names, timeout: calls.append((names, timeout)) or {})
+    master = connect(agent)
+    master.exchange_keys('watcher')
+    master.exchange_keys_all(['web1'])
+    assert calls == [('watcher', DEFAULT_TIMEOUT), (['web1'], DEFAULT_TIMEOUT)]
+
+
+def test_agent_exchange_keys_times_out(agent):
+    Host.get('watcher', create=True)  # never answers
+    start = time.time()
+    assert connect(agent).exchange_keys('watcher', 1) is None
+    assert time.time() - start < 5
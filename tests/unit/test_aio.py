@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+
+from conftest import PUBLIC_KEY1
+from sera import aio
+
+
+def run(coro):
+    """Run a coroutine on a new event loop, like asyncio.run of python 3.7+"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        # cancel pollers still waiting on a receive
+        all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks  # < 3.7
+        tasks = [task for task in all_tasks(loop) if not task.done()]
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+
+def test_send_to_many(client):
+
+    async def reply(name):
+        watcher = await aio.Host.get(name, create=True)
+        cmd = await watcher.receive(timeout=5)
+        await watcher.send(
+            cmd.host, cmd.name, stdout=name, recipient_key=PUBLIC_KEY1, await_response=False)
+
+    async def send_all(names):
+        master = await aio.Host.get('master', create=True)
+        for name in names:
+            await master.client.create_endpoint(name)
+        replies = [asyncio.ensure_future(reply(name)) for name in names]
+        responses = await asyncio.gather(*[
+            master.send(name, 'echo', {}, PUBLIC_KEY1, timeout=5) for name in names])
+        await asyncio.gather(*replies)
+        return responses
+
+    names = ['watcher-%i' % i for i in range(5)]
+    responses = run(send_all(names))
+    assert [resp.stdout for resp in responses] == names
+
+
+def test_replies_routed_by_correlation_id(client):
+
+    async def watch(watcher, count):
+        cmds = [await watcher.receive(timeout=5) for i in range(count)]
+        for cmd in reversed(cmds):  # reply out of order
+            await watcher.send(
+                cmd.host, cmd.name, stdout=cmd.params['n'], recipient_key=PUBLIC_KEY1,
+                correlation_id=cmd.correlation_id, await_response=False)
+
+    async def pipeline():
+        master = await aio.Host.get('master', create=True)
+        watcher = await aio.Host.get('watcher', create=True)
+        replies = asyncio.ensure_future(watch(watcher, 3))
+        responses = await asyncio.gather(*[
+            master.send('watcher', 'echo', {'n': str(n)}, PUBLIC_KEY1, timeout=5)
+            for n in range(3)])
+        await replies
+        return responses
+
+    responses = run(pipeline())
+    assert [resp.stdout for resp in responses] == ['0', '1', '2']
+
+
+def test_exchange_keys(client):
+
+    async def exchange():
+        master = await aio.Host.get('master', create=True)
+        watcher = await aio.Host.get('watcher', create=True)
+
+        async def reply():
+            cmd = await watcher.receive(timeout=5)
+            assert cmd.name == 'public_key'
+            await watcher.send(
+                cmd.host, 'public_key %s' % PUBLIC_KEY1,
+                correlation_id=cmd.correlation_id, await_response=False)
+        replied = asyncio.ensure_future(reply())
+        watcher_key = await master.exchange_keys('watcher', timeout=5)
+        await replied
+        return watcher_key
+
+    assert run(exchange()) == PUBLIC_KEY1
+
+
+def test_send_times_out(client, monkeypatch):
+    monkeypatch.setattr(aio, 'DEFAULT_TIMEOUT', 0.1)  # each poll of the reply queue
+
+    async def send():
+        master = await aio.Host.get('master', create=True)
+        await master.client.create_endpoint('watcher')  # never answers
+        response = await master.send('watcher', 'echo', {}, PUBLIC_KEY1, timeout=0.1)
+        await asyncio.wait_for(master.poller, 1)  # stops once nothing is awaited
+        return response
+
+    assert run(send()) is None
+
+
+def test_unclaimed_reply_received_later(client):
+
+    async def receive():
+        master = await aio.Host.get('master', create=True)
+        web1 = await aio.Host.get('web1', create=True)
+        web2 = await aio.Host.get('web2', create=True)
+        await web1.send('master', 'first', await_response=False)
+        await web2.send('master', 'second', await_response=False)
+        second = await master.receive(timeout=5, sender='web2')
+        assert [cmd.name for cmd in master.unclaimed] == ['first']
+        first = await master.receive(timeout=0, sender='web1')
+        return first, second
+
+    first, second = run(receive())
+    assert [first.name, second.name] == ['first', 'second']
+
+
+def test_send_batch(client):
+
+    async def send_batch(names):
+        master = await aio.Host.get('master', create=True)
+        watchers = [await aio.Host.get(name, create=True) for name in names]
+        await master.send_batch([(name, 'echo', {}, PUBLIC_KEY1) for name in names])
+        return [await watcher.receive(timeout=5) for watcher in watchers]
+
+    cmds = run(send_batch(['web1', 'web2']))
+    assert [(cmd.host, cmd.name) for cmd in cmds] == [('master', 'echo')] * 2
+
+
+
+def test_permanent_error_fails_waiters(client, monkeypatch):
+
+    def denied(timeout=0):
+        raise PermissionError('denied')
+
+    async def receive():
+        host = await aio.Host.get('watcher', create=True)
+        provider = host.client.provider
+        monkeypatch.setattr(provider, 'receive_message', denied)
+        return await host.receive()
+
+    with pytest.raises(PermissionError):
+        run(receive())
\ No newline at end of file
@@ -0,0 +1,45 @@
+from click.testing import CliRunner
+
+from sera.commands.addrevoke import add, revoke
+from sera.utils import AllowedClients, read_allowed_clients
+
+
+def test_reload_on_change(tmp_path):
+    path = tmp_path / 'known_clients'
+    clients = AllowedClients(path, check_interval=0)
+    assert '123' not in clients
+    path.write_text('123\n456\n')
+    assert '123' in clients
+    assert sorted(clients) == ['123', '456']
+    path.write_text('456\n')
+    assert '123' not in clients
+    assert not clients.refresh()  # unchanged
+
+
+def test_check_interval(tmp_path):
+    path = tmp_path / 'known_clients'
+    path.write_text('123\n')
+    clients = AllowedClients(path, check_interval=60)
+    assert '123' in clients
+    path.write_text('456\n')
+    assert '456' not in clients  # not checked again yet
+
+
+def test_single_client(tmp_path):
+    path = tmp_path / 'known_clients'
+    path.write_text('123\n')
+    clients = AllowedClients(path, client='456', check_interval=0)
+    assert '456' in clients
+    assert '123' not in clients
+
+
+def test_add_revoke(tmp_path):
+    path = tmp_path / 'known_clients'
+    path.write_text('123\n')
+    obj = {'local': True, 'known_clients': path}
+    runner = CliRunner()
+    assert runner.invoke(add, ['456'], obj=obj).exit_code == 0
+    assert runner.invoke(add, ['456'], obj=obj).exit_code == 0
+    assert read_allowed_clients(path) == ['123', '456']
+    assert runner.invoke(revoke, ['123'], obj=obj).exit_code == 0
+    assert read_allowed_clients(path) == ['456']
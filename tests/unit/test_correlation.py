@@ -0,0 +1,48 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import PUBLIC_KEY1
+from sera.sera import Host
+
+
+def reply_all(watcher, count, correlate=True):
+    """Answer count commands in reverse order"""
+    cmds = [watcher.receive(timeout=5) for i in range(count)]
+    for cmd in reversed(cmds):
+        watcher.send(
+            cmd.host, cmd.name, stdout=cmd.params['n'], recipient_key=PUBLIC_KEY1,
+            correlation_id=cmd.correlation_id if correlate else None,
+            await_response=False)
+
+
+def test_concurrent_sends(client):
+    master = Host.get('master', create=True)
+    watcher = Host.get('watcher', create=True)
+    with ThreadPoolExecutor(max_workers=9) as pool:
+        responses = [
+            pool.submit(master.send, 'watcher', 'echo', {'n': str(n)}, PUBLIC_KEY1, timeout=5)
+            for n in range(8)]
+        pool.submit(reply_all, watcher, 8).result()
+        assert [resp.result().stdout for resp in responses] == [str(n) for n in range(8)]
+    assert not master.replies
+
+
+def test_stale_reply_dropped(client):
+    master = Host.get('master', create=True)
+    watcher = Host.get('watcher', create=True)
+    assert master.send('watcher', 'echo', {'n': '0'}, PUBLIC_KEY1, timeout=0) is None
+    reply_all(watcher, 1)  # too late
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        response = pool.submit(
+            master.send, 'watcher', 'echo', {'n': '1'}, PUBLIC_KEY1, timeout=5)
+        reply_all(watcher, 1)
+        assert response.result().stdout == '1'
+
+
+def test_uncorrelated_reply(client):
+    master = Host.get('master', create=True)
+    watcher = Host.get('watcher', create=True)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        response = pool.submit(
+            master.send, 'watcher', 'echo', {'n': '0'}, PUBLIC_KEY1, timeout=5)
+        reply_all(watcher, 1, correlate=False)
+        assert response.result().stdout == '0'
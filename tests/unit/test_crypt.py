@@ -0,0 +1,70 @@
+import errno
+from hashlib import sha256
+
+from nacl.encoding import Base64Encoder
+from nacl.secret import SecretBox
+from nacl.utils import random
+import pytest
+
+from sera.commands import crypt
+from sera.commands.crypt import apply_crypto
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_apply_crypto(tmpdir, jobs):
+    for i in range(10):
+        tmpdir.join('file%i.txt' % i).write('content %i' % i)
+    apply_crypto(b'password', False, str(tmpdir), '*', jobs=jobs)
+    assert len(tmpdir.listdir('*.nacl')) == 10
+    for file in tmpdir.listdir('*.txt'):
+        file.remove()
+    apply_crypto(b'password', False, str(tmpdir), '*.nacl', command='decrypt', jobs=jobs)
+    assert sorted(file.read() for file in tmpdir.listdir('*.txt')) == [
+        'content %i' % i for i in range(10)]
+
+
+def test_apply_crypto_wrong_password(tmpdir, capsys):
+    tmpdir.join('file.txt').write('content')
+    apply_crypto(b'password', False, str(tmpdir), '*.txt')
+    apply_crypto(b'wrong', False, str(tmpdir), '*.nacl', command='decrypt', jobs=2)
+    assert 'Error: ' in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_apply_crypto_unreadable_file(tmpdir, monkeypatch, capsys, jobs):
+    for name in ['a.txt', 'unreadable.txt', 'c.txt']:
+        tmpdir.join(name).write('content')
+    tmpdir.join('unreadable.txt').chmod(0)
+    encrypt_stream = crypt.encrypt_stream
+
+    def failing_encrypt_stream(box, infile, outfile, chunk_size=None):
+        if infile.name.endswith('unreadable.txt'):  # root may read it regardless
+            outfile.write(b'partial')
+            raise PermissionError(errno.EACCES, 'Permission denied', infile.name)
+        encrypt_stream(box, infile, outfile, chunk_size)
+    monkeypatch.setattr(crypt, 'encrypt_stream', failing_encrypt_stream)
+    apply_crypto(b'password', False, str(tmpdir), '*.txt', jobs=jobs)
+    assert sorted(file.basename for file in tmpdir.listdir()) == [
+        'a.txt', 'a.txt.nacl', 'c.txt', 'c.txt.nacl', 'unreadable.txt']
+    err = capsys.readouterr().err
+    assert 'Warning: [Errno 13] Permission denied' in err
+    assert 'on 1 out of 3 files' in err
+
+
+def test_decrypt_legacy_format(tmpdir):
+    box = SecretBox(sha256(b'password').digest())
+    tmpdir.join('file.txt.nacl').write_binary(
+        box.encrypt(b'content', random(SecretBox.NONCE_SIZE), Base64Encoder))
+    apply_crypto(b'password', False, str(tmpdir), '*.nacl', command='decrypt')
+    assert tmpdir.join('file.txt').read() == 'content'
+
+
+def test_decrypt_truncated(tmpdir, monkeypatch):
+    monkeypatch.setattr('sera.commands.crypt.CHUNK_SIZE', 16)
+    tmpdir.join('file.txt').write('x' * 100)
+    apply_crypto(b'password', False, str(tmpdir), '*.txt')
+    tmpdir.join('file.txt').remove()
+    encrypted = tmpdir.join('file.txt.nacl')
+    encrypted.write_binary(encrypted.read_binary()[:-32])
+    apply_crypto(b'password', False, str(tmpdir), '*.nacl', command='decrypt')
+    assert tmpdir.listdir() == [encrypted]
@@ -0,0 +1,158 @@
+from base64 import b64encode
+import os
+
+import pytest
+
+from conftest import PUBLIC_KEY1
+from sera import envelope, sera
+from sera.sera import Host
+from sera.utils import encrypt
+
+
+def test_pack_unpack():
+    data = envelope.pack(b'payload', b'k' * 32, 'zlib', b'c' * 16)
+    env = envelope.unpack(data)
+    assert env.flags == envelope.ENCRYPTED
+    assert env.codec == 'zlib'
+    assert env.sender_key == b'k' * 32
+    assert env.correlation_id == b'c' * 16
+    assert env.fragment_count == 1
+    assert env.payload == b'payload'
+    assert env.payload.obj is data  # not copied
+
+    env = envelope.unpack(envelope.pack(
+        b'', bytes(32), encrypted=False, fragment=(b'f' * 16, 2, 3)))
+    assert env.flags == envelope.FRAGMENTED
+    assert env.correlation_id is None
+    assert (env.fragment_id, env.fragment_index, env.fragment_count) == (b'f' * 16, 2, 3)
+
+
+def test_unpack_malformed():
+    with pytest.raises(ValueError):
+        envelope.unpack(b'{"name": "echo"}')
+    data = bytearray(envelope.pack(b'', bytes(32)))
+    data[2] = 99
+    with pytest.raises(ValueError):
+        envelope.unpack(bytes(data))
+
+
+def test_send_receive(client):
+    host = Host.get('master', create=True)
+    [(body, payload)] = host._pack(
+        'echo', stdout='hi', recipient_key=PUBLIC_KEY1, correlation_id='ab' * 16)
+    env = envelope.unpack(payload['Envelope'])
+    assert not env.codec
+    host.client.send_message('master', body, payload)
+    reply = host.receive(0)
+    assert (reply.name, reply.stdout) == ('echo', 'hi')
+    assert reply.public_key == PUBLIC_KEY1
+    assert reply.correlation_id == 'ab' * 16
+
+
+def test_unencrypted(client):
+    host = Host.get('master', create=True)
+    host.send('master', 'public_key %s' % PUBLIC_KEY1, await_response=False)
+    reply = host.receive(0)
+    assert (reply.name, reply.public_key) == ('public_key', PUBLIC_KEY1)
+
+
+def test_legacy_format(client):
+    host = Host.get('master', create=True)
+    encrypted = encrypt('{"name": "echo", "stdout": "hi"}', PUBLIC_KEY1)
+    host.client.send_message(
+        'master', '"decrypt %s"' % PUBLIC_KEY1, {'Encrypted': encrypted})
+    reply = host.receive(0)
+    assert (reply.name, reply.stdout, reply.public_key) == ('echo', 'hi', PUBLIC_KEY1)
+
+
+def test_small_payload_uncompressed(client):
+    host = Host.get('master', create=True)
+    [(body, payload)] = host._pack('echo', stdout='hi', recipient_key=PUBLIC_KEY1)
+    assert not envelope.unpack(payload['Envelope']).codec
+
+
+def test_compressed_payload(client):
+    host = Host.get('master', create=True)
+    stdout = 'package 1.0\n' * 10000
+    [(body, payload)] = host._pack('echo', stdout=stdout, recipient_key=PUBLIC_KEY1)
+    assert envelope.unpack(payload['Envelope']).codec == 'zlib'
+    assert len(payload['Envelope']) < len(stdout) / 10
+    host.send('master', 'echo', stdout=stdout, recipient_key=PUBLIC_KEY1, await_response=False)
+    assert host.receive(0).stdout == stdout
+
+
+def test_codec_disabled(client, monkeypatch):
+    monkeypatch.setenv('SERA_CODEC', 'none')
+    host = Host.get('master', create=True)
+    [(body, payload)] = host._pack('echo', stdout='x' * 1000, recipient_key=PUBLIC_KEY1)
+    assert not envelope.unpack(payload['Envelope']).codec
+
+
+def test_fragmented_payload(client, monkeypatch):
+    monkeypatch.setattr(sera, 'FRAGMENT_BYTES', 1000)
+    host = Host.get('master', create=True)
+    stdout = b64encode(os.urandom(3000)).decode('ascii')  # barely compressible
+    messages = host._pack('echo', stdout=stdout, recipient_key=PUBLIC_KEY1)
+    assert len(messages) > 1
+    # fragments can arrive in any order
+    for body, payload in reversed(messages):
+        host.client.send_message('master', body, payload)
+    reply = host.receive(0)
+    assert reply.stdout == stdout
+    assert not sera.FRAGMENTS
+    assert host.receive(0) is None
+
+
+def test_missing_fragment(client, monkeypatch):
+    monkeypatch.setattr(sera, 'FRAGMENT_BYTES', 1000)
+    host = Host.get('master', create=True)
+    stdout = b64encode(os.urandom(3000)).decode('ascii')
+    messages = host._pack('echo', stdout=stdout, recipient_key=PUBLIC_KEY1)
+    for body, payload in messages[1:]:
+        host.client.send_message('master', body, payload)
+    assert host.receive(0) is None
+    sera.FRAGMENTS.clear()
+
+
+def refragment(payload, index, count):
+    """Return a fragment's message attributes with another index and count"""
+    env = envelope.unpack(payload['Envelope'])
+    return {'Envelope': envelope.pack(
+        bytes(env.payload), env.sender_key, env.codec, env.correlation_id,
+        bool(env.flags & envelope.ENCRYPTED), fragment=(env.fragment_id, index, count))}
+
+
+def test_fragment_out_of_range(client, monkeypatch):
+    monkeypatch.setattr(sera, 'FRAGMENT_BYTES', 1000)
+    host = Host.get('master', create=True)
+    stdout = b64encode(os.urandom(2000)).decode('ascii')
+    messages = host._pack('echo', stdout=stdout, recipient_key=PUBLIC_KEY1)
+    count = len(messages)
+    (body, first), (_, second) = messages[:2]
+    bad = [refragment(first, count, count), refragment(second, 0, 0),
+           refragment(second, 1, count + 1)]
+    for payload in bad[:2] + [first, bad[2]] + [payload for _, payload in messages[1:]]:
+        host.client.send_message('master', body, payload)
+    assert host.receive(0).stdout == stdout
+    assert not sera.FRAGMENTS
+    assert host.receive(0) is None
+
+
+def test_repeated_fragment(client, monkeypatch):
+    monkeypatch.setattr(sera, 'FRAGMENT_BYTES', 1000)
+    host = Host.get('master', create=True)
+    stdout = b64encode(os.urandom(2000)).decode('ascii')
+    messages = host._pack('echo', stdout=stdout, recipient_key=PUBLIC_KEY1)
+    for body, payload in messages[:1] + messages:
+        host.client.send_message('master', body, payload)
+    assert host.receive(0).stdout == stdout
+    assert not sera.FRAGMENTS
+    assert host.receive(0) is None
+
+
+def test_sender_key():
+    data = envelope.pack(b'payload', bytes(range(32)))
+    assert envelope.sender_key(data) == bytes(range(32))
+    with pytest.raises(ValueError):
+        envelope.sender_key(b'{"name": "echo"}')
+
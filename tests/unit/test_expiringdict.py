@@ -0,0 +1,84 @@
+from threading import Thread
+import time
+
+from sera.expiringdict import ExpiringDict
+
+
+def test_get_set():
+    cache = ExpiringDict(60)
+    cache['a'] = 1
+    assert cache['a'] == 1
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert cache.get('b', 2) == 2
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    cache = ExpiringDict(10)
+    cache['a'] = 1
+    now[0] += 5
+    cache['b'] = 2
+    assert 0 < cache.ttl('a') <= 5
+    now[0] += 5
+    assert 'a' not in cache
+    assert list(cache) == ['b']
+    now[0] += 5
+    assert len(cache) == 0
+    assert cache.evictions == 2
+
+
+def test_expired_entries_evicted_on_write(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    cache = ExpiringDict(10)
+    for key in range(100):
+        cache[key] = key
+    now[0] += 10
+    cache['new'] = None
+    assert list(cache._items) == ['new']
+
+
+def test_max_len_evicts_least_recently_used():
+    cache = ExpiringDict(60, max_len=2)
+    cache['a'] = 1
+    cache['b'] = 2
+    cache['a']
+    cache['c'] = 3
+    assert sorted(cache) == ['a', 'c']
+    assert cache.evictions == 1
+
+
+def test_pop_and_items():
+    cache = ExpiringDict(60)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.pop('a') == 1
+    assert cache.pop('a', 'gone') == 'gone'
+    assert cache.items() == [('b', 2)]
+    assert cache.values() == [2]
+
+
+def test_sweep():
+    cache = ExpiringDict(0.01, sweep_interval=0.01)
+    cache['a'] = 1
+    time.sleep(0.1)
+    assert not cache._items
+
+
+def test_counts_concurrent_lookups():
+    cache = ExpiringDict(60, max_len=10)
+    cache['a'] = 1
+
+    def lookup():
+        for i in range(1000):
+            cache.get('a')
+            cache.get('b')
+    threads = [Thread(target=lookup) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert (cache.hits, cache.misses) == (8000, 8000)
@@ -0,0 +1,42 @@
+import sqlite3
+
+import pytest
+
+from conftest import PUBLIC_KEY1
+from sera.keystore import KeyStore
+
+
+def test_get_set(tmpdir):
+    keys = KeyStore(tmpdir.join('keys.db'))
+    assert keys.get('web-1') is None
+    keys['web-1'] = PUBLIC_KEY1
+    keys = KeyStore(tmpdir.join('keys.db'))
+    assert keys['web-1'] == PUBLIC_KEY1
+    assert 'web-1' in keys
+    del keys['web-1']
+    assert 'web-1' not in keys
+    with pytest.raises(KeyError):
+        keys['web-1']
+
+
+def test_bulk_update_is_atomic(tmpdir):
+    keys = KeyStore(tmpdir.join('keys.db'))
+    keys.update(('web-%i' % n, PUBLIC_KEY1) for n in range(1000))
+    assert len(keys) == 1000
+    with pytest.raises(sqlite3.Error):
+        keys.update([('db-1', PUBLIC_KEY1), ('db-2', object())])
+    assert 'db-1' not in keys
+
+
+def test_dotenv_import_export(tmpdir):
+    dotenv = tmpdir.join('known_watchers')
+    dotenv.write('web-1=%s\nweb-2="%s"\n' % (PUBLIC_KEY1, PUBLIC_KEY1))
+    keys = KeyStore.open(tmpdir.join('keys.db'), dotenv)
+    assert list(keys) == ['web-1', 'web-2']
+    assert keys['web-2'] == PUBLIC_KEY1
+    keys['web-3'] = PUBLIC_KEY1
+    assert keys.export_dotenv(dotenv) == 3
+    assert KeyStore(tmpdir.join('other.db')).import_dotenv(dotenv) == 3
+    # an existing store isn't imported into again
+    dotenv.write('web-4=%s\n' % PUBLIC_KEY1)
+    assert 'web-4' not in KeyStore.open(tmpdir.join('keys.db'), dotenv)
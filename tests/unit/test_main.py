@@ -0,0 +1,82 @@
+import json
+import os
+import subprocess
+import sys
+
+import click
+
+from sera.commands import main
+from sera.commands.main import LazyGroup, SUBCOMMAND_HELP, SUBCOMMAND_MODULES
+
+# runs in a fresh interpreter so modules imported by other tests don't count
+LAZY_IMPORTS = """
+import json, sys
+import click
+from click.testing import CliRunner
+from sera.commands.main import main, SUBCOMMAND_MODULES
+
+def loaded():
+    return sorted(set(SUBCOMMAND_MODULES.values()) & set(sys.modules))
+
+result = {'imported': loaded()}
+result['help'] = CliRunner().invoke(main, ['--help']).output
+result['after_help'] = loaded()
+main.resolve_command(click.Context(main), ['echo', 'hello'])
+result['after_echo'] = loaded()
+print(json.dumps(result))
+"""
+
+
+class EntryPoint:
+    def __init__(self, name, obj):
+        self.name = name
+        self.obj = obj
+
+    def load(self):
+        return self.obj
+
+
+def test_subcommands_imported_when_invoked():
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ, PYTHONPATH=root)
+    out = subprocess.run(
+        [sys.executable, '-c', LAZY_IMPORTS], env=env, check=True,
+        stdout=subprocess.PIPE).stdout
+    result = json.loads(out.decode())
+    assert result['imported'] == []
+    for name in SUBCOMMAND_MODULES:
+        assert '  %s' % name in result['help']
+    assert result['after_help'] == []
+    assert result['after_echo'] == ['sera.commands.echo']
+
+
+def test_subcommand_help_matches_commands():
+    ctx = click.Context(main.main)
+    assert sorted(SUBCOMMAND_HELP) == sorted(SUBCOMMAND_MODULES)
+    for name, help in SUBCOMMAND_HELP.items():
+        assert main.main.get_command(ctx, name).get_short_help_str(1000) == help
+
+
+def test_plugin_entry_points(monkeypatch):
+    @click.command()
+    def hello():
+        pass
+
+    @click.group()
+    def collection():
+        pass
+
+    @collection.command()
+    def world():
+        pass
+
+    entry_points = {
+        'sera.subcommand': [EntryPoint('hello', hello)],
+        'sera.collection': [EntryPoint('collection', collection)]}
+    monkeypatch.setattr(main, 'get_entry_points', entry_points.get)
+    group = LazyGroup(subcommand_modules={'echo': 'sera.commands.echo'})
+    ctx = click.Context(group)
+    assert group.list_commands(ctx) == ['echo', 'hello', 'world']
+    assert group.get_command(ctx, 'hello') is hello
+    assert group.get_command(ctx, 'world') is collection.commands['world']
+    assert group.get_command(ctx, 'missing') is None
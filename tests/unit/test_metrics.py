@@ -0,0 +1,48 @@
+import pytest
+
+from conftest import PUBLIC_KEY1
+from sera import metrics
+from sera.sera import Host
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(metrics, 'ENABLED', True)
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_disabled():
+    metrics.inc('sera_receives_total', result='empty')
+    assert not metrics.COUNTERS
+
+
+def test_render(enabled):
+    metrics.inc('sera_receives_total', result='empty')
+    metrics.inc('sera_receives_total', result='empty')
+    metrics.inc('sera_errors_total', stage='send')
+    metrics.observe('sera_command_seconds', 0.003, command='echo "x"')
+    metrics.observe('sera_command_seconds', 500, command='echo "x"')
+    text = metrics.render()
+    assert '# TYPE sera_command_seconds histogram' in text
+    assert 'sera_receives_total{result="empty"} 2' in text
+    assert 'sera_errors_total{stage="send"} 1' in text
+    assert 'sera_command_seconds_bucket{command="echo \\"x\\"",le="0.0025"} 0' in text
+    assert 'sera_command_seconds_bucket{command="echo \\"x\\"",le="0.005"} 1' in text
+    assert 'sera_command_seconds_bucket{command="echo \\"x\\"",le="120"} 1' in text
+    assert 'sera_command_seconds_bucket{command="echo \\"x\\"",le="+Inf"} 2' in text
+    assert 'sera_command_seconds_count{command="echo \\"x\\""} 2' in text
+
+
+def test_host_metrics(enabled, client):
+    master = Host.get('master', create=True)
+    watcher = Host.get('watcher', create=True)
+    assert watcher.receive(timeout=0) is None
+    master.send('watcher', 'echo', {}, PUBLIC_KEY1, await_response=False)
+    assert watcher.receive(timeout=0).name == 'echo'
+    counters = dict((key, value) for key, value in metrics.COUNTERS.items())
+    assert counters[('sera_receives_total', (('result', 'empty'),))] == 1
+    assert counters[('sera_receives_total', (('result', 'message'),))] == 1
+    for name in ['sera_send_seconds', 'sera_decrypt_seconds', 'sera_queue_wait_seconds']:
+        assert metrics.HISTOGRAMS[(name, ())][-1] == 1
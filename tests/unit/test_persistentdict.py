@@ -0,0 +1,35 @@
+import time
+
+from sera.persistentdict import PersistentExpiringDict
+
+
+def test_entries_persist(tmpdir):
+    path = tmpdir.join('cache.db')
+    cache = PersistentExpiringDict(60, path)
+    cache['a'] = None
+    cache['b'] = {'url': 'b'}
+    del cache['a']
+    cache = PersistentExpiringDict(60, path)
+    assert 'a' not in cache
+    assert cache['b'] == {'url': 'b'}
+    assert 0 < cache.ttl('b') <= 60
+
+
+def test_expired_rows_compacted(tmpdir, monkeypatch):
+    path = tmpdir.join('cache.db')
+    cache = PersistentExpiringDict(10, path, table='messages')
+    cache['a'] = None
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 10)
+    cache = PersistentExpiringDict(10, path, table='messages')
+    assert 'a' not in cache
+    assert not cache.db.execute('SELECT * FROM messages').fetchall()
+
+
+def test_max_len_on_load(tmpdir):
+    path = tmpdir.join('cache.db')
+    cache = PersistentExpiringDict(60, path)
+    for key in 'abc':
+        cache[key] = None
+    cache = PersistentExpiringDict(60, path, max_len=2)
+    assert sorted(cache) == ['b', 'c']
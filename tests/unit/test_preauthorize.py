@@ -0,0 +1,36 @@
+from conftest import PUBLIC_KEY1
+from sera import sera
+from sera.providers import memory
+from sera.sera import Host
+
+
+def test_preauthorize(client, monkeypatch):
+    master = Host.get('master', create=True)
+    watcher = Host.get('watcher', create=True)
+    watcher.allowed_clients = {'other'}
+    decrypted, deleted = [], []
+    monkeypatch.setattr(sera, 'decrypt', lambda *args, **kwargs: decrypted.append(args))
+    monkeypatch.setattr(watcher.client, 'delete_message', deleted.append)
+    for n in range(3):
+        master.send('watcher', 'echo', {'n': n}, PUBLIC_KEY1, await_response=False)
+    master.send('watcher', 'public_key %s' % PUBLIC_KEY1, await_response=False)
+    for n in range(4):
+        assert watcher.receive(timeout=0) is None
+    assert not decrypted
+    assert watcher.rejected == {PUBLIC_KEY1: 4}
+    assert watcher.rejected_total == 4
+    assert not deleted  # left to expire, watchers may not delete
+    watcher.allowed_clients = {PUBLIC_KEY1}
+    master.send('watcher', 'public_key %s' % PUBLIC_KEY1, await_response=False)
+    assert watcher.receive(timeout=0).name == 'public_key'
+
+
+def test_rejected_keys_bounded(client, monkeypatch):
+    monkeypatch.setattr(sera, 'REJECTED_MAX_KEYS', 2)
+    watcher = Host.get('watcher', create=True)
+    watcher.allowed_clients = set()
+    for key in ['a', 'b', 'c', 'c']:
+        monkeypatch.setattr(watcher, '_sender_key', lambda msg, key=key: key)
+        watcher._preauthorize(memory.Message(uid=key))
+    assert watcher.rejected == {'b': 1, 'c': 2}
+    assert watcher.rejected_total == 4
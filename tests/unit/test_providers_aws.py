@@ -0,0 +1,245 @@
+import time
+from uuid import uuid4
+
+from botocore.exceptions import ClientError, EndpointConnectionError
+import pytest
+
+from sera.providers import aws
+from sera.sera import Host
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    monkeypatch.setattr(aws, 'CLIENTS', {})
+    monkeypatch.setenv('SERA_REGION', 'us-east-1')
+    monkeypatch.setenv('SERA_ACCESS_KEY', 'access')
+    monkeypatch.setenv('SERA_SECRET_KEY', 'secret')
+    monkeypatch.setenv('SERA_ENDPOINT_CACHE', '')
+
+
+def test_get_boto_client_shared(clients, monkeypatch):
+    monkeypatch.setenv('SERA_MAX_POOL_CONNECTIONS', '25')
+    client = aws.get_boto_client('sqs')
+    assert aws.get_boto_client('sqs', 'us-east-1', 'access', 'secret') is client
+    assert client.meta.config.max_pool_connections == 25
+    assert client.meta.config.tcp_keepalive
+    assert aws.get_boto_client('sqs', 'us-west-2') is not client
+    assert aws.get_boto_client('sqs', access_key='other') is not client
+
+
+def test_providers_share_client(clients):
+    assert aws.AWSProvider().sqs is aws.AWSProvider(namespace='other').sqs
+
+
+def client_error(code, status=400):
+    return ClientError(
+        {'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}},
+        'ReceiveMessage')
+
+
+def test_is_transient():
+    assert aws.is_transient(client_error('ThrottlingException'))
+    assert aws.is_transient(client_error('Unknown', 503))
+    assert aws.is_transient(EndpointConnectionError(endpoint_url='https://sqs'))
+    assert not aws.is_transient(client_error('AccessDenied', 403))
+    assert not aws.is_transient(client_error('AWS.SimpleQueueService.NonExistentQueue'))
+    assert not aws.is_transient(ValueError())
+
+
+class StubSQS(object):
+    """Records calls to the sqs api, with queues that can be deleted and recreated"""
+
+    def __init__(self):
+        self.meta = type('Meta', (), {'region_name': 'us-east-1'})
+        self.queues = {}  # name: url
+        self.messages = {}  # url: messages waiting to be received
+        self.batches = []  # entries of each send_message_batch
+        self.failing = set()  # batch entry ids that fail
+        self.calls = []
+
+    def _check(self, url):
+        if url not in self.queues.values():
+            raise client_error('AWS.SimpleQueueService.NonExistentQueue')
+
+    def get_queue_url(self, QueueName):
+        self.calls.append(('get_queue_url', QueueName))
+        if QueueName not in self.queues:
+            raise client_error('AWS.SimpleQueueService.NonExistentQueue')
+        return {'QueueUrl': self.queues[QueueName]}
+
+    def create_queue(self, QueueName, Attributes):
+        self.calls.append(('create_queue', QueueName))
+        url = 'https://sqs/%s/%i' % (QueueName, len(self.calls))
+        self.queues.setdefault(QueueName, url)
+        return {'QueueUrl': self.queues[QueueName]}
+
+    def send_message(self, QueueUrl, **kwargs):
+        self.calls.append(('send_message', QueueUrl))
+        self._check(QueueUrl)
+        return {'MessageId': '1'}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.calls.append(('send_message_batch', QueueUrl))
+        self._check(QueueUrl)
+        self.batches.append(Entries)
+        return {
+            'Successful': [
+                {'Id': entry['Id']} for entry in Entries if entry['Id'] not in self.failing],
+            'Failed': [
+                {'Id': entry['Id'], 'Code': 'InternalError', 'SenderFault': False}
+                for entry in Entries if entry['Id'] in self.failing]}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, **kwargs):
+        self.calls.append(('receive_message', QueueUrl))
+        self._check(QueueUrl)
+        messages = self.messages.get(QueueUrl, [])
+        received, messages[:] = messages[:MaxNumberOfMessages], messages[MaxNumberOfMessages:]
+        return {'Messages': received} if received else {}
+
+    def put(self, url, *bodies):
+        """Queue messages for receive_message"""
+        self.messages.setdefault(url, []).extend({
+            'MessageId': uuid4().hex, 'ReceiptHandle': uuid4().hex, 'Body': body,
+            'Attributes': {'SentTimestamp': '0'},
+            'MessageAttributes': {'Sender': {'StringValue': 'master'}}} for body in bodies)
+
+
+@pytest.fixture
+def stub(clients, monkeypatch, tmp_path):
+    monkeypatch.setenv('SERA_ENDPOINT_CACHE', str(tmp_path / 'endpoints.db'))
+    monkeypatch.setattr(aws, 'ENDPOINT_CACHE', None)
+    sqs = StubSQS()
+
+    def provider(creator=True, name='master', **kwargs):
+        provider = aws.AWSProvider(**kwargs)
+        provider.sqs = sqs
+        provider.endpoint = Host(name, client=provider, creator=creator)
+        return provider
+    yield sqs, provider
+
+
+def test_endpoint_cache_persists(stub, monkeypatch):
+    sqs, provider = stub
+    provider().send_message('watcher', 'echo')
+    monkeypatch.setattr(aws, 'ENDPOINT_CACHE', None)  # a later invocation
+    sqs.calls = []
+    provider().send_message('watcher', 'echo')
+    assert [call for call, arg in sqs.calls] == ['send_message']
+
+
+def test_endpoint_cache_key_per_account(stub):
+    sqs, provider = stub
+    assert provider()._cache_key('watcher') != provider(access_key='other')._cache_key('watcher')
+    assert provider()._cache_key('watcher') == provider(namespace='sera')._cache_key('watcher')
+
+
+def test_stale_endpoint_retried_once(stub):
+    sqs, provider = stub
+    provider = provider()
+    provider.send_message('watcher', 'echo')
+    sqs.queues.clear()  # deleted and recreated on the next send
+    sqs.calls = []
+    provider.send_message('watcher', 'echo')
+    assert [call for call, arg in sqs.calls] == [
+        'send_message', 'get_queue_url', 'create_queue', 'send_message']
+
+
+def test_missing_endpoint_not_created(stub):
+    sqs, provider = stub
+    assert provider(creator=False).send_message('watcher', 'echo') is None
+    assert [call for call, arg in sqs.calls] == ['get_queue_url']
+
+
+def test_receive_url_resolved_when_stale(stub):
+    sqs, provider = stub
+    provider = provider(creator=False)
+    provider.endpoint.url = 'https://sqs/old'
+    sqs.queues['sera-master'] = 'https://sqs/new'
+    assert provider.receive_message(0) is None
+    assert provider.endpoint.url == 'https://sqs/new'
+    sqs.calls = []
+    provider.receive_message(0)
+    assert sqs.calls == [('receive_message', 'https://sqs/new')]
+
+
+def test_receive_from_deleted_queue(stub, caplog):
+    sqs, provider = stub
+    provider = provider(creator=False)
+    sqs.queues['sera-master'] = 'https://sqs/old'
+    provider.endpoint.url = provider.get_endpoint('master')
+    del sqs.queues['sera-master']
+    assert provider.receive_message(0) is None
+    assert provider._cache_key('master') not in provider.cache
+    assert [call for call, arg in sqs.calls] == [
+        'get_queue_url', 'receive_message', 'get_queue_url']
+    assert "sera-master queue doesn't exist" in caplog.text
+    sqs.queues['sera-master'] = 'https://sqs/new'
+    provider.receive_message(0)
+    assert provider.endpoint.url == 'https://sqs/new'
+
+
+def receiver(provider, name, **kwargs):
+    """Return a provider receiving on the queue of a name"""
+    receiver = provider(name=name, **kwargs)
+    receiver.endpoint.url = receiver.create_endpoint(name)
+    return receiver
+
+
+def test_batch_receive_prefetched(stub):
+    sqs, provider = stub
+    watcher = receiver(provider, 'watcher', MaxNumberOfMessages=10)
+    sqs.put(watcher.endpoint.url, 'one', 'two', 'three')
+    sqs.calls = []
+    assert [watcher.receive_message(0).body for i in range(3)] == ['one', 'two', 'three']
+    assert [call for call, arg in sqs.calls] == ['receive_message']
+
+
+def test_prefetched_expire_at_visibility_deadline(stub):
+    sqs, provider = stub
+    watcher = receiver(provider, 'watcher', MaxNumberOfMessages=10, VisibilityTimeout=0.05)
+    sqs.put(watcher.endpoint.url, 'one', 'two', 'three')
+    assert watcher.receive_message(0).body == 'one'
+    time.sleep(0.05)  # the others are visible on the queue again
+    sqs.put(watcher.endpoint.url, 'four')
+    assert watcher.receive_message(0).body == 'four'
+    assert not watcher.prefetched
+    assert watcher.receive_message(0) is None
+
+
+def test_prefetched_per_queue(stub):
+    sqs, provider = stub
+    web1 = receiver(provider, 'web1', MaxNumberOfMessages=10)
+    web2 = receiver(provider, 'web2', MaxNumberOfMessages=10)
+    sqs.put(web1.endpoint.url, 'one', 'two')
+    sqs.put(web2.endpoint.url, 'three')
+    assert web1.receive_message(0).body == 'one'
+    assert web2.receive_message(0).body == 'three'
+    assert web2.receive_message(0) is None
+    assert web1.receive_message(0).body == 'two'
+
+
+def test_send_batch_split_by_entries(stub):
+    sqs, provider = stub
+    provider().send_message_batch([('watcher', str(i), {}) for i in range(23)])
+    assert [len(batch) for batch in sqs.batches] == [10, 10, 3]
+    assert [entry['MessageBody'] for batch in sqs.batches for entry in batch] == [
+        str(i) for i in range(23)]
+    assert [entry['Id'] for entry in sqs.batches[-1]] == ['0', '1', '2']
+
+
+def test_send_batch_split_by_size(stub, monkeypatch):
+    monkeypatch.setattr(aws, 'MaxBatchBytes', 1000)
+    sqs, provider = stub
+    provider().send_message_batch([('watcher', 'x' * 400, {}) for i in range(5)])
+    assert [len(batch) for batch in sqs.batches] == [2, 2, 1]
+
+
+def test_send_batch_failed_entries(stub, keys, caplog):
+    sqs, provider = stub
+    sqs.failing = {'1'}
+    master = provider().endpoint
+    responses = master.send_batch([
+        ('web1', 'echo', '', None), ('web1', 'echo', '', None), ('web2', 'echo', '', None)])
+    assert [[failed['Id'] for failed in response['Failed']] for response in responses] == [
+        ['1'], []]
+    assert 'InternalError sending batch entry 1' in caplog.text
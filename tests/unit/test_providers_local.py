@@ -0,0 +1,118 @@
+import gc
+import json
+import os
+from pathlib import Path
+import stat
+import threading
+import time
+
+from conftest import PUBLIC_KEY1
+from sera.providers import local
+from sera.providers.local import LocalProvider
+from sera.sera import Host
+
+
+def test_get_missing_endpoint(spool):
+    assert not LocalProvider().get_endpoint('missing')
+
+
+def test_send_receive_message(spool):
+    host = Host.get('master', create=True)
+    host.client.send_message(host.name, 'test', {'Encrypted': b'\x00\x01'})
+    msg = host.client.receive_message()
+    assert msg.body == 'test'
+    assert msg.sender == 'master'
+    assert msg.encrypted == b'\x00\x01'
+    assert not host.client.receive_message()
+
+
+def test_message_visible_after_timeout(spool):
+    host = Host.get('master', create=True, VisibilityTimeout=0)
+    host.client.send_message(host.name, 'test')
+    assert host.client.receive_message().body == 'test'
+    host.client.swept = 0
+    assert host.client.receive_message().body == 'test'
+
+
+def test_host_send_encrypted(spool):
+    host = Host.get('master', create=True)
+    resp = host.send(host.name, 'echo', {'args': ['hello']}, PUBLIC_KEY1, timeout=0)
+    assert resp.name == 'echo'
+    assert resp.params == {'args': ['hello']}
+    assert resp.public_key == PUBLIC_KEY1
+
+
+def test_unencrypted_message(spool):
+    host = Host.get('master', create=True)
+    host.client.send_message(host.name, json.dumps('public_key %s' % PUBLIC_KEY1))
+    resp = host.receive(timeout=0)
+    assert resp.name == 'public_key'
+    assert resp.public_key == PUBLIC_KEY1
+
+
+def test_message_retention(spool):
+    host = Host.get('master', create=True, MessageRetentionPeriod=0)
+    host.client.send_message(host.name, 'test')
+    host.client.swept = 0
+    assert not host.client.receive_message()
+
+
+def test_spool_group_writable(spool):
+    spool_path = Path(str(spool)) / 'spool'
+    url = LocalProvider(spool_path=str(spool_path)).create_endpoint('watcher')
+    for path in [spool_path, Path(url), Path(url) / 'new']:
+        assert stat.S_IMODE(path.stat().st_mode) == 0o2770
+    host = Host.get('master', create=True)
+    host.client.send_message(host.name, 'test')
+    path, = (Path(host.url) / 'new').iterdir()
+    assert stat.S_IMODE(path.stat().st_mode) == 0o660
+
+
+def test_send_to_missing_endpoint(spool):
+    host = Host.get('master', create=True)
+    host.creator = False
+    assert host.client.send_message('missing', 'test') is None
+    assert host.list_endpoints() == ['master']
+
+
+def test_receive_from_missing_endpoint(spool):
+    host = Host.get('watcher', create=True)
+    host.client.delete_endpoint(host.url)
+    start = time.time()
+    assert host.client.receive_message(0.1) is None
+    assert time.time() - start >= 0.1  # waited for the endpoint
+
+
+def test_receiver_woken_on_delivery(spool, monkeypatch):
+    monkeypatch.setattr(local, 'MinPollInterval', 10)  # only a wakeup can end the wait
+    watcher = Host.get('watcher', create=True)
+    master = Host.get('master', create=True)
+    received = []
+    thread = threading.Thread(target=lambda: received.append(watcher.client.receive_message(5)))
+    thread.start()
+    wait = Path(watcher.url) / 'wake'
+    while not list(wait.iterdir()):  # the receiver is waiting
+        time.sleep(0.01)
+    start = time.time()
+    master.client.send_message('watcher', 'test')
+    thread.join()
+    assert time.time() - start < 1
+    assert received[0].body == 'test'
+
+
+def test_fifo_removed_with_receiver(spool):
+    host = Host.get('watcher', create=True)
+    host.client.receive_message(0.01)
+    fifo, = (Path(host.url) / 'wake').iterdir()
+    del host.client
+    gc.collect()
+    assert not fifo.exists()
+
+
+def test_stale_fifo_removed(spool):
+    host = Host.get('watcher', create=True)
+    fifo = Path(host.url) / 'wake' / ('1-stale@%s' % local.HOSTNAME)
+    os.mkfifo(str(fifo))
+    host.client.send_message(host.name, 'test')
+    assert not fifo.exists()
+    assert host.client.receive_message().body == 'test'
@@ -0,0 +1,66 @@
+import time
+
+from conftest import PUBLIC_KEY1
+from sera.providers import memory
+from sera.sera import Host
+
+
+def test_send_receive_message(client):
+    host = Host.get('master', create=True)
+    host.client.send_message(host.name, 'test')
+    msg = host.client.receive_message()
+    assert msg.body == 'test'
+    assert msg.sender == 'master'
+    assert not host.client.receive_message()
+
+
+def test_send_to_missing_endpoint(client):
+    host = Host.get('master', create=True)
+    host.creator = False
+    assert host.client.send_message('missing', 'test') is None
+    assert host.list_endpoints() == ['master']
+
+
+def test_receive_from_missing_endpoint(client):
+    host = Host.get('watcher', create=True)
+    host.client.delete_endpoint(host.url)
+    start = time.time()
+    assert host.client.receive_message(0.1) is None
+    assert time.time() - start >= 0.1  # waited for the endpoint
+    host.client.create_endpoint(host.name)
+    host.client.send_message(host.name, 'test')
+    assert host.client.receive_message().body == 'test'
+
+
+def test_message_visible_after_timeout():
+    queue = memory.Queue()
+    record = {'uid': '1', 'sent': 0}
+    queue.put(record)
+    assert queue.get(now=0, retention=60, visibility=10) is record
+    assert not queue.get(now=5, retention=60, visibility=10)
+    assert queue.get(now=10, retention=60, visibility=10) is record
+
+
+def test_message_retention(client):
+    host = Host.get('master', create=True, MessageRetentionPeriod=-1)
+    host.client.send_message(host.name, 'test')
+    assert not host.client.receive_message()
+
+
+def test_duplicate_delivery_dropped(client):
+    host = Host.get('master', create=True, DuplicateRate=0.5)
+    for i in range(20):
+        host.client.send_message(host.name, str(i))
+    bodies = []
+    msg = host.client.receive_message()
+    while msg:
+        bodies.append(msg.body)
+        msg = host.client.receive_message()
+    assert sorted(bodies, key=int) == [str(i) for i in range(20)]
+
+
+def test_host_send_encrypted(client):
+    host = Host.get('master', create=True)
+    resp = host.send(host.name, 'echo', {'args': ['hello']}, PUBLIC_KEY1, timeout=0)
+    assert resp.name == 'echo'
+    assert resp.params == {'args': ['hello']}
\ No newline at end of file
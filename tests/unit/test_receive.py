@@ -0,0 +1,102 @@
+import pytest
+
+from sera import sera
+from sera.sera import Host
+
+
+def failing(errors, receive_message):
+    """Return a receive_message that raises each error in turn before receiving"""
+    errors = list(errors)
+
+    def receive(timeout=0):
+        if errors:
+            raise errors.pop(0)
+        return receive_message(timeout)
+    return receive
+
+
+def test_permanent_error_raised(client, monkeypatch):
+    host = Host.get('watcher', create=True)
+    monkeypatch.setattr(host.client, 'receive_message', failing(
+        [PermissionError('denied')], host.client.receive_message))
+    with pytest.raises(PermissionError):
+        host.receive()
+
+
+def test_transient_error_retried(client, monkeypatch):
+    delays = []
+    monkeypatch.setattr(sera.time, 'sleep', delays.append)
+    host = Host.get('watcher', create=True)
+    monkeypatch.setattr(host.client, 'receive_message', failing(
+        [ConnectionError('reset'), TimeoutError('slow')], host.client.receive_message))
+    host.client.send_message('watcher', 'echo')
+    assert host.receive(timeout=5).name == 'echo'
+    assert len(delays) == 2
+
+
+def test_is_transient():
+    class Provider(object):
+        def is_transient(self, err):
+            return isinstance(err, KeyError)
+
+    assert sera.is_transient(object(), ConnectionError())
+    assert not sera.is_transient(object(), ValueError())
+    assert sera.is_transient(Provider(), KeyError())
+    assert not sera.is_transient(Provider(), ConnectionError())
+
+
+def empty_polls(count, receive_message):
+    """Return a receive_message that returns nothing count times, recording timeouts"""
+    waits = []
+
+    def receive(timeout=0):
+        waits.append(timeout)
+        if len(waits) <= count:
+            return
+        return receive_message(timeout)
+    return receive, waits
+
+
+def test_polls_back_to_back(client, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(sera.time, 'sleep', sleeps.append)
+    host = Host.get('watcher', create=True)
+    receive, waits = empty_polls(3, host.client.receive_message)
+    monkeypatch.setattr(host.client, 'receive_message', receive)
+    host.client.send_message('watcher', 'echo')
+    assert host.receive(timeout=10).name == 'echo'
+    assert len(waits) == 4
+    assert all(0 < wait <= 10 for wait in waits)
+    assert not sleeps
+
+
+def test_idle_delay(client, monkeypatch):
+    monkeypatch.setenv('SERA_IDLE_AFTER', '0')
+    monkeypatch.setenv('SERA_IDLE_DELAY', '2.5')
+    sleeps = []
+    monkeypatch.setattr(sera.time, 'sleep', sleeps.append)
+    host = Host.get('watcher', create=True)
+    receive, waits = empty_polls(3, host.client.receive_message)
+    monkeypatch.setattr(host.client, 'receive_message', receive)
+    host.client.send_message('watcher', 'echo')
+    assert host.receive(timeout=10).name == 'echo'
+    assert sleeps == [2.5, 2.5, 2.5]
+
+
+def test_backoff(monkeypatch):
+    monkeypatch.setattr(sera.random, 'uniform', lambda low, high: high)
+    assert [sera.backoff(attempt, max_delay=5) for attempt in range(1, 6)] == [1, 2, 4, 5, 5]
+    monkeypatch.setenv('SERA_MAX_DELAY', '3')
+    assert sera.backoff(10) == 3
+
+
+def test_backoff_after_errors(client, monkeypatch):
+    monkeypatch.setattr(sera.random, 'uniform', lambda low, high: high)
+    sleeps = []
+    monkeypatch.setattr(sera.time, 'sleep', sleeps.append)
+    host = Host.get('watcher', create=True)
+    monkeypatch.setattr(host.client, 'receive_message', failing(
+        [ConnectionError()] * 3, host.client.receive_message))
+    host.client.send_message('watcher', 'echo')
+    assert host.receive(timeout=10).name == 'echo'
+    assert sleeps == [1, 2, 4]
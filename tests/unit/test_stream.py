@@ -0,0 +1,44 @@
+from conftest import PUBLIC_KEY1
+from sera.sera import Host, run_stream
+
+
+def test_run_stream():
+    chunks = []
+    out = run_stream(
+        ['sh', '-c', 'echo a; sleep 0.2; echo b >&2; exit 2'],
+        lambda stdout, stderr: chunks.append((stdout, stderr)), interval=0.1)
+    assert out.returncode == 2
+    assert not out.stdout
+    assert chunks == [('a\n', ''), ('', 'b\n')]
+
+
+def test_run_stream_chunk_size():
+    chunks = []
+    run_stream(
+        ['sh', '-c', 'seq 1 100'],
+        lambda stdout, stderr: chunks.append(stdout), interval=10, chunk_size=100)
+    assert ''.join(chunks) == ''.join('%i\n' % i for i in range(1, 101))
+    assert len(chunks) > 1
+
+
+def test_send_stream_reassembles(client):
+    master = Host.get('master', create=True)
+    watcher = Host.get('web-1', create=True)
+    # out of order with the final result before the last chunk
+    for seq, stdout, returncode in [(1, 'b', None), (2, '', 0), (0, 'a', None)]:
+        watcher.send(
+            'master', 'slow', recipient_key=PUBLIC_KEY1, stdout=stdout,
+            returncode=returncode, seq=seq, await_response=False)
+    chunks = []
+    out = master.send_stream(
+        'web-1', 'slow', {}, PUBLIC_KEY1, lambda stdout, stderr: chunks.append(stdout),
+        timeout=1)
+    assert chunks == ['a', 'b']
+    assert out.returncode == 0
+    assert watcher.receive(0).stream
+
+
+def test_send_stream_timeout(client):
+    master = Host.get('master', create=True)
+    Host.get('web-1', create=True)
+    assert master.send_stream('web-1', 'slow', {}, PUBLIC_KEY1, print, timeout=0) is None
@@ -0,0 +1,53 @@
+from conftest import PUBLIC_KEY1
+from sera.sera import Host, aggregate, RemoteCommand
+from sera.utils import is_target_pattern, resolve_targets
+
+
+def test_is_target_pattern():
+    assert is_target_pattern('web-*')
+    assert is_target_pattern('@web')
+    assert not is_target_pattern('web.example.com')
+
+
+def test_resolve_targets(tmpdir):
+    known = ['web-1', 'web-2', 'db-1']
+    endpoints = ['web-3', PUBLIC_KEY1.replace('=', '')]
+    assert resolve_targets('web-*', known, endpoints) == ['web-1', 'web-2', 'web-3']
+    assert resolve_targets('*', [], endpoints) == ['web-3']
+    groups = tmpdir.join('groups')
+    groups.write('web="db-1 web-[12]"\nother=new.example.com\n')
+    assert resolve_targets('@web', known, endpoints, groups) == ['db-1', 'web-1', 'web-2']
+    assert resolve_targets('@other', known, endpoints, groups) == ['new-example-com']
+    assert resolve_targets('@missing', known, endpoints, groups) == []
+
+
+def test_send_all(client):
+    master = Host.get('master', create=True)
+    watchers = [Host.get(name, create=True) for name in ['web-1', 'web-2', 'web-3']]
+    assert sorted(master.client.list_endpoints()) == ['master', 'web-1', 'web-2', 'web-3']
+    # replies arrive before send_all receives them
+    for watcher in watchers[:2]:
+        watcher.send(
+            'master', 'echo', recipient_key=PUBLIC_KEY1, stdout='hi', returncode=0,
+            await_response=False)
+    watchers[2].send('master', 'other', await_response=False)
+    replies = master.send_all(
+        dict((watcher.name, None) for watcher in watchers), 'echo', timeout=0.1)
+    assert [reply and reply.stdout for reply in replies.values()] == ['hi', 'hi', None]
+    assert watchers[0].receive(0)  # the command was sent
+
+
+def test_aggregate():
+    out = aggregate({
+        'web-1': RemoteCommand(returncode=0, stdout='ok', stderr=''),
+        'web-2': None,
+        'web-3': RemoteCommand(returncode=0, stdout='ok', stderr=''),
+        'web-4': RemoteCommand(returncode=1, stdout='', stderr='failed'),
+    })
+    assert out.returncode == 1
+    assert out.stdout.splitlines() == [
+        'web-1, web-3 (2): returncode 0',
+        '    ok',
+        'web-2 (1): no response',
+        'web-4 (1): returncode 1',
+        '    failed']
@@ -1,8 +1,10 @@
 import os
+from pathlib import Path
 
 # import pytest
 
-from sera.utils import keygen, encrypt, decrypt, get_default_envpath, get_allowed_clients
+from sera.utils import (
+    keygen, encrypt, decrypt, get_box, loadenv, get_allowed_clients)
 from dotenv import get_key
 
 SECRET_KEY1 = 'mWxBUK-aDh6qZRhdFROhTyiQVdk2pZwqwq-hq4-5elw='
@@ -12,7 +14,7 @@ PUBLIC_KEY2 = 'enLttA6OYJ1ctH3cDRi21uLwTXWRLC_jhY_e952lt3E='
 
 
 def test_keygen():
-    keygen('.testenv', write=True)
+    keygen(Path('.testenv'), write=True)
     private_key = get_key('.testenv', 'SERA_CLIENT_PRIVATE_KEY')
     print(private_key)
     public_key = get_key('.testenv', 'SERA_CLIENT_PUBLIC_KEY')
@@ -33,9 +35,20 @@ def test_encrypt_decrypt():
     assert msg2 == 'test'
 
 
-def test_get_default_envpath(dotenv_file):
-    path = get_default_envpath()
-    assert path == str(dotenv_file)
+def test_get_box_cached():
+    box = get_box(SECRET_KEY1, PUBLIC_KEY2)
+    assert get_box(SECRET_KEY1, PUBLIC_KEY2) is box
+    assert get_box(SECRET_KEY2, PUBLIC_KEY1) is not box
+    msg = encrypt('test', recipient_key=PUBLIC_KEY1, private_key=SECRET_KEY2)
+    assert decrypt(msg, PUBLIC_KEY2, SECRET_KEY1) == 'test'
+
+
+def test_loadenv(tmp_path, monkeypatch):
+    monkeypatch.delenv('SERA_TEST_VARIABLE', raising=False)
+    envpath = tmp_path / 'env'
+    envpath.write_text('SERA_TEST_VARIABLE=1\n')
+    assert loadenv(tmp_path) == (envpath, True)
+    assert os.getenv('SERA_TEST_VARIABLE') == '1'
 
 
 def test_get_allowed_clients(allowed_clients_file):
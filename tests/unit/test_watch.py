@@ -0,0 +1,101 @@
+import logging
+import threading
+import time
+
+import pytest
+
+from conftest import PUBLIC_KEY1
+from sera.commands import main as main_module, watch
+from sera.commands.main import main
+from sera.sera import Host
+
+
+@pytest.fixture
+def master(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(main_module, 'configure_path', lambda: tmp_path)
+    Host.get('watcher', create=True)
+    return Host.get('master', create=True)
+
+
+def run_watch(master, workers):
+    """Watch until an end command, waking the poll so the watcher notices it"""
+    stopped = threading.Event()
+
+    def wake():
+        while not stopped.wait(0.05):
+            send(master, 'wake')
+    thread = threading.Thread(target=wake)
+    thread.start()
+    try:
+        main.main(
+            ['-w', 'watcher', '-t', '10', '-v', '0', 'watch', '-c', PUBLIC_KEY1,
+             '-n', str(workers)], standalone_mode=False)
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def send(master, *names):
+    for name in names:
+        master.send('watcher', name, {}, PUBLIC_KEY1, await_response=False)
+
+
+def fake_execute(ran, before=None):
+    """Return an execute that records commands, ends on end and fails on fail"""
+    def execute(ctx, host, cmd):
+        if cmd.name == 'end':
+            raise SystemExit()
+        if cmd.name == 'fail':
+            raise RuntimeError('failed')
+        if before:
+            before(cmd)
+        ran.append(cmd.name)
+    return execute
+
+
+def test_workers_run_concurrently(master, monkeypatch):
+    in_flight = threading.Barrier(3, timeout=5)  # both commands and the test
+    ran = []
+    monkeypatch.setattr(watch, 'execute', fake_execute(
+        ran, lambda cmd: cmd.name != 'wake' and in_flight.wait()))
+    send(master, 'one', 'two')
+
+    def end():
+        in_flight.wait()
+        send(master, 'end')
+    thread = threading.Thread(target=end)
+    thread.start()
+    with pytest.raises(SystemExit):
+        run_watch(master, 2)
+    thread.join()
+    assert sorted(ran)[:2] == ['one', 'two']
+
+
+def test_end_in_worker_stops_watch(master, monkeypatch):
+    ran = []
+    monkeypatch.setattr(watch, 'execute', fake_execute(ran))
+    send(master, 'one', 'end')
+    with pytest.raises(SystemExit):
+        run_watch(master, 2)
+    assert 'one' in ran
+
+
+def test_failed_worker_logged(master, monkeypatch, caplog):
+    ran = []
+    monkeypatch.setattr(watch, 'execute', fake_execute(ran))
+    send(master, 'fail', 'two')
+    with caplog.at_level(logging.ERROR, logger='sera.commands.watch'):
+        thread = threading.Thread(target=lambda: (
+            wait_for(lambda: 'two' in ran), send(master, 'end')))
+        thread.start()
+        with pytest.raises(SystemExit):
+            run_watch(master, 2)
+        thread.join()
+    assert 'Command failed: failed' in caplog.text
+    assert 'two' in ran  # the watcher kept going
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)